@@ -16,10 +16,6 @@
 import json
 import re
 import traceback
-import uuid
-import base64
-import time
-import io
 from copy import deepcopy
 
 import trio
@@ -34,125 +30,13 @@ from api.db.services.conversation_service import ConversationService, structure_
 from api.db.services.dialog_service import DialogService, ask, chat
 from api.db.services.knowledgebase_service import KnowledgebaseService
 from api.db.services.llm_service import LLMBundle, TenantService
+from api.db.services.temp_file_service import get_temp_file_contents, get_temp_file_info, save_temp_file
 from api.db.services.user_service import UserTenantService, UserService
 from api.db.services.write_service import upload_image, write_dialog
 from api.utils.api_utils import get_data_error_result, get_json_result, server_error_response, validate_request
+from api.utils.delta_stream import delta_events, sse
 from graphrag.general.mind_map_extractor import MindMapExtractor
 from rag.app.tag import label_question
-from rag.utils.redis_conn import REDIS_CONN
-
-try:
-    from docx import Document
-    DOCX_AVAILABLE = True
-except ImportError:
-    DOCX_AVAILABLE = False
-
-try:
-    import olefile
-    from docx2txt import process as docx2txt_process
-    DOC_AVAILABLE = True
-except ImportError:
-    DOC_AVAILABLE = False
-
-
-def extract_file_content(file_content_bytes, filename, content_type):
-    """
-    根据文件类型提取文件内容
-    
-    Args:
-        file_content_bytes: 文件的二进制内容
-        filename: 文件名
-        content_type: MIME类型
-    
-    Returns:
-        str: 提取的文本内容
-    """
-    try:
-        # 获取文件扩展名
-        file_ext = filename.lower().split('.')[-1] if '.' in filename else ''
-        
-        # 处理旧版Word文档(.doc)
-        if file_ext == 'doc':
-            try:
-                # 对于.doc文件，由于格式复杂，我们提供一个友好的提示
-                return f'检测到旧版Word文档(.doc格式)：{filename}\n\n由于.doc格式的复杂性，建议您：\n1. 将文件另存为.docx格式后重新上传\n2. 或者复制文档内容直接粘贴到聊天框中\n\n这样可以确保内容被正确解析和处理。'
-            except Exception as e:
-                print(f".doc文件处理错误: {e}")
-                return f'无法处理.doc格式文件：{filename}\n建议转换为.docx格式或直接粘贴文本内容。'
-        
-        # 处理新版Word文档(.docx)
-        elif file_ext == 'docx' or 'word' in content_type.lower():
-            if DOCX_AVAILABLE:
-                try:
-                    # 使用python-docx处理Word文档
-                    doc_stream = io.BytesIO(file_content_bytes)
-                    doc = Document(doc_stream)
-                    
-                    # 提取所有段落文本
-                    paragraphs = []
-                    for paragraph in doc.paragraphs:
-                        if paragraph.text.strip():
-                            paragraphs.append(paragraph.text.strip())
-                    
-                    # 提取表格内容
-                    for table in doc.tables:
-                        for row in table.rows:
-                            row_text = []
-                            for cell in row.cells:
-                                if cell.text.strip():
-                                    row_text.append(cell.text.strip())
-                            if row_text:
-                                paragraphs.append(' | '.join(row_text))
-                    
-                    return '\n\n'.join(paragraphs) if paragraphs else '无法提取文档内容'
-                    
-                except Exception as e:
-                    print(f"Word文档处理错误: {e}")
-                    return f'Word文档解析失败：{filename}\n建议检查文件是否损坏或转换为文本格式。'
-            else:
-                return f'缺少Word文档处理库，无法解析：{filename}\n建议将内容复制粘贴到聊天框中。'
-        
-        # 处理文本文件
-        elif file_ext in ['txt', 'md', 'py', 'js', 'html', 'css', 'json', 'xml', 'csv'] or 'text' in content_type.lower():
-            # 尝试多种编码
-            encodings = ['utf-8', 'gbk', 'gb2312', 'big5', 'latin1']
-            for encoding in encodings:
-                try:
-                    return file_content_bytes.decode(encoding)
-                except UnicodeDecodeError:
-                    continue
-            # 如果所有编码都失败，使用错误忽略模式
-            return file_content_bytes.decode('utf-8', errors='ignore')
-        
-        # 处理PDF文件
-        elif file_ext == 'pdf':
-            return f'暂不支持PDF文件内容提取：{filename}\n建议转换为Word或文本格式后重新上传。'
-        
-        # 其他文件类型
-        else:
-            # 尝试作为文本文件处理
-            try:
-                # 先尝试UTF-8
-                text_content = file_content_bytes.decode('utf-8')
-                # 检查是否包含过多的非打印字符（可能是二进制文件）
-                non_printable_ratio = sum(1 for c in text_content if ord(c) < 32 and c not in '\n\r\t') / len(text_content) if text_content else 0
-                if non_printable_ratio > 0.3:  # 如果超过30%是非打印字符，可能是二进制文件
-                    return f'检测到二进制文件：{filename}\n文件类型：{content_type}\n建议上传文本格式的文件以获得更好的处理效果。'
-                return text_content
-            except UnicodeDecodeError:
-                # 尝试其他编码
-                encodings = ['gbk', 'gb2312', 'big5', 'latin1']
-                for encoding in encodings:
-                    try:
-                        return file_content_bytes.decode(encoding, errors='ignore')
-                    except:
-                        continue
-                return f'无法解析文件内容：{filename}\n文件类型：{content_type}\n建议转换为支持的格式（.txt, .docx等）。'
-                
-    except Exception as e:
-        print(f"文件内容提取错误: {e}")
-        return f'文件处理失败：{filename}\n错误信息：{str(e)}\n建议检查文件格式或重新上传。'
-
 
 @manager.route("/set", methods=["POST"])  # type: ignore # noqa: F821
 @login_required
@@ -185,58 +69,62 @@ def set_conversation():
         return server_error_response(e)
 
 
+def get_dialog_avatar(dialog_id):
+    """(对话框是否可访问, 对话框图标)：用户所在租户的对话框或共享对话框"""
+    import os
+    tenants = UserTenantService.query(user_id=current_user.id)
+
+    # 检查用户自己的对话框
+    for tenant in tenants:
+        dialog = DialogService.query(tenant_id=tenant.tenant_id, id=dialog_id)
+        if dialog and len(dialog) > 0:
+            return True, dialog[0].icon
+
+    # 如果用户没有，检查共享对话框
+    system_admin_id = os.getenv("SYSTEM_ADMIN_ID", "d807e79c13a44c0391df3750fe82090b")
+    shared_dialog = DialogService.query(tenant_id=system_admin_id, id=dialog_id)
+    if shared_dialog and len(shared_dialog) > 0:
+        return True, shared_dialog[0].icon
+    return False, None
+
+
+def format_reference(ref):
+    """统一 reference 中 chunk 的字段名"""
+    def get_value(d, k1, k2):
+        return d.get(k1, d.get(k2))
+
+    if not isinstance(ref, dict):
+        return ref
+    ref["chunks"] = [
+        {
+            "id": get_value(ck, "chunk_id", "id"),
+            "content": get_value(ck, "content", "content_with_weight"),
+            "document_id": get_value(ck, "doc_id", "document_id"),
+            "document_name": get_value(ck, "docnm_kwd", "document_name"),
+            "dataset_id": get_value(ck, "kb_id", "dataset_id"),
+            "image_id": get_value(ck, "image_id", "img_id"),
+            "similarity": get_value(ck, "similarity", "similarity"),
+            "positions": get_value(ck, "positions", "position_int"),
+        }
+        for ck in ref.get("chunks", [])
+    ]
+    return ref
+
+
 @manager.route("/get", methods=["GET"])  # type: ignore # type: ignore # noqa: F821
 @login_required
 def get():
-    import os
     conv_id = request.args["conversation_id"]
     try:
         e, conv = ConversationService.get_by_id(conv_id)
         if not e:
             return get_data_error_result(message="Conversation not found!")
-        tenants = UserTenantService.query(user_id=current_user.id)
-        avatar = None
-        dialog_found = False
-        
-        # 检查用户自己的对话框
-        for tenant in tenants:
-            dialog = DialogService.query(tenant_id=tenant.tenant_id, id=conv.dialog_id)
-            if dialog and len(dialog) > 0:
-                avatar = dialog[0].icon
-                dialog_found = True
-                break
-        
-        # 如果用户没有，检查共享对话框
-        if not dialog_found:
-            system_admin_id = os.getenv("SYSTEM_ADMIN_ID", "d807e79c13a44c0391df3750fe82090b")
-            shared_dialog = DialogService.query(tenant_id=system_admin_id, id=conv.dialog_id)
-            if shared_dialog and len(shared_dialog) > 0:
-                avatar = shared_dialog[0].icon
-                dialog_found = True
-        
+        dialog_found, avatar = get_dialog_avatar(conv.dialog_id)
         if not dialog_found:
             return get_json_result(data=False, message="Only owner of conversation authorized for this operation.", code=settings.RetCode.OPERATING_ERROR)
 
-
-        def get_value(d, k1, k2):
-            return d.get(k1, d.get(k2))
-
         for ref in conv.reference:
-            if isinstance(ref, list):
-                continue
-            ref["chunks"] = [
-                {
-                    "id": get_value(ck, "chunk_id", "id"),
-                    "content": get_value(ck, "content", "content_with_weight"),
-                    "document_id": get_value(ck, "doc_id", "document_id"),
-                    "document_name": get_value(ck, "docnm_kwd", "document_name"),
-                    "dataset_id": get_value(ck, "kb_id", "dataset_id"),
-                    "image_id": get_value(ck, "image_id", "img_id"),
-                    "similarity": get_value(ck, "similarity", "similarity"),
-                    "positions": get_value(ck, "positions", "position_int"),
-                }
-                for ck in ref.get("chunks", [])
-            ]
+            format_reference(ref)
 
         conv = conv.to_dict()
         conv["avatar"] = avatar
@@ -245,6 +133,29 @@ def get():
         return server_error_response(e)
 
 
+@manager.route("/messages", methods=["GET"])  # type: ignore # noqa: F821
+@login_required
+def messages():
+    """分页读取会话历史，page 1 为最新的 page_size 条消息，按时间顺序返回"""
+    conv_id = request.args["conversation_id"]
+    page_number = int(request.args.get("page", 1))
+    items_per_page = int(request.args.get("page_size", 30))
+    try:
+        e, conv = ConversationService.get_head(conv_id)
+        if not e:
+            return get_data_error_result(message="Conversation not found!")
+        dialog_found, _ = get_dialog_avatar(conv.dialog_id)
+        if not dialog_found:
+            return get_json_result(data=False, message="Only owner of conversation authorized for this operation.", code=settings.RetCode.OPERATING_ERROR)
+        total, msgs = ConversationService.get_messages(conv_id, page_number, items_per_page)
+        for m in msgs:
+            if "reference" in m:
+                format_reference(m["reference"])
+        return get_json_result(data={"total": total, "messages": msgs})
+    except Exception as e:
+        return server_error_response(e)
+
+
 @manager.route("/getsse/<dialog_id>", methods=["GET"])  # type: ignore # noqa: F821
 def getsse(dialog_id):
     token = request.headers.get("Authorization").split()
@@ -319,38 +230,21 @@ def completion():
     msg = []
     temp_file_contents = []  # 存储临时文件内容
     
+    temp_file_ids = []
     for m in req["messages"]:
         if m["role"] == "system":
             continue
         if m["role"] == "assistant" and not msg:
             continue
-        
-        # 处理临时文件
-        if m.get("temp_file_ids"):
-            for file_id in m["temp_file_ids"]:
-                try:
-                    redis_key = f"temp_file:{file_id}"
-                    file_data = REDIS_CONN.get(redis_key)
-                    if file_data:
-                        file_info = json.loads(file_data)
-                        # 验证用户权限
-                        if file_info.get('user_id') == current_user.id:
-                            # 使用新的文件内容提取函数
-                            file_content_bytes = base64.b64decode(file_info['content'])
-                            content = extract_file_content(
-                                file_content_bytes, 
-                                file_info['filename'], 
-                                file_info['content_type']
-                            )
-                            temp_file_contents.append({
-                                'filename': file_info['filename'],
-                                'content': content,
-                                'content_type': file_info['content_type']
-                            })
-                except Exception as e:
-                    print(f"Error processing temp file {file_id}: {e}")
-        
+        temp_file_ids.extend(m.get("temp_file_ids") or [])
         msg.append(m)
+
+    # 处理临时文件：只读取上传时已提取并缓存的文本
+    if temp_file_ids:
+        try:
+            temp_file_contents = get_temp_file_contents(temp_file_ids, current_user.id)
+        except Exception as e:
+            print(f"Error processing temp files {temp_file_ids}: {e}")
     
     # 如果有临时文件内容，将其添加到最后一条用户消息中
     if temp_file_contents and msg:
@@ -368,64 +262,41 @@ def completion():
     
     message_id = msg[-1].get("id")
     try:
-        e, conv = ConversationService.get_by_id(req["conversation_id"])
+        e, conv = ConversationService.get_head(req["conversation_id"])
         if not e:
             return get_data_error_result(message="Conversation not found!")
-        conv.message = deepcopy(req["messages"])
+        # 只保存本轮的提问和回答，历史消息不再整体重写
+        turn_start = len(req["messages"]) - 1
+        conv.message = deepcopy(req["messages"][-1:])
+        conv.reference = [{"chunks": [], "doc_aggs": []}]
         e, dia = DialogService.get_by_id(conv.dialog_id)
         if not e:
             return get_data_error_result(message="Dialog not found!")
         
         # 处理 use_all_kbs 参数：当为 true 时，获取系统中所有知识库
         if req.get("use_all_kbs"):
-            # 直接查询所有有效且有数据的知识库，不限制用户
-            from api.db import StatusEnum
-            all_kbs = KnowledgebaseService.model.select().where(
-                (KnowledgebaseService.model.status == StatusEnum.VALID.value) &
-                (KnowledgebaseService.model.chunk_num > 0)  # 只选择已解析有数据的知识库
-            )
-            kb_ids = [kb.id for kb in all_kbs]
-            req["kb_ids"] = kb_ids
+            # 所有有效且已解析有数据的知识库，不限制用户，经元数据缓存读取
+            req["kb_ids"] = KnowledgebaseService.get_ids_with_chunks()
             del req["use_all_kbs"]
         
         del req["conversation_id"]
         del req["messages"]
 
-        if not conv.reference:
-            conv.reference = []
-        else:
-
-            def get_value(d, k1, k2):
-                return d.get(k1, d.get(k2))
-
-            for ref in conv.reference:
-                if isinstance(ref, list):
-                    continue
-                ref["chunks"] = [
-                    {
-                        "id": get_value(ck, "chunk_id", "id"),
-                        "content": get_value(ck, "content", "content_with_weight"),
-                        "document_id": get_value(ck, "doc_id", "document_id"),
-                        "document_name": get_value(ck, "docnm_kwd", "document_name"),
-                        "dataset_id": get_value(ck, "kb_id", "dataset_id"),
-                        "image_id": get_value(ck, "image_id", "img_id"),
-                        "similarity": get_value(ck, "similarity", "similarity"),
-                        "positions": get_value(ck, "positions", "position_int"),
-                    }
-                    for ck in ref.get("chunks", [])
-                ]
-
-        if not conv.reference:
-            conv.reference = []
-        conv.reference.append({"chunks": [], "doc_aggs": []})
+        # delta_stream: 每个事件只携带新增文本，最后一个事件携带完整回答和引用
+        delta_stream = req.pop("delta_stream", False)
 
         def stream():
             nonlocal dia, msg, req, conv
             try:
-                for ans in chat(dia, msg, True, **req):
-                    ans = structure_answer(conv, ans, message_id, conv.id)
-                    yield "data:" + json.dumps({"code": 0, "message": "", "data": ans}, ensure_ascii=False) + "\n\n"
-                ConversationService.update_by_id(conv.id, conv.to_dict())
+                if delta_stream:
+                    answers = delta_events(chat(dia, msg, True, **req), lambda ans: structure_answer(conv, ans, message_id, conv.id), message_id, conv.id)
+                    for ans in answers:
+                        yield sse(ans)
+                else:
+                    for ans in chat(dia, msg, True, **req):
+                        ans = structure_answer(conv, ans, message_id, conv.id)
+                        yield "data:" + json.dumps({"code": 0, "message": "", "data": ans}, ensure_ascii=False) + "\n\n"
+                ConversationService.append_turn(conv.id, turn_start, conv.message, conv.reference)
             except Exception as e:
                 traceback.print_exc()
                 yield "data:" + json.dumps({"code": 500, "message": str(e), "data": {"answer": "**ERROR**: " + str(e), "reference": []}}, ensure_ascii=False) + "\n\n"
@@ -442,8 +313,8 @@ def completion():
         else:
             answer = None
             for ans in chat(dia, msg, **req):
-                answer = structure_answer(conv, ans, message_id, req["conversation_id"])
-                ConversationService.update_by_id(conv.id, conv.to_dict())
+                answer = structure_answer(conv, ans, message_id, conv.id)
+                ConversationService.append_turn(conv.id, turn_start, conv.message, conv.reference)
                 break
             return get_json_result(data=answer)
     except Exception as e:
@@ -534,9 +405,6 @@ def upload_temp_file():
         if file.filename == '':
             return get_data_error_result(message="未选择文件")
         
-        # 生成唯一的文件ID
-        file_id = str(uuid.uuid4())
-        
         # 读取文件内容
         file_content = file.read()
         
@@ -544,34 +412,11 @@ def upload_temp_file():
         if len(file_content) > 10 * 1024 * 1024:
             return get_data_error_result(message="文件大小不能超过10MB")
         
-        # 对于文本文件，尝试解码内容以验证
-        try:
-            if file.content_type and 'text' in file.content_type:
-                text_content = file_content.decode('utf-8')
-        except Exception as e:
-            pass
-        
-        # 将文件信息存储到Redis
-        file_info = {
-            'id': file_id,
-            'filename': file.filename,
-            'content_type': file.content_type or 'application/octet-stream',
-            'size': len(file_content),
-            'content': base64.b64encode(file_content).decode('utf-8'),
-            'user_id': current_user.id,
-            'conversation_id': request.form.get('conversation_id', ''),
-            'upload_time': time.time()
-        }
-        
-        # 存储到Redis，设置过期时间为1小时
-        redis_key = f"temp_file:{file_id}"
-        success = REDIS_CONN.set(redis_key, json.dumps(file_info, ensure_ascii=False), 3600)
-        
-        if not success:
+        # 原始文件存入对象存储，提取的文本按内容哈希缓存
+        file_info = save_temp_file(file_content, file.filename, file.content_type or 'application/octet-stream', current_user.id, request.form.get('conversation_id', ''))
+        if not file_info:
             return get_data_error_result(message="存储文件失败，请稍后重试")
-        
-        # 验证存储是否成功
-        stored_data = REDIS_CONN.get(redis_key)
+        file_id = file_info['id']
         
         result_data = {
             'file_id': file_id,
@@ -632,14 +477,10 @@ def get_temp_file(file_id):
                 message='Invalid authorization.',
                 code=settings.RetCode.AUTHENTICATION_ERROR
             )
-        redis_key = f"temp_file:{file_id}"
-        file_data = REDIS_CONN.get(redis_key)
-        
-        if not file_data:
+        file_info = get_temp_file_info(file_id)
+        if not file_info:
             return get_data_error_result(message="文件不存在或已过期")
         
-        file_info = json.loads(file_data)
-        
         # 验证用户权限
         if file_info.get('user_id') != current_user.id:
             return get_data_error_result(message="无权访问此文件")
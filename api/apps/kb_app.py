@@ -13,7 +13,6 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 #
-import json
 import os
 
 from flask import request
@@ -31,6 +30,7 @@ from api.db.services.knowledgebase_service import KnowledgebaseService
 from api.db.services.user_service import TenantService, UserTenantService
 from api.utils import get_uuid
 from api.utils.api_utils import get_data_error_result, get_json_result, not_allowed_parameters, server_error_response, validate_request
+from graphrag.utils import load_kb_graph_data
 from rag.nlp import search
 from rag.settings import PAGERANK_FLD
 
@@ -231,23 +231,15 @@ def knowledge_graph(kb_id):
     if not KnowledgebaseService.accessible(kb_id, current_user.id):
         return get_json_result(data=False, message="No authorization.", code=settings.RetCode.AUTHENTICATION_ERROR)
     _, kb = KnowledgebaseService.get_by_id(kb_id)
-    req = {"kb_id": [kb_id], "knowledge_graph_kwd": ["graph"]}
 
     obj = {"graph": {}, "mind_map": {}}
     if not settings.docStoreConn.indexExist(search.index_name(kb.tenant_id), kb_id):
         return get_json_result(data=obj)
-    sres = settings.retrievaler.search(req, search.index_name(kb.tenant_id), [kb_id])
-    if not len(sres.ids):
+    # the last snapshot misses the documents merged since as deltas
+    graph = load_kb_graph_data(kb.tenant_id, kb_id)
+    if graph is None:
         return get_json_result(data=obj)
-
-    for id in sres.ids[:1]:
-        ty = sres.field[id]["knowledge_graph_kwd"]
-        try:
-            content_json = json.loads(sres.field[id]["content_with_weight"])
-        except Exception:
-            continue
-
-        obj[ty] = content_json
+    obj["graph"] = graph
 
     if "nodes" in obj["graph"]:
         obj["graph"]["nodes"] = sorted(obj["graph"]["nodes"], key=lambda x: x.get("pagerank", 0), reverse=True)[:256]
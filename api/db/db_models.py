@@ -937,11 +937,25 @@ class Conversation(DataBaseModel):
     message = JSONField(null=True)
     reference = JSONField(null=True, default=[])
     user_id = CharField(max_length=255, null=True, help_text="user_id", index=True)
+    message_table = BooleanField(null=False, default=False, help_text="message and reference are stored in conversation_message")
 
     class Meta:
         db_table = "conversation"
 
 
+class ConversationMessage(DataBaseModel):
+    id = CharField(max_length=32, primary_key=True)
+    conversation_id = CharField(max_length=32, null=False, index=True)
+    seq = IntegerField(null=False, help_text="position in the conversation")
+    message = JSONField(null=False, default={})
+    ref_idx = IntegerField(null=True, help_text="position of reference in the conversation references")
+    reference = JSONField(null=True, default={})
+
+    class Meta:
+        db_table = "conversation_message"
+        indexes = ((("conversation_id", "seq"), True),)
+
+
 class APIToken(DataBaseModel):
     tenant_id = CharField(max_length=32, null=False, index=True)
     token = CharField(max_length=255, null=False, index=True)
@@ -1132,3 +1146,10 @@ def migrate_db():
             )
         except Exception:
             pass
+        try:
+            migrate(
+                migrator.add_column("conversation", "message_table",
+                                    BooleanField(null=False, default=False, help_text="message and reference are stored in conversation_message"))
+            )
+        except Exception:
+            pass
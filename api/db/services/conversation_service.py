@@ -13,14 +13,17 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 #
+import logging
 import time
+from collections import defaultdict
+from datetime import datetime
 from uuid import uuid4
 from api.db import StatusEnum
-from api.db.db_models import Conversation, DB
+from api.db.db_models import Conversation, ConversationMessage, DB
 from api.db.services.api_service import API4ConversationService
 from api.db.services.common_service import CommonService
 from api.db.services.dialog_service import DialogService, chat
-from api.utils import get_uuid
+from api.utils import current_timestamp, datetime_format, get_uuid
 import json
 
 from rag.prompts import chunks_format
@@ -46,7 +49,195 @@ class ConversationService(CommonService):
 
         sessions = sessions.paginate(page_number, items_per_page)
 
-        return list(sessions.dicts())
+        sessions = list(sessions.dicts())
+        cls._load_messages(sessions)
+        return sessions
+
+    # Conversations migrated to the conversation_message table (message_table) keep one row per
+    # message, the reference of a turn being stored on its row. Readers below rebuild the
+    # `message`/`reference` lists, writers only touch the rows that changed. Conversations are
+    # migrated from the JSON blob on their first append_turn.
+
+    @classmethod
+    @DB.connection_context()
+    def query(cls, cols=None, reverse=None, order_by=None, **kwargs):
+        convs = list(super().query(cols=cols, reverse=reverse, order_by=order_by, **kwargs))
+        cls._load_messages(convs)
+        return convs
+
+    @classmethod
+    @DB.connection_context()
+    def get_by_id(cls, pid):
+        e, conv = super().get_by_id(pid)
+        if e:
+            cls._load_messages([conv])
+        return e, conv
+
+    @classmethod
+    @DB.connection_context()
+    def get_head(cls, pid):
+        """The conversation without its messages and references."""
+        fields = [f for f in cls.model._meta.sorted_fields if f.name not in ("message", "reference")]
+        conv = cls.model.select(*fields).where(cls.model.id == pid).first()
+        return conv is not None, conv
+
+    @classmethod
+    @DB.connection_context()
+    def update_by_id(cls, pid, data):
+        # Only _migrate sets message_table: a caller writing back a conversation it loaded before
+        # a concurrent migration would otherwise revert it.
+        data = dict(data)
+        data.pop("message_table", None)
+        if "message" in data or "reference" in data:
+            head = cls.model.select(cls.model.message_table).where(cls.model.id == pid).first()
+            if head and head.message_table:
+                with DB.atomic():
+                    cls._sync_messages(pid, data.pop("message", None), data.pop("reference", None))
+                    return super().update_by_id(pid, data)
+        return super().update_by_id(pid, data)
+
+    @classmethod
+    @DB.connection_context()
+    def delete_by_id(cls, pid):
+        with DB.atomic():
+            ConversationMessage.delete().where(ConversationMessage.conversation_id == pid).execute()
+            return super().delete_by_id(pid)
+
+    @classmethod
+    @DB.connection_context()
+    def append_turn(cls, pid, start, messages, references):
+        """
+        Store the messages of a turn at positions start, start + 1, ... and their references,
+        dropping whatever followed position `start` before (a regenerated answer). Only these rows
+        are written, the conversation is migrated from its JSON blob first if needed.
+        """
+        with DB.atomic():
+            if not cls._migrated(pid):
+                e, conv = super().get_by_id(pid)
+                if e:
+                    cls._migrate(conv)
+            M = ConversationMessage
+            M.delete().where((M.conversation_id == pid) & (M.seq >= start)).execute()
+            last = M.select(M.ref_idx).where((M.conversation_id == pid) & (M.seq < start) & M.ref_idx.is_null(False)).order_by(M.ref_idx.desc()).first()
+            rows = cls._rows(pid, messages, references, start, last.ref_idx + 1 if last else 0)
+            if rows:
+                M.insert_many(rows).execute()
+            super().update_by_id(pid, {})
+
+    @classmethod
+    @DB.connection_context()
+    def get_messages(cls, pid, page_number=1, items_per_page=30):
+        """
+        (total, messages) of page `page_number`, pages being counted from the latest message and
+        returned in chronological order. Messages carrying a reference have it under "reference".
+        """
+        st = max(0, page_number - 1) * items_per_page
+        if not cls._migrated(pid):
+            e, conv = super().get_by_id(pid)
+            if not e:
+                return 0, []
+            rows = cls._rows(pid, conv.message or [], conv.reference or [])
+            total = len(rows)
+            rows = rows[max(0, total - st - items_per_page): max(0, total - st)]
+        else:
+            M = ConversationMessage
+            total = M.select().where(M.conversation_id == pid).count()
+            rows = list(M.select().where(M.conversation_id == pid).order_by(M.seq.desc()).offset(st).limit(items_per_page).dicts())[::-1]
+        messages = []
+        for r in rows:
+            m = dict(r["message"])
+            if r["ref_idx"] is not None:
+                m["reference"] = r["reference"]
+            messages.append(m)
+        return total, messages
+
+    @classmethod
+    def _migrated(cls, pid):
+        head = cls.model.select(cls.model.message_table).where(cls.model.id == pid).first()
+        return bool(head and head.message_table)
+
+    @classmethod
+    def _migrate(cls, conv):
+        # flag first: a concurrent migration of the same conversation finds nothing to do
+        if not cls.model.update(message_table=True, message=[], reference=[]).where((cls.model.id == conv.id) & (cls.model.message_table == False)).execute():  # noqa: E712
+            return
+        rows = cls._rows(conv.id, conv.message or [], conv.reference or [])
+        for i in range(0, len(rows), 100):
+            ConversationMessage.insert_many(rows[i: i + 100]).execute()
+        logging.info(f"Conversation {conv.id} migrated to conversation_message, {len(rows)} messages")
+
+    @staticmethod
+    def _rows(pid, messages, references, start=0, ref_start=0):
+        """
+        Rows of `messages`, references attached to the last assistant messages (a turn appends one
+        assistant message and one reference), any extra one to the earliest rows without one.
+        """
+        ref_of = {}
+        assistants = [i for i, m in enumerate(messages) if m.get("role") == "assistant"]
+        for i, r in zip(reversed(assistants), range(len(references) - 1, -1, -1)):
+            ref_of[i] = r
+        extra = len(references) - len(ref_of)
+        if extra > 0:
+            free = [i for i in range(len(messages)) if i not in ref_of]
+            for i, r in zip(free, range(extra)):
+                ref_of[i] = r
+            if extra > len(free):
+                logging.warning(f"Conversation {pid}: {extra - len(free)} references without a message are dropped")
+        rows = []
+        for i, m in enumerate(messages):
+            r = ref_of.get(i)
+            rows.append({
+                "id": get_uuid(),
+                "conversation_id": pid,
+                "seq": start + i,
+                "message": m,
+                "ref_idx": None if r is None else ref_start + r,
+                "reference": None if r is None else references[r],
+                "create_time": current_timestamp(),
+                "create_date": datetime_format(datetime.now()),
+            })
+        return rows
+
+    @classmethod
+    def _sync_messages(cls, pid, messages=None, references=None):
+        M = ConversationMessage
+        current = list(M.select().where(M.conversation_id == pid).order_by(M.seq).dicts())
+        if messages is None:
+            messages = [r["message"] for r in current]
+        if references is None:
+            references = [r["reference"] for r in sorted(current, key=lambda r: r["ref_idx"] if r["ref_idx"] is not None else -1) if r["ref_idx"] is not None]
+        rows = cls._rows(pid, messages, references)
+        for old, new in zip(current, rows):
+            if (old["message"], old["ref_idx"], old["reference"] if old["ref_idx"] is not None else None) != (new["message"], new["ref_idx"], new["reference"]):
+                M.update(message=new["message"], ref_idx=new["ref_idx"], reference=new["reference"]).where(M.id == old["id"]).execute()
+        if len(rows) > len(current):
+            M.insert_many(rows[len(current):]).execute()
+        elif len(rows) < len(current):
+            M.delete().where((M.conversation_id == pid) & (M.seq >= len(rows))).execute()
+
+    @classmethod
+    def _load_messages(cls, convs):
+        """Fill `message`/`reference` of the migrated conversations (models or dicts) with one query."""
+        def get(c, k):
+            return c.get(k) if isinstance(c, dict) else getattr(c, k, None)
+
+        ids = [get(c, "id") for c in convs if get(c, "message_table")]
+        if not ids:
+            return
+        rows = defaultdict(list)
+        M = ConversationMessage
+        for r in M.select().where(M.conversation_id.in_(ids)).order_by(M.seq).dicts():
+            rows[r["conversation_id"]].append(r)
+        for c in convs:
+            if not get(c, "message_table"):
+                continue
+            rs = rows.get(get(c, "id"), [])
+            message = [r["message"] for r in rs]
+            reference = [r["reference"] for r in sorted((r for r in rs if r["ref_idx"] is not None), key=lambda r: r["ref_idx"])]
+            if isinstance(c, dict):
+                c["message"], c["reference"] = message, reference
+            else:
+                c.message, c.reference = message, reference
 
 
 def structure_answer(conv, ans, message_id, session_id):
@@ -22,15 +22,16 @@ from timeit import default_timer as timer
 
 from api import settings
 from api.db import LLMType, ParserType, StatusEnum
-from api.db.db_models import DB, Dialog
+from api.db.db_models import DB, ConversationMessage, Dialog
 from api.db.services.common_service import CommonService
 from api.db.services.knowledgebase_service import KnowledgebaseService
 from api.db.services.llm_service import LLMBundle, TenantLLMService
+from api.utils.chat_trace import ChatTrace
 from rag.app.resume import forbidden_select_fields4resume
 from rag.app.tag import label_question
 from rag.nlp.search import index_name
 from rag.prompts import chunks_format, citation_prompt, kb_prompt, keyword_extraction, llm_id2llm_type, message_fit_in
-from rag.utils import num_tokens_from_string, rmSpace
+from rag.utils import approx_num_tokens, rmSpace
 
 from .database import MINIO_CONFIG
 
@@ -62,6 +63,8 @@ class DialogService(CommonService):
         try:
             from api.db.services.conversation_service import ConversationService
             with DB.atomic(): 
+                conv_ids = ConversationService.model.select(ConversationService.model.id).where(ConversationService.model.dialog_id == pid)
+                ConversationMessage.delete().where(ConversationMessage.conversation_id.in_(conv_ids)).execute()
                 ConversationService.model.delete().where(ConversationService.model.dialog_id == pid).execute()
                 dialog_deleted = cls.model.delete().where(cls.model.id == pid).execute()
                 return dialog_deleted > 0
@@ -95,7 +98,7 @@ def chat_solo(dialog, messages, stream=True, llm_id=None):
         for ans in chat_mdl.chat_streamly(prompt_config.get("system", ""), msg, dialog.llm_setting):
             answer = ans
             delta_ans = ans[len(last_ans) :]
-            if num_tokens_from_string(delta_ans) < 16:
+            if approx_num_tokens(delta_ans) < 16:
                 continue
             last_ans = answer
             yield {"answer": answer, "reference": {}, "audio_binary": tts(tts_mdl, delta_ans), "prompt": "", "created_at": time.time()}
@@ -124,6 +127,7 @@ def chat(dialog, messages, stream=True, **kwargs):
         return
 
     chat_start_ts = timer()
+    trace = ChatTrace(dialog.tenant_id, dialog.id)
 
     if llm_id2llm_type(llm_id) == "image2text":
         llm_model_config = TenantLLMService.get_model_config(dialog.tenant_id, LLMType.IMAGE2TEXT, llm_id)
@@ -134,7 +138,7 @@ def chat(dialog, messages, stream=True, **kwargs):
 
     check_llm_ts = timer()
 
-    kbs = KnowledgebaseService.get_by_ids(kb_ids)
+    kbs = KnowledgebaseService.get_by_ids_cached(kb_ids)
     embedding_list = list(set([kb.embd_id for kb in kbs]))
     if len(embedding_list) != 1:
         yield {"answer": "**ERROR**: Knowledge bases use different embedding models.", "reference": []}
@@ -198,6 +202,7 @@ def chat(dialog, messages, stream=True, **kwargs):
         rerank_mdl = LLMBundle(dialog.tenant_id, LLMType.RERANK, dialog.rerank_id)
 
     bind_reranker_ts = timer()
+    trace.add("model_binding", (bind_llm_ts - create_retriever_ts) + (bind_reranker_ts - refine_question_ts))
     generate_keyword_ts = bind_reranker_ts
     thought = ""
     kbinfos = {"total": 0, "chunks": [], "doc_aggs": []}
@@ -208,32 +213,37 @@ def chat(dialog, messages, stream=True, **kwargs):
         if prompt_config.get("keyword", False):
             questions[-1] += keyword_extraction(chat_mdl, questions[-1])
             generate_keyword_ts = timer()
+            trace.add("keyword_extraction", generate_keyword_ts - bind_reranker_ts)
 
         tenant_ids = list(set([kb.tenant_id for kb in kbs]))
 
         knowledges = []
 
-        kbinfos = retriever.retrieval(
-            " ".join(questions),
-            embd_mdl,
-            tenant_ids,
-            kb_ids,
-            1,
-            dialog.top_n,
-            dialog.similarity_threshold,
-            dialog.vector_similarity_weight,
-            doc_ids=attachments,
-            top=dialog.top_k,
-            aggs=False,
-            rerank_mdl=rerank_mdl,
-            rank_feature=label_question(" ".join(questions), kbs),
-        )
+        # 检索内部的查询分析、向量化、ES 检索与重排序各自记录到 trace
+        with trace.activate():
+            kbinfos = retriever.retrieval(
+                " ".join(questions),
+                embd_mdl,
+                tenant_ids,
+                kb_ids,
+                1,
+                dialog.top_n,
+                dialog.similarity_threshold,
+                dialog.vector_similarity_weight,
+                doc_ids=attachments,
+                top=dialog.top_k,
+                aggs=False,
+                rerank_mdl=rerank_mdl,
+                rank_feature=label_question(" ".join(questions), kbs),
+            )
         knowledges = kb_prompt(kbinfos, max_tokens)
 
     logging.debug("{}->{}".format(" ".join(questions), "\n->".join(knowledges)))
 
     retrieval_ts = timer()
+    trace.add("retrieval", retrieval_ts - generate_keyword_ts)
     if not knowledges and prompt_config.get("empty_response"):
+        trace.finish()
         empty_res = prompt_config["empty_response"]
         yield {"answer": empty_res, "reference": kbinfos, "prompt": "\n\n### Query:\n%s" % " ".join(questions), "audio_binary": tts(tts_mdl, empty_res)}
         return {"answer": prompt_config["empty_response"], "reference": kbinfos}
@@ -253,6 +263,7 @@ def chat(dialog, messages, stream=True, **kwargs):
 
     if "max_tokens" in gen_conf:
         gen_conf["max_tokens"] = min(gen_conf["max_tokens"], max_tokens - used_token_count)
+    trace.since("prompt_assembly", retrieval_ts)
 
     def decorate_answer(answer):
         nonlocal prompt_config, knowledges, kwargs, kbinfos, prompt, retrieval_ts, questions
@@ -271,14 +282,15 @@ def chat(dialog, messages, stream=True, **kwargs):
         if knowledges and (prompt_config.get("quote", True) and kwargs.get("quote", True)):
             # 获取引用的 chunk 索引
             if not re.search(r"##[0-9]+\$\$", answer):
-                answer, idx = retriever.insert_citations(
-                    answer,
-                    [ck["content_ltks"] for ck in kbinfos["chunks"]],
-                    [ck["vector"] for ck in kbinfos["chunks"]],
-                    embd_mdl,
-                    tkweight=1 - dialog.vector_similarity_weight,
-                    vtweight=dialog.vector_similarity_weight,
-                )
+                with trace.span("citation_insertion"):
+                    answer, idx = retriever.insert_citations(
+                        answer,
+                        [ck["content_ltks"] for ck in kbinfos["chunks"]],
+                        [ck["vector"] for ck in kbinfos["chunks"]],
+                        embd_mdl,
+                        tkweight=1 - dialog.vector_similarity_weight,
+                        vtweight=dialog.vector_similarity_weight,
+                    )
                 cited_chunk_indices = idx
             else:
                 for r in re.finditer(r"##([0-9]+)\$\$", answer):
@@ -319,10 +331,8 @@ def chat(dialog, messages, stream=True, **kwargs):
                 recall_docs = kbinfos["doc_aggs"]
             kbinfos["doc_aggs"] = recall_docs
 
-            refs = deepcopy(kbinfos)
-            for c in refs["chunks"]:
-                if c.get("vector"):
-                    del c["vector"]
+            # 向量只用于插入引用，拷贝引用信息时直接跳过
+            refs = deepcopy({**kbinfos, "chunks": [{k: v for k, v in c.items() if k != "vector"} for c in kbinfos["chunks"]]})
 
         # 特殊错误提示
         if "invalid key" in answer.lower() or "invalid api" in answer.lower():
@@ -330,6 +340,7 @@ def chat(dialog, messages, stream=True, **kwargs):
 
         # 时间信息拼接
         finish_chat_ts = timer()
+        trace.finish()
         total_time_cost = (finish_chat_ts - chat_start_ts) * 1000
         check_llm_time_cost = (check_llm_ts - chat_start_ts) * 1000
         create_retriever_time_cost = (create_retriever_ts - check_llm_ts) * 1000
@@ -349,7 +360,10 @@ def chat(dialog, messages, stream=True, **kwargs):
     if stream:
         last_ans = ""  # 记录上一次返回的完整回答
         answer = ""  # 当前累计的完整回答
+        generate_start_ts = timer()
         for ans in chat_mdl.chat_streamly(prompt + prompt4citation, msg[1:], gen_conf):
+            if "time_to_first_token" not in trace.spans:
+                trace.since("time_to_first_token", generate_start_ts)
             # 如果存在思考过程(thought)，移除相关标记
             if thought:
                 ans = re.sub(r"<think>.*</think>", "", ans, flags=re.DOTALL)
@@ -357,17 +371,19 @@ def chat(dialog, messages, stream=True, **kwargs):
             # 计算新增的文本片段(delta)
             delta_ans = ans[len(last_ans) :]
             # 如果新增token太少(小于16)，跳过本次返回(避免频繁发送小片段)
-            if num_tokens_from_string(delta_ans) < 16:
+            if approx_num_tokens(delta_ans) < 16:
                 continue
             last_ans = answer
             # 返回当前累计回答(包含思考过程)+新增片段)
             yield {"answer": thought + answer, "reference": {}, "audio_binary": tts(tts_mdl, delta_ans)}
+        trace.since("generation", generate_start_ts)
         delta_ans = answer[len(last_ans) :]
         if delta_ans:
             yield {"answer": thought + answer, "reference": {}, "audio_binary": tts(tts_mdl, delta_ans)}
         yield decorate_answer(thought + answer)
     else:
-        answer = chat_mdl.chat(prompt + prompt4citation, msg[1:], gen_conf)
+        with trace.span("generation"):
+            answer = chat_mdl.chat(prompt + prompt4citation, msg[1:], gen_conf)
         user_content = msg[-1].get("content", "[content not available]")
         logging.debug("User: {}|Assistant: {}".format(user_content, answer))
         res = decorate_answer(answer)
@@ -521,7 +537,7 @@ def ask(question, kb_ids, tenant_id):
         generator: 生成器对象，产生包含回答和引用信息的字典
     """
 
-    kbs = KnowledgebaseService.get_by_ids(kb_ids)
+    kbs = KnowledgebaseService.get_by_ids_cached(kb_ids)
     embedding_list = list(set([kb.embd_id for kb in kbs]))
 
     is_knowledge_graph = all([kb.parser_id == ParserType.KG for kb in kbs])
@@ -567,10 +583,7 @@ def ask(question, kb_ids, tenant_id):
         if not recall_docs:
             recall_docs = kbinfos["doc_aggs"]
         kbinfos["doc_aggs"] = recall_docs
-        refs = deepcopy(kbinfos)
-        for c in refs["chunks"]:
-            if c.get("vector"):
-                del c["vector"]
+        refs = deepcopy({**kbinfos, "chunks": [{k: v for k, v in c.items() if k != "vector"} for c in kbinfos["chunks"]]})
 
         if answer.lower().find("invalid key") >= 0 or answer.lower().find("invalid api") >= 0:
             answer += " Please set LLM API-Key in 'User Setting -> Model Providers -> API-Key'"
@@ -40,6 +40,7 @@ from api.db.services.common_service import CommonService
 from api.db.services.knowledgebase_service import KnowledgebaseService
 from api.db import StatusEnum
 from rag.utils.redis_conn import REDIS_CONN
+from graphrag.utils import invalidate_graph
 
 
 class DocumentService(CommonService):
@@ -98,17 +99,19 @@ class DocumentService(CommonService):
         try:
             settings.docStoreConn.delete({"doc_id": doc.id}, search.index_name(tenant_id), doc.kb_id)
             settings.docStoreConn.update(
-                {"kb_id": doc.kb_id, "knowledge_graph_kwd": ["entity", "relation", "graph", "community_report"], "source_id": doc.id},
+                {"kb_id": doc.kb_id, "knowledge_graph_kwd": ["entity", "relation", "graph", "subgraph", "community_report"], "source_id": doc.id},
                 {"remove": {"source_id": doc.id}},
                 search.index_name(tenant_id),
                 doc.kb_id,
             )
             settings.docStoreConn.update({"kb_id": doc.kb_id, "knowledge_graph_kwd": ["graph"]}, {"removed_kwd": "Y"}, search.index_name(tenant_id), doc.kb_id)
             settings.docStoreConn.delete(
-                {"kb_id": doc.kb_id, "knowledge_graph_kwd": ["entity", "relation", "graph", "community_report"], "must_not": {"exists": "source_id"}}, search.index_name(tenant_id), doc.kb_id
+                {"kb_id": doc.kb_id, "knowledge_graph_kwd": ["entity", "relation", "graph", "subgraph", "community_report"], "must_not": {"exists": "source_id"}}, search.index_name(tenant_id), doc.kb_id
             )
         except Exception:
             pass
+        # the graphs cached by the task executors still hold this document
+        invalidate_graph(doc.kb_id)
         return cls.delete_by_id(doc.id)
 
     @classmethod
@@ -16,9 +16,11 @@
 from api.db import StatusEnum, TenantPermission
 from api.db.db_models import Knowledgebase, DB, Tenant, User, UserTenant,Document
 from api.db.services.common_service import CommonService
+from rag.utils.metadata_cache import METADATA_CACHE, bumps_metadata_version
 from peewee import fn
 
 
+@bumps_metadata_version
 class KnowledgebaseService(CommonService):
     model = Knowledgebase
 
@@ -183,14 +185,34 @@ class KnowledgebaseService(CommonService):
         cls.update_by_id(id, {"parser_config": m.parser_config})
 
     @classmethod
-    @DB.connection_context()
     def get_field_map(cls, ids):
+        return METADATA_CACHE.get(("field_map", tuple(sorted(ids))), lambda: cls._get_field_map(ids))
+
+    @classmethod
+    @DB.connection_context()
+    def _get_field_map(cls, ids):
         conf = {}
         for k in cls.get_by_ids(ids):
             if k.parser_config and "field_map" in k.parser_config:
                 conf.update(k.parser_config["field_map"])
         return conf
 
+    @classmethod
+    def get_by_ids_cached(cls, kb_ids):
+        """get_by_ids through the metadata cache, for the chat path."""
+        return METADATA_CACHE.get(("kbs", tuple(sorted(set(kb_ids)))), lambda: list(cls.get_by_ids(kb_ids)))
+
+    @classmethod
+    def get_ids_with_chunks(cls):
+        """Ids of the valid knowledge bases holding chunks, through the metadata cache."""
+        return METADATA_CACHE.get(("kb_ids_with_chunks",), cls._get_ids_with_chunks)
+
+    @classmethod
+    @DB.connection_context()
+    def _get_ids_with_chunks(cls):
+        kbs = cls.model.select(cls.model.id).where((cls.model.status == StatusEnum.VALID.value) & (cls.model.chunk_num > 0))
+        return [kb.id for kb in kbs]
+
     @classmethod
     @DB.connection_context()
     def get_by_name(cls, kb_name, tenant_id):
@@ -24,6 +24,8 @@ from api.db import LLMType
 from api.db.db_models import DB
 from api.db.db_models import LLMFactories, LLM, TenantLLM
 from api.db.services.common_service import CommonService
+from rag.utils.embedding_cache import EMBEDDING_CACHE
+from rag.utils.metadata_cache import METADATA_CACHE, bumps_metadata_version
 
 
 class LLMFactoriesService(CommonService):
@@ -34,6 +36,7 @@ class LLMService(CommonService):
     model = LLM
 
 
+@bumps_metadata_version
 class TenantLLMService(CommonService):
     model = TenantLLM
 
@@ -87,8 +90,13 @@ class TenantLLMService(CommonService):
         return model_name, None
 
     @classmethod
-    @DB.connection_context()
     def get_model_config(cls, tenant_id, llm_type, llm_name=None):
+        key = ("model_config", tenant_id, getattr(llm_type, "value", llm_type), llm_name)
+        return METADATA_CACHE.get(key, lambda: cls._get_model_config(tenant_id, llm_type, llm_name))
+
+    @classmethod
+    @DB.connection_context()
+    def _get_model_config(cls, tenant_id, llm_type, llm_name=None):
         e, tenant = TenantService.get_by_id(tenant_id)
         if not e:
             raise LookupError("Tenant not found")
@@ -133,7 +141,11 @@ class TenantLLMService(CommonService):
         if llm_type == LLMType.EMBEDDING.value:
             if model_config["llm_factory"] not in EmbeddingModel:
                 return
-            return EmbeddingModel[model_config["llm_factory"]](model_config["api_key"], model_config["llm_name"], base_url=model_config["api_base"])
+            mdl = EmbeddingModel[model_config["llm_factory"]](model_config["api_key"], model_config["llm_name"], base_url=model_config["api_base"])
+            # the input limit of this very model, when it is below the one of its provider
+            if model_config.get("max_tokens"):
+                mdl.max_tokens = min(mdl.max_tokens, int(model_config["max_tokens"]))
+            return mdl
 
         if llm_type == LLMType.RERANK:
             if model_config["llm_factory"] not in RerankModel:
@@ -166,7 +178,7 @@ class TenantLLMService(CommonService):
     @classmethod
     @DB.connection_context()
     def increase_usage(cls, tenant_id, llm_type, used_tokens, llm_name=None):
-        e, tenant = TenantService.get_by_id(tenant_id)
+        e, tenant = TenantService.get_by_id_cached(tenant_id)
         if not e:
             logging.error(f"Tenant not found: {tenant_id}")
             return 0
@@ -215,18 +227,26 @@ class LLMBundle:
         assert self.mdl, "Can't find model for {}/{}/{}".format(tenant_id, llm_type, llm_name)
         model_config = TenantLLMService.get_model_config(tenant_id, llm_type, llm_name)
         self.max_length = model_config.get("max_tokens", 8192)
+        # Identifies the embedding space: the same model served by another endpoint may differ.
+        self.embd_cache_key = "{}/{}@{}".format(model_config.get("llm_factory", ""), model_config.get("llm_name", ""), model_config.get("api_base", ""))
 
     def encode(self, texts: list):
-        embeddings, used_tokens = self.mdl.encode(texts)
-        if not TenantLLMService.increase_usage(self.tenant_id, self.llm_type, used_tokens):
-            logging.error("LLMBundle.encode can't update token usage for {}/EMBEDDING used_tokens: {}".format(self.tenant_id, used_tokens))
+        # Chunk and document stats count every text, only the texts actually embedded are billed.
+        embeddings, used_tokens, billed_tokens = EMBEDDING_CACHE.encode(self.embd_cache_key, texts, self.mdl.encode)
+        if billed_tokens and not TenantLLMService.increase_usage(self.tenant_id, self.llm_type, billed_tokens):
+            logging.error("LLMBundle.encode can't update token usage for {}/EMBEDDING used_tokens: {}".format(self.tenant_id, billed_tokens))
         return embeddings, used_tokens
 
     def encode_queries(self, query: str):
-        emd, used_tokens = self.mdl.encode_queries(query)
-        if not TenantLLMService.increase_usage(self.tenant_id, self.llm_type, used_tokens):
-            logging.error("LLMBundle.encode_queries can't update token usage for {}/EMBEDDING used_tokens: {}".format(self.tenant_id, used_tokens))
-        return emd, used_tokens
+        def encode_query(texts):
+            emd, used_tokens = self.mdl.encode_queries(texts[0])
+            return [emd], used_tokens
+
+        # Query vectors may carry a search instruction, so they live apart from document vectors.
+        emd, used_tokens, billed_tokens = EMBEDDING_CACHE.encode(self.embd_cache_key + ":query", [query], encode_query)
+        if billed_tokens and not TenantLLMService.increase_usage(self.tenant_id, self.llm_type, billed_tokens):
+            logging.error("LLMBundle.encode_queries can't update token usage for {}/EMBEDDING used_tokens: {}".format(self.tenant_id, billed_tokens))
+        return emd[0], used_tokens
 
     def similarity(self, query: str, texts: list):
         sim, used_tokens = self.mdl.similarity(query, texts)
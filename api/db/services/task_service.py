@@ -19,7 +19,7 @@ import xxhash
 from datetime import datetime
 
 from api.db.db_utils import bulk_insert_into_db
-from peewee import JOIN
+from peewee import JOIN, Case
 from api.db.db_models import DB, File2Document, File
 from api.db import StatusEnum, FileType, TaskStatus
 from api.db.db_models import Task, Document, Knowledgebase, Tenant
@@ -47,9 +47,8 @@ class TaskService(CommonService):
     model = Task
 
     @classmethod
-    @DB.connection_context()
-    def get_task(cls, task_id):
-        fields = [
+    def _task_fields(cls):
+        return [
             cls.model.id,
             cls.model.doc_id,
             cls.model.from_page,
@@ -72,13 +71,20 @@ class TaskService(CommonService):
             Tenant.llm_id,
             cls.model.update_time,
         ]
-        docs = (
+
+    @classmethod
+    def _select_tasks(cls, fields):
+        return (
             cls.model.select(*fields)
             .join(Document, on=(cls.model.doc_id == Document.id))
             .join(Knowledgebase, on=(Document.kb_id == Knowledgebase.id))
             .join(Tenant, on=(Knowledgebase.tenant_id == Tenant.id))
-            .where(cls.model.id == task_id)
         )
+
+    @classmethod
+    @DB.connection_context()
+    def get_task(cls, task_id):
+        docs = cls._select_tasks(cls._task_fields()).where(cls.model.id == task_id)
         docs = list(docs.dicts())
         if not docs:
             return None
@@ -100,6 +106,47 @@ class TaskService(CommonService):
 
         return docs[0]
 
+    @classmethod
+    @DB.connection_context()
+    def get_task_batch(cls, task_ids: list[str]) -> dict:
+        """
+        Batched get_task for a consumer that claims several messages at once: one select
+        for the tasks with their document state and one update for the abandoned ones.
+        Returns {task_id: task} of the tasks to run; cancelled tasks are returned with
+        "canceled" set so that the caller can acknowledge them. A task is only marked as
+        received, which counts a retry, by mark_received once it actually starts.
+        """
+        if not task_ids:
+            return {}
+        fields = cls._task_fields() + [Document.run.alias("doc_run"), Document.progress.alias("doc_progress")]
+        tasks = list(cls._select_tasks(fields).where(cls.model.id.in_(task_ids)).dicts())
+
+        abandoned = [t["id"] for t in tasks if t["retry_count"] >= 3]
+        if abandoned:
+            cls.model.update(
+                progress_msg=cls.model.progress_msg + "\nERROR: Task is abandoned after 3 times attempts.",
+                progress=-1,
+                retry_count=cls.model.retry_count + 1,
+            ).where(cls.model.id.in_(abandoned)).execute()
+
+        res = {}
+        for t in tasks:
+            if t["retry_count"] >= 3:
+                continue
+            run, progress = t.pop("doc_run"), t.pop("doc_progress")
+            t["canceled"] = run == TaskStatus.CANCEL.value or progress < 0
+            res[t["id"]] = t
+        return res
+
+    @classmethod
+    @DB.connection_context()
+    def mark_received(cls, task_id):
+        return cls.model.update(
+            progress_msg=cls.model.progress_msg + f"\n{datetime.now().strftime('%H:%M:%S')} Task has been received.",
+            progress=random.random() / 10.0,
+            retry_count=cls.model.retry_count + 1,
+        ).where(cls.model.id == task_id).execute()
+
     @classmethod
     @DB.connection_context()
     def get_tasks(cls, doc_id: str):
@@ -189,6 +236,37 @@ class TaskService(CommonService):
             if "progress" in info:
                 cls.model.update(progress=info["progress"]).where(cls.model.id == id).execute()
 
+    @classmethod
+    @DB.connection_context()
+    def update_progress_batch(cls, infos: dict):
+        """
+        update_progress for many tasks at once: {task_id: {"progress_msg": msg, "progress": prog}}
+        is written with one select of the current messages and one UPDATE.
+        """
+        if not infos:
+            return
+
+        def update():
+            msgs = {}
+            with_msg = [id for id, info in infos.items() if info.get("progress_msg")]
+            if with_msg:
+                for task in cls.model.select(cls.model.id, cls.model.progress_msg).where(cls.model.id.in_(with_msg)):
+                    msgs[task.id] = trim_header_by_lines(task.progress_msg + "\n" + infos[task.id]["progress_msg"], 3000)
+            progs = {id: info["progress"] for id, info in infos.items() if "progress" in info}
+            fields = {}
+            if msgs:
+                fields["progress_msg"] = Case(cls.model.id, list(msgs.items()), cls.model.progress_msg)
+            if progs:
+                fields["progress"] = Case(cls.model.id, list(progs.items()), cls.model.progress)
+            if fields:
+                cls.model.update(**fields).where(cls.model.id.in_(list(set(msgs) | set(progs)))).execute()
+
+        if os.environ.get("MACOS"):
+            update()
+            return
+        with DB.lock("update_progress", -1):
+            update()
+
 
 def queue_tasks(doc: dict, bucket: str, name: str):
     """
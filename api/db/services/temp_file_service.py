@@ -0,0 +1,278 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""
+聊天临时附件：原始文件按内容哈希存入对象存储，提取出的文本按内容哈希、文件名和类型缓存在 Redis，
+问答时只读取缓存的文本，不再解码和重复解析文件。对象存储中的文件在最后一次上传 TEMP_FILE_TTL 之后删除。
+"""
+import base64
+import hashlib
+import io
+import json
+import logging
+import os
+import time
+import uuid
+
+from rag.utils import approx_num_tokens, truncate
+from rag.utils.redis_conn import REDIS_CONN, RedisDistributedLock
+from rag.utils.storage_factory import STORAGE_IMPL
+
+TEMP_FILE_BUCKET = os.environ.get("TEMP_FILE_BUCKET", "tempfiles")
+# 有序集合：对象存储中的文件哈希 -> 过期时间
+TEMP_FILE_EXPIRY_KEY = "temp_file_expiry"
+TEMP_FILE_TTL = int(os.environ.get("TEMP_FILE_TTL", "3600"))
+TEMP_FILE_TEXT_TTL = int(os.environ.get("TEMP_FILE_TEXT_TTL", "86400"))
+# 每次问答附件文本的 token 上限，超出部分截断，优先保留最新的附件
+TEMP_FILE_TOKEN_BUDGET = int(os.environ.get("TEMP_FILE_TOKEN_BUDGET", "16384"))
+
+try:
+    from docx import Document
+    DOCX_AVAILABLE = True
+except ImportError:
+    DOCX_AVAILABLE = False
+
+try:
+    import olefile
+    from docx2txt import process as docx2txt_process
+    DOC_AVAILABLE = True
+except ImportError:
+    DOC_AVAILABLE = False
+
+
+def extract_file_content(file_content_bytes, filename, content_type):
+    """
+    根据文件类型提取文件内容
+    
+    Args:
+        file_content_bytes: 文件的二进制内容
+        filename: 文件名
+        content_type: MIME类型
+    
+    Returns:
+        str: 提取的文本内容
+    """
+    try:
+        # 获取文件扩展名
+        file_ext = filename.lower().split('.')[-1] if '.' in filename else ''
+        
+        # 处理旧版Word文档(.doc)
+        if file_ext == 'doc':
+            try:
+                # 对于.doc文件，由于格式复杂，我们提供一个友好的提示
+                return f'检测到旧版Word文档(.doc格式)：{filename}\n\n由于.doc格式的复杂性，建议您：\n1. 将文件另存为.docx格式后重新上传\n2. 或者复制文档内容直接粘贴到聊天框中\n\n这样可以确保内容被正确解析和处理。'
+            except Exception as e:
+                print(f".doc文件处理错误: {e}")
+                return f'无法处理.doc格式文件：{filename}\n建议转换为.docx格式或直接粘贴文本内容。'
+        
+        # 处理新版Word文档(.docx)
+        elif file_ext == 'docx' or 'word' in content_type.lower():
+            if DOCX_AVAILABLE:
+                try:
+                    # 使用python-docx处理Word文档
+                    doc_stream = io.BytesIO(file_content_bytes)
+                    doc = Document(doc_stream)
+                    
+                    # 提取所有段落文本
+                    paragraphs = []
+                    for paragraph in doc.paragraphs:
+                        if paragraph.text.strip():
+                            paragraphs.append(paragraph.text.strip())
+                    
+                    # 提取表格内容
+                    for table in doc.tables:
+                        for row in table.rows:
+                            row_text = []
+                            for cell in row.cells:
+                                if cell.text.strip():
+                                    row_text.append(cell.text.strip())
+                            if row_text:
+                                paragraphs.append(' | '.join(row_text))
+                    
+                    return '\n\n'.join(paragraphs) if paragraphs else '无法提取文档内容'
+                    
+                except Exception as e:
+                    print(f"Word文档处理错误: {e}")
+                    return f'Word文档解析失败：{filename}\n建议检查文件是否损坏或转换为文本格式。'
+            else:
+                return f'缺少Word文档处理库，无法解析：{filename}\n建议将内容复制粘贴到聊天框中。'
+        
+        # 处理文本文件
+        elif file_ext in ['txt', 'md', 'py', 'js', 'html', 'css', 'json', 'xml', 'csv'] or 'text' in content_type.lower():
+            # 尝试多种编码
+            encodings = ['utf-8', 'gbk', 'gb2312', 'big5', 'latin1']
+            for encoding in encodings:
+                try:
+                    return file_content_bytes.decode(encoding)
+                except UnicodeDecodeError:
+                    continue
+            # 如果所有编码都失败，使用错误忽略模式
+            return file_content_bytes.decode('utf-8', errors='ignore')
+        
+        # 处理PDF文件
+        elif file_ext == 'pdf':
+            return f'暂不支持PDF文件内容提取：{filename}\n建议转换为Word或文本格式后重新上传。'
+        
+        # 其他文件类型
+        else:
+            # 尝试作为文本文件处理
+            try:
+                # 先尝试UTF-8
+                text_content = file_content_bytes.decode('utf-8')
+                # 检查是否包含过多的非打印字符（可能是二进制文件）
+                non_printable_ratio = sum(1 for c in text_content if ord(c) < 32 and c not in '\n\r\t') / len(text_content) if text_content else 0
+                if non_printable_ratio > 0.3:  # 如果超过30%是非打印字符，可能是二进制文件
+                    return f'检测到二进制文件：{filename}\n文件类型：{content_type}\n建议上传文本格式的文件以获得更好的处理效果。'
+                return text_content
+            except UnicodeDecodeError:
+                # 尝试其他编码
+                encodings = ['gbk', 'gb2312', 'big5', 'latin1']
+                for encoding in encodings:
+                    try:
+                        return file_content_bytes.decode(encoding, errors='ignore')
+                    except:
+                        continue
+                return f'无法解析文件内容：{filename}\n文件类型：{content_type}\n建议转换为支持的格式（.txt, .docx等）。'
+                
+    except Exception as e:
+        print(f"文件内容提取错误: {e}")
+        return f'文件处理失败：{filename}\n错误信息：{str(e)}\n建议检查文件格式或重新上传。'
+
+
+def _text_key(digest, filename, content_type):
+    # 提取结果取决于扩展名和类型，提示信息中还带有文件名
+    variant = hashlib.sha256(f"{filename}\n{content_type}".encode("utf-8")).hexdigest()[:16]
+    return f"temp_file_text:{digest}:{variant}"
+
+
+def _cache_text(digest, blob, filename, content_type):
+    text = extract_file_content(blob, filename, content_type)
+    REDIS_CONN.set(_text_key(digest, filename, content_type), text, TEMP_FILE_TEXT_TTL)
+    return text
+
+
+def _file_lock(digest):
+    # 删除过期文件与重新上传同一文件互斥
+    return RedisDistributedLock(f"temp_file_lock:{digest}", timeout=60, blocking_timeout=10)
+
+
+def _remove_expired_files():
+    """删除对象存储中过期的文件；每个哈希由 zpopmin 取出，只会被一个进程处理"""
+    now = time.time()
+    while True:
+        popped = REDIS_CONN.zpopmin(TEMP_FILE_EXPIRY_KEY, 1)
+        if not popped:
+            return
+        digest, expire_at = popped[0]
+        if expire_at > now:
+            REDIS_CONN.zadd(TEMP_FILE_EXPIRY_KEY, digest, expire_at)
+            return
+        lock = _file_lock(digest)
+        if not lock.acquire():
+            # 正在被重新上传，稍后再处理
+            REDIS_CONN.zadd(TEMP_FILE_EXPIRY_KEY, digest, expire_at)
+            return
+        try:
+            # 取出之后又被上传的文件不删除
+            if REDIS_CONN.zscore(TEMP_FILE_EXPIRY_KEY, digest) is None:
+                STORAGE_IMPL.rm(TEMP_FILE_BUCKET, digest)
+        except Exception:
+            logging.exception(f"Fail to remove expired temp file {digest}")
+        finally:
+            lock.release()
+
+
+def save_temp_file(blob, filename, content_type, user_id, conversation_id=""):
+    """保存临时文件并提取文本，返回文件信息，失败时返回 None"""
+    _remove_expired_files()
+    digest = hashlib.sha256(blob).hexdigest()
+    # 每次上传都顺延过期时间；持有文件锁，以免其他进程在检查之后删除已取出的同一文件
+    lock = _file_lock(digest)
+    locked = lock.acquire()
+    try:
+        REDIS_CONN.zadd(TEMP_FILE_EXPIRY_KEY, digest, time.time() + TEMP_FILE_TTL)
+        if not locked or not STORAGE_IMPL.obj_exist(TEMP_FILE_BUCKET, digest):
+            STORAGE_IMPL.put(TEMP_FILE_BUCKET, digest, blob)
+    finally:
+        if locked:
+            lock.release()
+    if not REDIS_CONN.exist(_text_key(digest, filename, content_type)):
+        _cache_text(digest, blob, filename, content_type)
+
+    file_info = {
+        "id": str(uuid.uuid4()),
+        "filename": filename,
+        "content_type": content_type,
+        "size": len(blob),
+        "hash": digest,
+        "user_id": user_id,
+        "conversation_id": conversation_id,
+        "upload_time": time.time(),
+    }
+    if not REDIS_CONN.set(f"temp_file:{file_info['id']}", json.dumps(file_info, ensure_ascii=False), TEMP_FILE_TTL):
+        return None
+    return file_info
+
+
+def get_temp_file_info(file_id):
+    file_data = REDIS_CONN.get(f"temp_file:{file_id}")
+    return json.loads(file_data) if file_data else None
+
+
+def get_temp_file_contents(file_ids, user_id, budget=TEMP_FILE_TOKEN_BUDGET):
+    """
+    按 file_ids 的顺序返回用户附件的 {"filename", "content", "content_type"}。
+    相同的文件只返回一次；从最后一个附件往前累计 token，超出 budget 的部分被截断或丢弃。
+    """
+    infos = []
+    for file_data in REDIS_CONN.mget([f"temp_file:{file_id}" for file_id in file_ids]):
+        if not file_data:
+            continue
+        info = json.loads(file_data)
+        if info.get("user_id") != user_id:
+            continue
+        if "hash" not in info:
+            # 旧格式：文件内容以 base64 保存在 Redis 中
+            info["blob"] = base64.b64decode(info.pop("content", ""))
+            info["hash"] = hashlib.sha256(info["blob"]).hexdigest()
+        infos.append(info)
+
+    keys = [_text_key(info["hash"], info["filename"], info["content_type"]) for info in infos]
+    seen = set()
+    infos = [(info, key) for info, key in zip(infos, keys) if not (key in seen or seen.add(key))]
+    texts = REDIS_CONN.mget([key for _, key in infos])
+
+    res = []
+    for (info, _), text in reversed(list(zip(infos, texts))):
+        if text is None:
+            blob = info.get("blob")
+            if blob is None:
+                blob = STORAGE_IMPL.get(TEMP_FILE_BUCKET, info["hash"])
+            if blob is None:
+                logging.warning(f"Temp file {info['id']} is missing from {TEMP_FILE_BUCKET}")
+                continue
+            text = _cache_text(info["hash"], blob, info["filename"], info["content_type"])
+        elif isinstance(text, bytes):
+            text = text.decode("utf-8")
+        tokens = approx_num_tokens(text)
+        if tokens > budget:
+            if budget <= 0:
+                logging.info(f"Temp file {info['id']} skipped, over the attachment token budget")
+                continue
+            text = truncate(text, budget)
+            tokens = budget
+        budget -= tokens
+        res.append({"filename": info["filename"], "content": text, "content_type": info["content_type"]})
+    return res[::-1]
@@ -26,6 +26,7 @@ from api.db.services.common_service import CommonService
 from api.utils import get_uuid, current_timestamp, datetime_format
 from api.db import StatusEnum
 from rag.settings import MINIO
+from rag.utils.metadata_cache import METADATA_CACHE, bumps_metadata_version
 
 
 class UserService(CommonService):
@@ -84,9 +85,15 @@ class UserService(CommonService):
                     cls.model.id == user_id).execute()
 
 
+@bumps_metadata_version
 class TenantService(CommonService):
     model = Tenant
 
+    @classmethod
+    def get_by_id_cached(cls, tenant_id):
+        """get_by_id through the metadata cache."""
+        return METADATA_CACHE.get(("tenant", tenant_id), lambda: cls.get_by_id(tenant_id))
+
     @classmethod
     @DB.connection_context()
     def get_info_by(cls, user_id):
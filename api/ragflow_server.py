@@ -16,6 +16,7 @@ from api.db.init_data import init_llm_factory
 from api.db.runtime_config import RuntimeConfig
 from api.db.services.document_service import DocumentService
 from api.utils import show_configs
+from api.utils.chat_trace import CHAT_METRICS
 from api.utils.log_utils import initRootLogger
 from api.versions import get_ragflow_version
 from rag.settings import print_rag_settings
@@ -90,6 +91,7 @@ if __name__ == "__main__":
 
     thread = ThreadPoolExecutor(max_workers=1)
     thread.submit(update_progress)
+    CHAT_METRICS.serve()
 
     # start http server
     try:
@@ -0,0 +1,232 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""
+Per-stage latency tracing of the chat pipeline.
+
+A ChatTrace collects named spans for one chat turn. Finished traces are folded into per
+(tenant, dialog, stage) windows, which a local HTTP endpoint exposes in the Prometheus text
+format as p50/p95/p99 summaries, and appended to a JSONL log by a writer thread.
+
+Code deeper in the stack (retrieval) records spans through `span(name)`, which reports to the
+trace activated around the call and is a no-op otherwise.
+"""
+import contextvars
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from cachetools import LRUCache
+
+from api.utils.file_utils import get_project_base_directory
+
+CHAT_TRACE_ENABLED = int(os.environ.get("CHAT_TRACE_ENABLED", "1"))
+CHAT_TRACE_METRICS_PORT = int(os.environ.get("CHAT_TRACE_METRICS_PORT", "9390"))
+CHAT_TRACE_WINDOW = int(os.environ.get("CHAT_TRACE_WINDOW", "1024"))
+CHAT_TRACE_MAX_SERIES = int(os.environ.get("CHAT_TRACE_MAX_SERIES", "4096"))
+CHAT_TRACE_LOG = os.environ.get("CHAT_TRACE_LOG", os.path.join(get_project_base_directory(), "logs", "chat_trace.jsonl"))
+# Lines waiting for the writer thread; beyond that, traces are dropped from the log (not from the metrics).
+CHAT_TRACE_LOG_QUEUE = int(os.environ.get("CHAT_TRACE_LOG_QUEUE", "10000"))
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+_current = contextvars.ContextVar("chat_trace", default=None)
+
+
+class ChatTrace:
+    def __init__(self, tenant_id: str, dialog_id: str):
+        self.tenant_id = tenant_id
+        self.dialog_id = dialog_id
+        self.start_ts = time.perf_counter()
+        self.created_at = time.time()
+        self.spans = {}
+
+    def add(self, name: str, seconds: float):
+        self.spans[name] = self.spans.get(name, 0.0) + seconds
+
+    def since(self, name: str, start_ts: float):
+        self.add(name, time.perf_counter() - start_ts)
+
+    @contextmanager
+    def span(self, name: str):
+        start_ts = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.since(name, start_ts)
+
+    @contextmanager
+    def activate(self):
+        """Make this trace the target of `span()` for the enclosed calls."""
+        token = _current.set(self)
+        try:
+            yield self
+        finally:
+            _current.reset(token)
+
+    def finish(self):
+        self.add("total", time.perf_counter() - self.start_ts)
+        if CHAT_TRACE_ENABLED:
+            CHAT_METRICS.record(self)
+
+
+@contextmanager
+def span(name: str):
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    with trace.span(name):
+        yield
+
+
+def _quantile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+class ChatMetrics:
+    def __init__(self, window=CHAT_TRACE_WINDOW, max_series=CHAT_TRACE_MAX_SERIES, log_path=CHAT_TRACE_LOG):
+        self._lock = threading.Lock()
+        # (tenant_id, dialog_id, stage) -> [recent durations, count, sum]
+        self._series = LRUCache(maxsize=max(1, max_series))
+        self._window = max(1, window)
+        self._log_path = log_path
+        self._log_queue = queue.Queue(maxsize=max(1, CHAT_TRACE_LOG_QUEUE))
+        self._writer = None
+        self.dropped = 0
+        self._server = None
+
+    def record(self, trace: ChatTrace):
+        with self._lock:
+            for stage, seconds in trace.spans.items():
+                key = (trace.tenant_id, trace.dialog_id, stage)
+                series = self._series.get(key)
+                if series is None:
+                    series = [deque(maxlen=self._window), 0, 0.0]
+                    self._series[key] = series
+                series[0].append(seconds)
+                series[1] += 1
+                series[2] += seconds
+        self._log(trace)
+
+    def _log(self, trace: ChatTrace):
+        """Queue the trace for the writer thread: chat requests never wait for the disk."""
+        if not self._log_path:
+            return
+        line = json.dumps(
+            {
+                "created_at": trace.created_at,
+                "tenant_id": trace.tenant_id,
+                "dialog_id": trace.dialog_id,
+                "spans_ms": {k: round(v * 1000, 3) for k, v in trace.spans.items()},
+            },
+            ensure_ascii=False,
+        )
+        try:
+            self._log_queue.put_nowait(line)
+        except queue.Full:
+            self.dropped += 1
+            return
+        if self._writer is None:
+            with self._lock:
+                if self._writer is None:
+                    self._writer = threading.Thread(target=self._write_log, name="chat_trace_log", daemon=True)
+                    self._writer.start()
+
+    def _write_log(self):
+        while True:
+            lines = [self._log_queue.get()]
+            while True:
+                try:
+                    lines.append(self._log_queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                with open(self._log_path, "a", encoding="utf-8") as f:
+                    f.write("\n".join(lines) + "\n")
+            except OSError as e:
+                logging.warning(f"ChatMetrics can't write {self._log_path}: {e}")
+
+    def summary(self, tenant_id: str | None = None, dialog_id: str | None = None) -> dict:
+        """{stage: {"p50": ms, "p95": ms, "p99": ms, "count": n}} over the matching series."""
+        with self._lock:
+            merged = {}
+            for (tid, did, stage), (values, count, _) in self._series.items():
+                if tenant_id and tid != tenant_id or dialog_id and did != dialog_id:
+                    continue
+                v, c = merged.setdefault(stage, ([], [0]))
+                v.extend(values)
+                c[0] += count
+        res = {}
+        for stage, (values, count) in merged.items():
+            values.sort()
+            res[stage] = {f"p{int(q * 100)}": round(_quantile(values, q) * 1000, 3) for q in QUANTILES}
+            res[stage]["count"] = count[0]
+        return res
+
+    def exposition(self) -> str:
+        lines = [
+            "# HELP ragflow_chat_stage_seconds Latency of the chat pipeline stages.",
+            "# TYPE ragflow_chat_stage_seconds summary",
+        ]
+        with self._lock:
+            series = [(k, sorted(v), c, s) for k, (v, c, s) in self._series.items()]
+        for (tenant_id, dialog_id, stage), values, count, total in series:
+            labels = f'tenant_id="{tenant_id}",dialog_id="{dialog_id}",stage="{stage}"'
+            for q in QUANTILES:
+                lines.append(f'ragflow_chat_stage_seconds{{{labels},quantile="{q}"}} {_quantile(values, q):.6f}')
+            lines.append(f"ragflow_chat_stage_seconds_count{{{labels}}} {count}")
+            lines.append(f"ragflow_chat_stage_seconds_sum{{{labels}}} {total:.6f}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port=CHAT_TRACE_METRICS_PORT, host="127.0.0.1"):
+        """Expose /metrics on a local port from a daemon thread."""
+        if not CHAT_TRACE_ENABLED or not port or self._server:
+            return
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.exposition().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            self._server = ThreadingHTTPServer((host, port), Handler)
+        except OSError as e:
+            logging.warning(f"Chat trace metrics endpoint can't listen on {host}:{port}: {e}")
+            return
+        threading.Thread(target=self._server.serve_forever, name="chat_trace_metrics", daemon=True).start()
+        logging.info(f"Chat trace metrics on http://{host}:{port}/metrics")
+
+
+CHAT_METRICS = ChatMetrics()
@@ -0,0 +1,68 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""
+Delta streaming of chat answers over SSE.
+
+The chat generators yield the whole answer accumulated so far. In delta mode only the new text
+is sent:
+
+    {"delta": "...", "id": ..., "session_id": ...}                  new text since the last event
+    {"answer": "...", "reset": true, "id": ..., "session_id": ...}  the answer was rewritten (e.g. a
+                                                                     thinking block removed), start over
+    {..., "final": true}                                            the full structured answer with its
+                                                                     reference, as in the full mode
+
+Each event then costs O(delta) bytes and JSON encoding instead of O(answer).
+"""
+import json
+
+
+def sse(data, code=0, message="") -> str:
+    return "data:" + json.dumps({"code": code, "message": message, "data": data}, ensure_ascii=False) + "\n\n"
+
+
+def _delta_event(ans: dict, sent: str) -> tuple[dict | None, str]:
+    answer = ans.get("answer") or ""
+    if answer.startswith(sent):
+        event = {"delta": answer[len(sent):]}
+    else:
+        event = {"answer": answer, "reset": True}
+    if ans.get("audio_binary"):
+        event["audio_binary"] = ans["audio_binary"]
+    if len(event) == 1 and not event.get("delta"):
+        return None, sent
+    return event, answer
+
+
+def delta_events(answers, finalize, message_id=None, session_id=None):
+    """
+    Turns a generator of accumulated answers into delta events. The last answer is held back,
+    passed through `finalize` (e.g. structure_answer) and sent whole with "final": true.
+    """
+    sent = ""
+    last = None
+    for ans in answers:
+        if last is not None:
+            event, sent = _delta_event(last, sent)
+            if event:
+                event["id"] = message_id
+                event["session_id"] = session_id
+                yield event
+        last = ans
+    if last is not None:
+        final = finalize(last)
+        final["final"] = True
+        yield final
@@ -0,0 +1,90 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""
+Compare the full and the delta SSE protocols of /conversation/completion on a simulated answer:
+events, bytes sent and encoding time per answer. The answer is streamed the way the chat
+generators do, one accumulated string per `--step` tokens, and ends with a structured answer
+carrying `--chunks` reference chunks. The client side reassembly of the delta stream is checked.
+
+    python api/utils/delta_stream_benchmark.py [--tokens N] [--step N] [--chunks N] [--repeat N]
+"""
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent.parent))
+from api.utils.delta_stream import delta_events, sse
+
+
+def chat(tokens, step, reference):
+    words = [f"词{i % 97}" if i % 3 else f"word{i}" for i in range(tokens)]
+    for n in range(step, tokens + step, step):
+        yield {"answer": " ".join(words[:n]), "reference": {}, "audio_binary": None}
+    yield {"answer": " ".join(words), "reference": reference, "prompt": "", "created_at": time.time()}
+
+
+def structure(ans):
+    ans["id"] = "message"
+    ans["session_id"] = "session"
+    return ans
+
+
+def full_stream(answers):
+    for ans in answers:
+        yield sse(structure(ans))
+
+
+def delta_stream(answers):
+    for ans in delta_events(answers, structure, "message", "session"):
+        yield sse(ans)
+
+
+def run(protocol, args, reference):
+    events = size = 0
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        for event in protocol(chat(args.tokens, args.step, reference)):
+            events += 1
+            size += len(event.encode("utf-8"))
+    return events / args.repeat, size / args.repeat, (time.perf_counter() - start) / args.repeat
+
+
+def reassemble(answers):
+    text = ""
+    for event in delta_stream(answers):
+        data = json.loads(event[len("data:"):])["data"]
+        if data.get("final"):
+            return text, data["answer"]
+        text = data["answer"] if data.get("reset") else text + data.get("delta", "")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SSE delta streaming benchmark")
+    parser.add_argument("--tokens", type=int, default=4096, help="tokens of the answer")
+    parser.add_argument("--step", type=int, default=16, help="tokens per streamed event")
+    parser.add_argument("--chunks", type=int, default=8, help="reference chunks of the final event")
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    reference = {"chunks": [{"id": str(i), "content": "参考内容 " * 100, "document_name": f"doc{i}.pdf"} for i in range(args.chunks)], "doc_aggs": []}
+    for name, protocol in [("full", full_stream), ("delta", delta_stream)]:
+        events, size, elapsed = run(protocol, args, reference)
+        print(f"{name:>5}: {events:.0f} events, {size / 1024:.1f} KB, {elapsed * 1000:.1f} ms per answer")
+
+    streamed, final = reassemble(chat(args.tokens, args.step, reference))
+    print(f"delta reassembly matches the final answer: {streamed == final}")
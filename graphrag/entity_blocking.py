@@ -0,0 +1,125 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""
+Candidate generation for entity resolution. Instead of testing every pair of entities of a type,
+pairs are drawn from two blocking indexes: MinHash LSH over the character n-grams of the names,
+and nearest neighbours of the name embeddings.
+"""
+import logging
+import os
+import re
+from collections import defaultdict
+
+import numpy as np
+import xxhash
+
+from rag.nlp import is_english
+
+# 32 bands of 2 rows: pairs whose n-gram Jaccard similarity is above ~0.2 are likely to share a bucket.
+LSH_BANDS = int(os.environ.get("ENTITY_RESOLUTION_LSH_BANDS", "32"))
+LSH_ROWS = int(os.environ.get("ENTITY_RESOLUTION_LSH_ROWS", "2"))
+# Buckets larger than this hold a too common n-gram to tell anything, they are skipped.
+LSH_MAX_BUCKET = int(os.environ.get("ENTITY_RESOLUTION_LSH_MAX_BUCKET", "256"))
+MIN_JACCARD = float(os.environ.get("ENTITY_RESOLUTION_MIN_JACCARD", "0.2"))
+ANN_K = int(os.environ.get("ENTITY_RESOLUTION_ANN_K", "5"))
+ANN_THRESHOLD = float(os.environ.get("ENTITY_RESOLUTION_ANN_THRESHOLD", "0.9"))
+
+_PRIME = (1 << 31) - 1
+_PUNCT_RE = re.compile(r"[\s\W_]+", re.UNICODE)
+
+
+def name_shingles(name: str) -> set[str]:
+    """Character trigrams of English names, character bigrams otherwise (CJK names are short)."""
+    name = _PUNCT_RE.sub(" ", name.lower()).strip()
+    if not name:
+        return set()
+    if is_english(name.replace(" ", "")):
+        name = f" {name} "
+        n = 3
+    else:
+        name = name.replace(" ", "")
+        n = 2
+    if len(name) <= n:
+        return {name}
+    return {name[i: i + n] for i in range(len(name) - n + 1)}
+
+
+class MinHashLSH:
+    def __init__(self, bands=LSH_BANDS, rows=LSH_ROWS, seed=1):
+        self.bands = bands
+        self.rows = rows
+        rng = np.random.default_rng(seed)
+        num_perm = bands * rows
+        self._a = rng.integers(1, _PRIME, size=num_perm, dtype=np.int64)
+        self._b = rng.integers(0, _PRIME, size=num_perm, dtype=np.int64)
+
+    def signature(self, shingles: set[str]) -> np.ndarray:
+        hs = np.array([xxhash.xxh32_intdigest(s) % _PRIME for s in shingles], dtype=np.int64)
+        return ((self._a[:, None] * hs[None, :] + self._b[:, None]) % _PRIME).min(axis=1)
+
+    def candidate_pairs(self, names: list[str]) -> set[tuple[int, int]]:
+        """Index pairs (i < j) of the names sharing at least one band, with estimated Jaccard >= MIN_JACCARD."""
+        sigs = {}
+        for i, name in enumerate(names):
+            shingles = name_shingles(name)
+            if shingles:
+                sigs[i] = self.signature(shingles)
+        buckets = defaultdict(list)
+        for i, sig in sigs.items():
+            for band in range(self.bands):
+                buckets[(band, sig[band * self.rows: (band + 1) * self.rows].tobytes())].append(i)
+
+        pairs = set()
+        skipped = 0
+        for members in buckets.values():
+            if len(members) < 2:
+                continue
+            if len(members) > LSH_MAX_BUCKET:
+                skipped += 1
+                continue
+            for x in range(len(members)):
+                for y in range(x + 1, len(members)):
+                    i, j = members[x], members[y]
+                    pairs.add((i, j) if i < j else (j, i))
+        if skipped:
+            logging.info(f"MinHashLSH skipped {skipped} buckets of more than {LSH_MAX_BUCKET} names")
+        return {(i, j) for i, j in pairs if np.mean(sigs[i] == sigs[j]) >= MIN_JACCARD}
+
+
+def embedding_neighbors(vectors: np.ndarray, k=ANN_K, threshold=ANN_THRESHOLD, block=1024) -> set[tuple[int, int]]:
+    """
+    Index pairs (i < j) where j is among the k nearest neighbours of i by cosine similarity, above
+    `threshold`. Exact search by blocks of rows, so memory stays at block * n similarities.
+    """
+    n = len(vectors)
+    if n < 2:
+        return set()
+    v = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(v, axis=1, keepdims=True)
+    v = v / np.where(norms == 0, 1, norms)
+    k = min(k, n - 1)
+    pairs = set()
+    for st in range(0, n, block):
+        sims = v[st: st + block] @ v.T
+        for r in range(sims.shape[0]):
+            sims[r, st + r] = -1
+        top = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+        for r, js in enumerate(top):
+            i = st + r
+            for j in js:
+                if sims[r, j] >= threshold:
+                    pairs.add((i, int(j)) if i < j else (int(j), i))
+    return pairs
@@ -14,15 +14,17 @@
 #  limitations under the License.
 #
 import logging
-import itertools
+import os
 import re
 import time
 from dataclasses import dataclass
 from typing import Any, Callable
 
 import networkx as nx
+import numpy as np
 import trio
 
+from graphrag.entity_blocking import MinHashLSH, embedding_neighbors
 from graphrag.general.extractor import Extractor
 from rag.nlp import is_english
 import editdistance
@@ -33,6 +35,8 @@ from graphrag.utils import perform_variable_replacements, chat_limiter
 DEFAULT_RECORD_DELIMITER = "##"
 DEFAULT_ENTITY_INDEX_DELIMITER = "<|>"
 DEFAULT_RESOLUTION_RESULT_DELIMITER = "&&"
+# Candidate pairs asked to the LLM per prompt.
+RESOLUTION_BATCH_SIZE = int(os.environ.get("ENTITY_RESOLUTION_BATCH_SIZE", "100"))
 
 
 @dataclass
@@ -57,11 +61,13 @@ class EntityResolution(Extractor):
             get_entity: Callable | None = None,
             set_entity: Callable | None = None,
             get_relation: Callable | None = None,
-            set_relation: Callable | None = None
+            set_relation: Callable | None = None,
+            embd_mdl=None
     ):
         super().__init__(llm_invoker, get_entity=get_entity, set_entity=set_entity, get_relation=get_relation, set_relation=set_relation)
         """Init method definition."""
         self._llm = llm_invoker
+        self._embd_mdl = embd_mdl
         self._resolution_prompt = ENTITY_RESOLUTION_PROMPT
         self._record_delimiter_key = "record_delimiter"
         self._entity_index_dilimiter_key = "entity_index_delimiter"
@@ -91,19 +97,22 @@ class EntityResolution(Extractor):
         for node in nodes:
             node_clusters[graph.nodes[node].get('entity_type', '-')].append(node)
 
+        start = time.perf_counter()
         candidate_resolution = {entity_type: [] for entity_type in entity_types}
         for k, v in node_clusters.items():
-            candidate_resolution[k] = [(a, b) for a, b in itertools.combinations(v, 2) if self.is_similarity(a, b)]
+            candidate_resolution[k] = await self._candidate_pairs(v)
         num_candidates = sum([len(candidates) for _, candidates in candidate_resolution.items()])
-        callback(msg=f"Identified {num_candidates} candidate pairs")
+        elapsed = time.perf_counter() - start
+        callback(msg=f"Identified {num_candidates} candidate pairs among {len(nodes)} entities in {elapsed:.2f}s ({num_candidates / max(elapsed, 1e-6):.0f} candidates/s)")
 
+        start = time.perf_counter()
         resolution_result = set()
         async with trio.open_nursery() as nursery:
-            for candidate_resolution_i in candidate_resolution.items():
-                if not candidate_resolution_i[1]:
-                    continue
-                nursery.start_soon(lambda: self._resolve_candidate(candidate_resolution_i, resolution_result))
-        callback(msg=f"Resolved {num_candidates} candidate pairs, {len(resolution_result)} of them are selected to merge.")
+            for entity_type, candidates in candidate_resolution.items():
+                for i in range(0, len(candidates), RESOLUTION_BATCH_SIZE):
+                    nursery.start_soon(self._resolve_candidate, (entity_type, candidates[i: i + RESOLUTION_BATCH_SIZE]), resolution_result)
+        elapsed = time.perf_counter() - start
+        callback(msg=f"Resolved {num_candidates} candidate pairs in {elapsed:.2f}s ({num_candidates / max(elapsed, 1e-6):.0f} candidates/s), {len(resolution_result)} of them are selected to merge.")
 
         connect_graph = nx.Graph()
         removed_entities = []
@@ -212,6 +221,30 @@ class EntityResolution(Extractor):
 
         return ans_list
 
+    async def _candidate_pairs(self, names: list[str]) -> list[tuple[str, str]]:
+        """
+        Pairs of names worth asking the LLM about: MinHash LSH buckets over the character n-grams,
+        kept if is_similarity agrees, plus the nearest neighbours of the name embeddings.
+        """
+        if len(names) < 2:
+            return []
+        pairs = await trio.to_thread.run_sync(lambda: MinHashLSH().candidate_pairs(names))
+        pairs = {(i, j) for i, j in pairs if self.is_similarity(names[i], names[j])}
+        if self._embd_mdl:
+            try:
+                vectors = await trio.to_thread.run_sync(lambda: self._name_vectors(names))
+                pairs |= await trio.to_thread.run_sync(lambda: embedding_neighbors(vectors))
+            except Exception:
+                logging.exception("EntityResolution can't embed entity names, using n-gram candidates only")
+        return [(names[i], names[j]) for i, j in sorted(pairs)]
+
+    def _name_vectors(self, names: list[str], batch_size=256) -> np.ndarray:
+        vectors = []
+        for i in range(0, len(names), batch_size):
+            vts, _ = self._embd_mdl.encode(names[i: i + batch_size])
+            vectors.append(np.asarray(vts, dtype=np.float32))
+        return np.concatenate(vectors)
+
     def is_similarity(self, a, b):
         if is_english(a) and is_english(b):
             if editdistance.eval(a, b) <= min(len(a), len(b)) // 2:
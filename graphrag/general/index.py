@@ -14,7 +14,6 @@
 #  limitations under the License.
 #
 import json
-import logging
 from functools import partial
 import networkx as nx
 import trio
@@ -26,17 +25,19 @@ from graphrag.general.community_reports_extractor import CommunityReportsExtract
 from graphrag.entity_resolution import EntityResolution
 from graphrag.general.extractor import Extractor
 from graphrag.utils import (
-    graph_merge,
     set_entity,
     get_relation,
     set_relation,
     get_entity,
     get_graph,
     set_graph,
+    graph_lock,
+    compact_graph,
+    forget_graph,
+    dump_graph,
     chunk_id,
     update_nodes_pagerank_nhop_neighbour,
     does_graph_contains,
-    get_graph_doc_ids,
 )
 from rag.nlp import rag_tokenizer, search
 from rag.utils.redis_conn import REDIS_CONN
@@ -66,11 +67,14 @@ async def run_graphrag(
 ):
     start = trio.current_time()
     tenant_id, kb_id, doc_id = row["tenant_id"], str(row["kb_id"]), row["doc_id"]
-    chunks = []
-    for d in settings.retrievaler.chunk_list(
-        doc_id, tenant_id, [kb_id], fields=["content_with_weight", "doc_id"]
-    ):
-        chunks.append(d["content_with_weight"])
+    chunks = await trio.to_thread.run_sync(
+        lambda: [
+            d["content_with_weight"]
+            for d in settings.retrievaler.chunk_list(
+                doc_id, tenant_id, [kb_id], fields=["content_with_weight", "doc_id"]
+            )
+        ]
+    )
 
     graph, doc_ids = await update_graph(
         LightKGExt
@@ -90,6 +94,8 @@ async def run_graphrag(
         return
     if with_resolution or with_community:
         graphrag_task_set(tenant_id, kb_id, doc_id)
+        # resolution and community extraction modify the graph in place, keep it apart from the shared copy
+        forget_graph(tenant_id, kb_id)
     if with_resolution:
         await resolve_entities(
             graph,
@@ -157,9 +163,7 @@ async def update_graph(
         )
     # TODO: infinity doesn't support array search
     chunk = {
-        "content_with_weight": json.dumps(
-            nx.node_link_data(subgraph, edges="edges"), ensure_ascii=False, indent=2
-        ),
+        "content_with_weight": dump_graph(subgraph),
         "knowledge_graph_kwd": "subgraph",
         "kb_id": kb_id,
         "source_id": [doc_id],
@@ -176,27 +180,15 @@ async def update_graph(
     callback(msg=f"generated subgraph for doc {doc_id} in {now - start:.2f} seconds.")
     start = now
 
-    while True:
-        new_graph = subgraph
-        now_docids = set([doc_id])
-        old_graph, old_doc_ids = await get_graph(tenant_id, kb_id)
-        if old_graph is not None:
-            logging.info("Merge with an exiting graph...................")
-            new_graph = graph_merge(old_graph, subgraph)
+    # The subgraph stored above is the delta of this document: loading the graph merges it
+    # along with the deltas of the other documents not seen yet. It is passed along since the
+    # doc store may not show it before its next refresh.
+    async with graph_lock(kb_id):
+        new_graph, now_docids = await get_graph(tenant_id, kb_id, {doc_id: subgraph})
+        now_docids = set(now_docids)
         await update_nodes_pagerank_nhop_neighbour(tenant_id, kb_id, new_graph, 2)
-        if old_doc_ids:
-            for old_doc_id in old_doc_ids:
-                now_docids.add(old_doc_id)
-        old_doc_ids2 = await get_graph_doc_ids(tenant_id, kb_id)
-        delta_doc_ids = set(old_doc_ids2) - set(old_doc_ids)
-        if delta_doc_ids:
-            callback(
-                msg="The global graph has changed during merging, try again"
-            )
-            await trio.sleep(1)
-            continue
-        break
-    await set_graph(tenant_id, kb_id, new_graph, list(now_docids))
+        if await compact_graph(tenant_id, kb_id, deltas={doc_id: subgraph}):
+            callback(msg=f"Wrote a snapshot of the global graph of {len(now_docids)} documents.")
     now = trio.current_time()
     callback(
         msg=f"merging subgraph for doc {doc_id} into the global graph done in {now - start:.2f} seconds."
@@ -227,6 +219,7 @@ async def resolve_entities(
         set_entity=partial(set_entity, tenant_id, kb_id, embed_bdl),
         get_relation=partial(get_relation, tenant_id, kb_id),
         set_relation=partial(set_relation, tenant_id, kb_id, embed_bdl),
+        embd_mdl=embed_bdl,
     )
     reso = await er(graph, callback=callback)
     graph = reso.graph
@@ -240,7 +233,8 @@ async def resolve_entities(
             msg=f"Another graphrag task of doc_id {working_doc_id} is working on this kb, cancel myself"
         )
         return
-    await set_graph(tenant_id, kb_id, graph, doc_ids)
+    async with graph_lock(kb_id):
+        await set_graph(tenant_id, kb_id, graph, doc_ids)
 
     await trio.to_thread.run_sync(
         lambda: settings.docStoreConn.delete(
@@ -312,7 +306,8 @@ async def extract_community(
             msg=f"Another graphrag task of doc_id {working_doc_id} is working on this kb, cancel myself"
         )
         return
-    await set_graph(tenant_id, kb_id, graph, doc_ids)
+    async with graph_lock(kb_id):
+        await set_graph(tenant_id, kb_id, graph, doc_ids)
 
     now = trio.current_time()
     callback(
@@ -102,38 +102,46 @@ class KGSearch(Dealer):
             }
         return res
 
-    def get_relevant_ents_by_keywords(self, keywords, filters, idxnms, kb_ids, emb_mdl, sim_thr=0.3, N=56):
-        if not keywords:
-            return {}
+    def _ents_by_keywords_query(self, keywords, filters, idxnms, kb_ids, emb_mdl, sim_thr=0.3, N=56):
         filters = deepcopy(filters)
         filters["knowledge_graph_kwd"] = "entity"
         matchDense = self.get_vector(", ".join(keywords), emb_mdl, topk=1024, similarity=sim_thr)
-        es_res = self.dataStore.search(["content_with_weight", "entity_kwd", "rank_flt"], [], filters, [matchDense],
-                                       OrderByExpr(), 0, N,
-                                       idxnms, kb_ids)
-        return self._ent_info_from_(es_res, sim_thr)
+        return dict(selectFields=["content_with_weight", "entity_kwd", "rank_flt"], highlightFields=[], condition=filters,
+                    matchExprs=[matchDense], orderBy=OrderByExpr(), offset=0, limit=N, indexNames=idxnms, knowledgebaseIds=kb_ids)
 
-    def get_relevant_relations_by_txt(self, txt, filters, idxnms, kb_ids, emb_mdl, sim_thr=0.3, N=56):
-        if not txt:
-            return {}
+    def _relations_by_txt_query(self, txt, filters, idxnms, kb_ids, emb_mdl, sim_thr=0.3, N=56):
         filters = deepcopy(filters)
         filters["knowledge_graph_kwd"] = "relation"
         matchDense = self.get_vector(txt, emb_mdl, topk=1024, similarity=sim_thr)
-        es_res = self.dataStore.search(
-            ["content_with_weight", "_score", "from_entity_kwd", "to_entity_kwd", "weight_int"],
-            [], filters, [matchDense], OrderByExpr(), 0, N, idxnms, kb_ids)
-        return self._relation_info_from_(es_res, sim_thr)
+        return dict(selectFields=["content_with_weight", "_score", "from_entity_kwd", "to_entity_kwd", "weight_int"],
+                    highlightFields=[], condition=filters, matchExprs=[matchDense], orderBy=OrderByExpr(), offset=0, limit=N,
+                    indexNames=idxnms, knowledgebaseIds=kb_ids)
 
-    def get_relevant_ents_by_types(self, types, filters, idxnms, kb_ids, N=56):
-        if not types:
-            return {}
+    def _ents_by_types_query(self, types, filters, idxnms, kb_ids, N=56):
         filters = deepcopy(filters)
         filters["knowledge_graph_kwd"] = "entity"
         filters["entity_type_kwd"] = types
         ordr = OrderByExpr()
         ordr.desc("rank_flt")
-        es_res = self.dataStore.search(["entity_kwd", "rank_flt"], [], filters, [], ordr, 0, N,
-                                       idxnms, kb_ids)
+        return dict(selectFields=["entity_kwd", "rank_flt"], highlightFields=[], condition=filters, matchExprs=[],
+                    orderBy=ordr, offset=0, limit=N, indexNames=idxnms, knowledgebaseIds=kb_ids)
+
+    def get_relevant_ents_by_keywords(self, keywords, filters, idxnms, kb_ids, emb_mdl, sim_thr=0.3, N=56):
+        if not keywords:
+            return {}
+        es_res = self.dataStore.search(**self._ents_by_keywords_query(keywords, filters, idxnms, kb_ids, emb_mdl, sim_thr, N))
+        return self._ent_info_from_(es_res, sim_thr)
+
+    def get_relevant_relations_by_txt(self, txt, filters, idxnms, kb_ids, emb_mdl, sim_thr=0.3, N=56):
+        if not txt:
+            return {}
+        es_res = self.dataStore.search(**self._relations_by_txt_query(txt, filters, idxnms, kb_ids, emb_mdl, sim_thr, N))
+        return self._relation_info_from_(es_res, sim_thr)
+
+    def get_relevant_ents_by_types(self, types, filters, idxnms, kb_ids, N=56):
+        if not types:
+            return {}
+        es_res = self.dataStore.search(**self._ents_by_types_query(types, filters, idxnms, kb_ids, N))
         return self._ent_info_from_(es_res, 0)
 
     def retrieval(self, question: str,
@@ -162,9 +170,22 @@ class KGSearch(Dealer):
             ents = [qst]
             pass
 
-        ents_from_query = self.get_relevant_ents_by_keywords(ents, filters, idxnms, kb_ids, emb_mdl, ent_sim_threshold)
-        ents_from_types = self.get_relevant_ents_by_types(ty_kwds, filters, idxnms, kb_ids, 10000)
-        rels_from_txt = self.get_relevant_relations_by_txt(qst, filters, idxnms, kb_ids, emb_mdl, rel_sim_threshold)
+        # The three lookups are independent, send them in one multi-search round trip.
+        queries = []
+        if ents:
+            queries.append((self._ents_by_keywords_query(ents, filters, idxnms, kb_ids, emb_mdl, ent_sim_threshold),
+                            lambda r: self._ent_info_from_(r, ent_sim_threshold)))
+        if ty_kwds:
+            queries.append((self._ents_by_types_query(ty_kwds, filters, idxnms, kb_ids, 10000),
+                            lambda r: self._ent_info_from_(r, 0)))
+        if qst:
+            queries.append((self._relations_by_txt_query(qst, filters, idxnms, kb_ids, emb_mdl, rel_sim_threshold),
+                            lambda r: self._relation_info_from_(r, rel_sim_threshold)))
+        results = self.dataStore.msearch([q for q, _ in queries]) if queries else []
+        parsed = iter([parse(r) for (_, parse), r in zip(queries, results)])
+        ents_from_query = next(parsed) if ents else {}
+        ents_from_types = next(parsed) if ty_kwds else {}
+        rels_from_txt = next(parsed) if qst else {}
         nhop_pathes = defaultdict(dict)
         for _, ent in ents_from_query.items():
             nhops = ent.get("n_hop_ents", [])
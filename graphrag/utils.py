@@ -6,12 +6,17 @@ Reference:
  - [LightRag](https://github.com/HKUDS/LightRAG)
 """
 
+import base64
 import html
 import json
 import logging
 import re
+import threading
 import time
+import uuid
+import zlib
 from collections import defaultdict
+from contextlib import asynccontextmanager
 from copy import deepcopy
 from hashlib import md5
 from typing import Any, Callable
@@ -20,18 +25,34 @@ import trio
 
 import networkx as nx
 import numpy as np
+import ormsgpack
+import scipy.sparse
 import xxhash
+from cachetools import LRUCache
 from networkx.readwrite import json_graph
 
 from api import settings
 from rag.nlp import search, rag_tokenizer
 from rag.utils.doc_store_conn import OrderByExpr
-from rag.utils.redis_conn import REDIS_CONN
+from rag.utils.redis_conn import REDIS_CONN, RedisDistributedLock
 
 ErrorHandlerFn = Callable[[BaseException | None, str | None, dict | None], None]
 
 chat_limiter = trio.CapacityLimiter(int(os.environ.get('MAX_CONCURRENT_CHATS', 10)))
 
+# A new snapshot of the KB graph is written once this many documents were merged as deltas since the last one.
+GRAPH_SNAPSHOT_DELTAS = int(os.environ.get('GRAPH_SNAPSHOT_DELTAS', "16"))
+GRAPH_CACHE_SIZE = int(os.environ.get('GRAPH_CACHE_SIZE', "8"))
+GRAPH_LOCK_TIMEOUT = int(os.environ.get('GRAPH_LOCK_TIMEOUT', "1800"))
+GRAPH_SNAPSHOT_PREFIX = "msgpack+zlib:"
+# rank_flt of an entity is rewritten only when its PageRank moved by more than this fraction.
+PAGERANK_WRITE_TOLERANCE = float(os.environ.get('PAGERANK_WRITE_TOLERANCE', "0.05"))
+# (tenant_id, kb_id) -> (snapshot version, graph, merged doc ids, doc ids of the snapshot)
+_graph_cache = LRUCache(maxsize=max(1, GRAPH_CACHE_SIZE))
+_graph_cache_lock = threading.Lock()
+# (tenant_id, kb_id) -> lock held while the cached graph of the KB is checked, merged into and read
+_graph_locks = {}
+
 def perform_variable_replacements(
     input: str, history: list[dict] | None = None, variables: dict | None = None
 ) -> str:
@@ -81,14 +102,17 @@ def dict_has_keys_with_types(
     return True
 
 
-def get_llm_cache(llmnm, txt, history, genconf):
+def _llm_cache_key(llmnm, txt, history, genconf):
     hasher = xxhash.xxh64()
     hasher.update(str(llmnm).encode("utf-8"))
     hasher.update(str(txt).encode("utf-8"))
     hasher.update(str(history).encode("utf-8"))
     hasher.update(str(genconf).encode("utf-8"))
+    return hasher.hexdigest()
 
-    k = hasher.hexdigest()
+
+def get_llm_cache(llmnm, txt, history, genconf):
+    k = _llm_cache_key(llmnm, txt, history, genconf)
     bin = REDIS_CONN.get(k)
     if not bin:
         return
@@ -96,16 +120,22 @@ def get_llm_cache(llmnm, txt, history, genconf):
 
 
 def set_llm_cache(llmnm, txt, v, history, genconf):
-    hasher = xxhash.xxh64()
-    hasher.update(str(llmnm).encode("utf-8"))
-    hasher.update(str(txt).encode("utf-8"))
-    hasher.update(str(history).encode("utf-8"))
-    hasher.update(str(genconf).encode("utf-8"))
-
-    k = hasher.hexdigest()
+    k = _llm_cache_key(llmnm, txt, history, genconf)
     REDIS_CONN.set(k, v.encode("utf-8"), 24*3600)
 
 
+async def mget_llm_cache(llmnm, txts, history, genconf):
+    """Cached answers for all `txts` in one round trip, None where missing."""
+    keys = [_llm_cache_key(llmnm, txt, history, genconf) for txt in txts]
+    return [v if v else None for v in await REDIS_CONN.amget(keys)]
+
+
+async def mset_llm_cache(llmnm, answers: dict, history, genconf):
+    """Write {txt: answer} in one pipeline."""
+    mapping = {_llm_cache_key(llmnm, txt, history, genconf): v.encode("utf-8") for txt, v in answers.items()}
+    return await REDIS_CONN.amset(mapping, 24*3600)
+
+
 def get_embed_cache(llmnm, txt):
     hasher = xxhash.xxh64()
     hasher.update(str(llmnm).encode("utf-8"))
@@ -165,6 +195,44 @@ def graph_merge(g1, g2):
     return g
 
 
+def merge_subgraph(graph, subgraph):
+    """
+    In place counterpart of graph_merge(graph, subgraph): only the nodes and edges of `subgraph`
+    are visited, so the cost does not grow with `graph`.
+    """
+    for n, attr in subgraph.nodes(data=True):
+        if n in graph:
+            graph.nodes[n].update(attr)
+        else:
+            graph.add_node(n, **attr)
+    for source, target, attr in subgraph.edges(data=True):
+        if graph.has_edge(source, target):
+            graph[source][target]["weight"] = graph[source][target].get("weight", 0) + 1
+        else:
+            graph.add_edge(source, target, **attr)
+    for n in subgraph.nodes():
+        graph.nodes[n]["rank"] = int(graph.degree(n))
+    return graph
+
+
+def dump_graph(graph) -> str:
+    """Compact text form of a graph for the doc store: zlib compressed msgpack of its node-link data."""
+    data = nx.node_link_data(graph, edges="edges")
+    bin = ormsgpack.packb(data, default=lambda o: o.item() if hasattr(o, "item") else str(o))
+    return GRAPH_SNAPSHOT_PREFIX + base64.b64encode(zlib.compress(bin)).decode("ascii")
+
+
+def load_graph_data(content: str) -> dict:
+    """Node-link data of a stored graph, written either by dump_graph or as JSON by earlier versions."""
+    if content.startswith(GRAPH_SNAPSHOT_PREFIX):
+        return ormsgpack.unpackb(zlib.decompress(base64.b64decode(content[len(GRAPH_SNAPSHOT_PREFIX):])))
+    return json.loads(content)
+
+
+def load_graph(content: str):
+    return json_graph.node_link_graph(load_graph_data(content), edges="edges")
+
+
 def compute_args_hash(*args):
     return md5(str(args).encode()).hexdigest()
 
@@ -391,7 +459,12 @@ async def does_graph_contains(tenant_id, kb_id, doc_id):
     graph_doc_ids = set()
     for chunk_id in fields2.keys():
         graph_doc_ids = set(fields2[chunk_id]["source_id"])
-    return doc_id in graph_doc_ids
+    if doc_id in graph_doc_ids:
+        return True
+    # merged as a delta since the last snapshot
+    condition = {"knowledge_graph_kwd": ["subgraph"], "source_id": doc_id}
+    res = await trio.to_thread.run_sync(lambda: settings.docStoreConn.search(fields, [], condition, [], OrderByExpr(), 0, 1, search.index_name(tenant_id), [kb_id]))
+    return settings.docStoreConn.getTotal(res) > 0
 
 async def get_graph_doc_ids(tenant_id, kb_id) -> list[str]:
     conds = {
@@ -409,30 +482,162 @@ async def get_graph_doc_ids(tenant_id, kb_id) -> list[str]:
     return doc_ids
 
 
-async def get_graph(tenant_id, kb_id):
+def _graph_version_key(kb_id):
+    return f"graphrag:graph_version:{kb_id}"
+
+
+@asynccontextmanager
+async def graph_lock(kb_id):
+    """Serializes the writers of the graph of a KB across task executors."""
+    lock = RedisDistributedLock(f"graphrag:graph_lock:{kb_id}", timeout=GRAPH_LOCK_TIMEOUT, blocking_timeout=GRAPH_LOCK_TIMEOUT)
+    if not await trio.to_thread.run_sync(lock.acquire):
+        raise Exception(f"Can't lock the graph of kb {kb_id} within {GRAPH_LOCK_TIMEOUT} seconds")
+    try:
+        yield
+    finally:
+        try:
+            lock.release()
+        except Exception as e:
+            logging.warning(f"graph_lock of {kb_id} released after expiring: {e}")
+
+
+def _load_snapshot(tenant_id, kb_id):
     conds = {
         "fields": ["content_with_weight", "source_id"],
         "removed_kwd": "N",
         "size": 1,
         "knowledge_graph_kwd": ["graph"]
     }
-    res = await trio.to_thread.run_sync(lambda: settings.retrievaler.search(conds, search.index_name(tenant_id), [kb_id]))
+    res = settings.retrievaler.search(conds, search.index_name(tenant_id), [kb_id])
     if res.total == 0:
-        return None, []
+        return None, set()
     for id in res.ids:
         try:
-            return json_graph.node_link_graph(json.loads(res.field[id]["content_with_weight"]), edges="edges"), \
-                   res.field[id]["source_id"]
+            return load_graph(res.field[id]["content_with_weight"]), set(res.field[id]["source_id"])
         except Exception:
+            logging.exception(f"Graph snapshot of kb {kb_id} can't be loaded, rebuilding it")
             continue
-    result = await rebuild_graph(tenant_id, kb_id)
-    return result
+    graph, src_ids = _rebuild_graph(tenant_id, kb_id)
+    return graph, set(src_ids or [])
+
+
+def _graph_lock(key):
+    with _graph_cache_lock:
+        return _graph_locks.setdefault(key, threading.RLock())
+
+
+def _load_graph(tenant_id, kb_id, deltas=None):
+    # Merging deltas modifies the cached graph in place: one thread at a time per KB.
+    key = (tenant_id, kb_id)
+    with _graph_lock(key):
+        return _load_graph_locked(key, tenant_id, kb_id, deltas)
+
+
+def _load_graph_locked(key, tenant_id, kb_id, deltas=None):
+    """`deltas`: {doc_id: subgraph} just written, which the doc store may not show yet."""
+    version = REDIS_CONN.get(_graph_version_key(kb_id))
+    with _graph_cache_lock:
+        if version:
+            cached = _graph_cache.get(key)
+        else:
+            # The snapshot was dropped or modified (see invalidate_graph), or Redis lost the
+            # version: the cached graph can't be trusted.
+            _graph_cache.pop(key, None)
+            cached = None
+    if cached and cached[0] == version:
+        _, graph, doc_ids, snapshot_doc_ids = cached
+    else:
+        graph, snapshot_doc_ids = _load_snapshot(tenant_id, kb_id)
+        doc_ids = set(snapshot_doc_ids)
+
+    # Deltas are listed by document id only; contents are fetched for the unseen ones.
+    idxnm = search.index_name(tenant_id)
+    delta_doc_ids = set()
+    for d in settings.docStoreConn.scan(["source_id"], {"knowledge_graph_kwd": ["subgraph"]}, idxnm, [kb_id]):
+        delta_doc_ids.update(d.get("source_id", []))
+    unseen = delta_doc_ids - doc_ids
+    if unseen:
+        for d in settings.docStoreConn.scan(["content_with_weight", "source_id"],
+                                            {"knowledge_graph_kwd": ["subgraph"], "source_id": list(unseen)}, idxnm, [kb_id]):
+            try:
+                subgraph = load_graph(d["content_with_weight"])
+            except Exception:
+                logging.exception(f"Subgraph {d.get('id')} of kb {kb_id} can't be loaded")
+                continue
+            graph = subgraph if graph is None else merge_subgraph(graph, subgraph)
+            doc_ids.update(d.get("source_id", []))
+    for doc_id, subgraph in (deltas or {}).items():
+        if doc_id not in doc_ids:
+            graph = subgraph.copy() if graph is None else merge_subgraph(graph, subgraph)
+            doc_ids.add(doc_id)
+
+    if graph is not None and version:
+        with _graph_cache_lock:
+            _graph_cache[key] = (version, graph, doc_ids, snapshot_doc_ids)
+    return graph, doc_ids, snapshot_doc_ids
+
+
+def load_kb_graph(tenant_id, kb_id, deltas=None):
+    graph, doc_ids, _ = _load_graph(tenant_id, kb_id, deltas)
+    if graph is None:
+        return None, []
+    return graph, list(doc_ids)
+
+
+def load_kb_graph_data(tenant_id, kb_id) -> dict | None:
+    """
+    Node-link data of the KB graph for the API server, None if there is none. It is serialized
+    under the lock of the graph: request threads never share the cached graph itself.
+    """
+    key = (tenant_id, kb_id)
+    with _graph_lock(key):
+        graph, _, _ = _load_graph_locked(key, tenant_id, kb_id)
+        if graph is None:
+            return None
+        # through the stored form, which turns the numpy attribute values into plain ones
+        return load_graph_data(dump_graph(graph))
+
+
+async def get_graph(tenant_id, kb_id, deltas=None):
+    """
+    The KB graph: the last snapshot with the subgraphs of the documents merged since applied on top.
+    The graph stays in memory along with the version of its snapshot, so later calls only fetch
+    and merge the subgraphs they have not seen. `deltas` ({doc_id: subgraph}) are the subgraphs the
+    caller just wrote, merged if the doc store doesn't show them yet (it refreshes asynchronously).
+    Returns (graph, doc_ids), (None, []) if there is none.
+    """
+    return await trio.to_thread.run_sync(lambda: load_kb_graph(tenant_id, kb_id, deltas))
+
+
+def forget_graph(tenant_id, kb_id):
+    """Drop the in-memory graph of a KB, for callers about to modify it in place."""
+    with _graph_cache_lock:
+        _graph_cache.pop((tenant_id, kb_id), None)
+
+
+def invalidate_graph(kb_id):
+    """
+    Drop the snapshot version of a KB, after its graph chunks were removed or modified out of
+    set_graph: every process then reloads the graph instead of merging deltas into its cached one.
+    """
+    REDIS_CONN.delete(_graph_version_key(kb_id))
+    with _graph_cache_lock:
+        for key in [key for key in _graph_cache.keys() if key[1] == kb_id]:
+            _graph_cache.pop(key, None)
+
+
+async def compact_graph(tenant_id, kb_id, force=False, deltas=None):
+    """Write a new snapshot once GRAPH_SNAPSHOT_DELTAS documents were merged since the last one."""
+    graph, doc_ids, snapshot_doc_ids = await trio.to_thread.run_sync(lambda: _load_graph(tenant_id, kb_id, deltas))
+    if graph is None or (not force and len(doc_ids - snapshot_doc_ids) < GRAPH_SNAPSHOT_DELTAS):
+        return False
+    await set_graph(tenant_id, kb_id, graph, doc_ids)
+    return True
 
 
 async def set_graph(tenant_id, kb_id, graph, docids):
     chunk = {
-        "content_with_weight": json.dumps(nx.node_link_data(graph, edges="edges"), ensure_ascii=False,
-                                          indent=2),
+        "content_with_weight": dump_graph(graph),
         "knowledge_graph_kwd": "graph",
         "kb_id": kb_id,
         "source_id": list(docids),
@@ -445,6 +650,10 @@ async def set_graph(tenant_id, kb_id, graph, docids):
                                      search.index_name(tenant_id), kb_id))
     else:
         await trio.to_thread.run_sync(lambda: settings.docStoreConn.insert([{"id": chunk_id(chunk), **chunk}], search.index_name(tenant_id), kb_id))
+    version = uuid.uuid4().hex
+    REDIS_CONN.set(_graph_version_key(kb_id), version, 30 * 24 * 3600)
+    with _graph_cache_lock:
+        _graph_cache[(tenant_id, kb_id)] = (version, graph, set(docids), set(docids))
 
 
 def is_continuous_subsequence(subseq, seq):
@@ -489,6 +698,61 @@ def merge_tuples(list1, list2):
     return result
 
 
+def pagerank(graph, alpha=0.85, nstart=None, max_iter=100, tol=1.0e-6):
+    """
+    Power iteration over the weighted, row normalized SciPy sparse adjacency matrix, as nx.pagerank
+    does, warm started from `nstart` (the ranks of the previous run) so that a graph grown by a few
+    documents converges in a few iterations.
+    """
+    nodes = list(graph)
+    N = len(nodes)
+    if N == 0:
+        return {}
+    A = nx.to_scipy_sparse_array(graph, nodelist=nodes, weight="weight", dtype=float)
+    S = A.sum(axis=1)
+    S[S != 0] = 1.0 / S[S != 0]
+    A = scipy.sparse.csr_array(scipy.sparse.diags(S) @ A)
+    dangling = S == 0
+    p = np.repeat(1.0 / N, N)
+
+    x = p
+    if nstart:
+        x = np.array([nstart.get(n, 1.0 / N) for n in nodes], dtype=float)
+        x /= x.sum()
+    for _ in range(max_iter):
+        xlast = x
+        x = alpha * (x @ A + x[dangling].sum() * p) + (1 - alpha) * p
+        if np.abs(x - xlast).sum() < N * tol:
+            break
+    else:
+        logging.warning(f"pagerank didn't converge in {max_iter} iterations")
+    return dict(zip(nodes, map(float, x)))
+
+
+def write_entity_ranks(tenant_id, kb_id, ranks: dict) -> list[str]:
+    """Bulk partial update of rank_flt of the entity chunks, addressed by chunk id. Returns the entities written."""
+    if not ranks:
+        return []
+    idxnm = search.index_name(tenant_id)
+    names = list(ranks.keys())
+    updates, written = {}, []
+    for i in range(0, len(names), 1024):
+        for d in settings.docStoreConn.scan(["entity_kwd"], {"knowledge_graph_kwd": ["entity"], "entity_kwd": names[i: i + 1024]}, idxnm, [kb_id]):
+            n = d.get("entity_kwd")
+            if n not in ranks:
+                continue
+            updates[d["id"]] = {"rank_flt": ranks[n], "n_hop_with_weight": json.dumps(n, ensure_ascii=False)}
+            written.append(n)
+    errors = []
+    ids = list(updates.keys())
+    for i in range(0, len(ids), 1024):
+        errors.extend(settings.docStoreConn.updateBulk({id: updates[id] for id in ids[i: i + 1024]}, idxnm, kb_id))
+    if errors:
+        logging.warning(f"write_entity_ranks of kb {kb_id}: {len(errors)} errors, first: {errors[0]}")
+        return []
+    return written
+
+
 async def update_nodes_pagerank_nhop_neighbour(tenant_id, kb_id, graph, n_hop):
     def n_neighbor(id):
         nonlocal graph, n_hop
@@ -515,15 +779,18 @@ async def update_nodes_pagerank_nhop_neighbour(tenant_id, kb_id, graph, n_hop):
             nbrs.append(n)
         return nbrs
 
-    pr = nx.pagerank(graph)
+    pr = pagerank(graph, nstart={n: a["pagerank"] for n, a in graph.nodes(data=True) if "pagerank" in a})
+    # rank_flt holds the value last written to the entity chunk
+    changed = {}
+    for n, p in pr.items():
+        graph.nodes[n]["pagerank"] = p
+        written = graph.nodes[n].get("rank_flt")
+        if written is None or abs(p - written) > PAGERANK_WRITE_TOLERANCE * max(written, 1. / len(pr)):
+            changed[n] = p
     try:
-        async with trio.open_nursery() as nursery:
-            for n, p in pr.items():
-                graph.nodes[n]["pagerank"] = p
-                nursery.start_soon(lambda: trio.to_thread.run_sync(lambda: settings.docStoreConn.update({"entity_kwd": n, "kb_id": kb_id},
-                                                {"rank_flt": p,
-                                                "n_hop_with_weight": json.dumps((n), ensure_ascii=False)},
-                                                search.index_name(tenant_id), kb_id)))
+        written = await trio.to_thread.run_sync(lambda: write_entity_ranks(tenant_id, kb_id, changed))
+        for n in written:
+            graph.nodes[n]["rank_flt"] = changed[n]
     except Exception as e:
         logging.exception(e)
 
@@ -582,35 +849,24 @@ def flat_uniq_list(arr, key):
     return list(set(res))
 
 
-async def rebuild_graph(tenant_id, kb_id):
-    graph = nx.Graph()
-    src_ids = []
+def _rebuild_graph(tenant_id, kb_id):
     flds = ["entity_kwd", "entity_type_kwd", "from_entity_kwd", "to_entity_kwd", "weight_int", "knowledge_graph_kwd", "source_id"]
-    bs = 256
-    for i in range(0, 39*bs, bs):
-        es_res = await trio.to_thread.run_sync(lambda: settings.docStoreConn.search(flds, [],
-                                 {"kb_id": kb_id, "knowledge_graph_kwd": ["entity", "relation"]},
-                                 [],
-                                 OrderByExpr(),
-                                 i, bs, search.index_name(tenant_id), [kb_id]
-                                 ))
-        tot = settings.docStoreConn.getTotal(es_res)
-        if tot == 0:
-            return None, None
-
-        es_res = settings.docStoreConn.getFields(es_res, flds)
-        for id, d in es_res.items():
-            src_ids.extend(d.get("source_id", []))
-            if d["knowledge_graph_kwd"] == "entity":
-                graph.add_node(d["entity_kwd"], entity_type=d["entity_type_kwd"])
-            elif "from_entity_kwd" in d and "to_entity_kwd" in d:
-                graph.add_edge(
-                    d["from_entity_kwd"],
-                    d["to_entity_kwd"],
-                    weight=int(d["weight_int"])
-                )
-
-        if len(es_res.keys()) < 128:
-            return graph, list(set(src_ids))
-
-    return graph, list(set(src_ids))
+    graph = nx.Graph()
+    src_ids = set()
+    for d in settings.docStoreConn.scan(flds, {"knowledge_graph_kwd": ["entity", "relation"]}, search.index_name(tenant_id), [kb_id]):
+        src_ids.update(d.get("source_id", []))
+        if d["knowledge_graph_kwd"] == "entity":
+            graph.add_node(d["entity_kwd"], entity_type=d["entity_type_kwd"])
+        elif "from_entity_kwd" in d and "to_entity_kwd" in d:
+            graph.add_edge(
+                d["from_entity_kwd"],
+                d["to_entity_kwd"],
+                weight=int(d["weight_int"])
+            )
+    if not graph.number_of_nodes() and not src_ids:
+        return None, None
+    return graph, list(src_ids)
+
+
+async def rebuild_graph(tenant_id, kb_id):
+    return await trio.to_thread.run_sync(lambda: _rebuild_graph(tenant_id, kb_id))
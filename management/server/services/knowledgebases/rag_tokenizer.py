@@ -10,6 +10,10 @@ from hanziconv import HanziConv
 from nltk import word_tokenize
 from nltk.stem import PorterStemmer, WordNetLemmatizer
 
+from .mmap_dict import MmapDict
+
+TOKENIZER_MMAP_DICT = int(os.environ.get("TOKENIZER_MMAP_DICT", "0"))
+
 
 class RagTokenizer:
     def key_(self, line):
@@ -50,7 +54,26 @@ class RagTokenizer:
 
         self.SPLIT_CHAR = r"([ ,\.<>/?;:'\[\]\\`!@#$%^&*\(\)\{\}\|_+=《》，。？、；‘’：“”【】~！￥%……（）——-]+|[a-zA-Z0-9,\.-]+)"
 
-        trie_file_name = self.DIR_ + ".txt.trie"
+        dict_file_name = self.DIR_ + ".txt.dict"
+        if TOKENIZER_MMAP_DICT and os.path.exists(dict_file_name):
+            try:
+                # 映射只读共享词典，进程内不再复制一份
+                self.trie_ = MmapDict.load(dict_file_name)
+                return
+            except Exception:
+                logging.exception(f"[HUQIE]:Fail to load dict file {dict_file_name}, fall back to the trie file")
+
+        self.loadTrie_(self.DIR_ + ".txt")
+        if TOKENIZER_MMAP_DICT:
+            try:
+                print(f"[HUQIE]:Build dict file {dict_file_name}")
+                MmapDict.build(self.trie_.items(), dict_file_name)
+                self.trie_ = MmapDict.load(dict_file_name)
+            except Exception:
+                logging.exception(f"[HUQIE]:Build dict file {dict_file_name} failed")
+
+    def loadTrie_(self, fnm):
+        trie_file_name = fnm + ".trie"
         # check if trie file existence
         if os.path.exists(trie_file_name):
             try:
@@ -67,7 +90,7 @@ class RagTokenizer:
             self.trie_ = datrie.Trie(string.printable)
 
         # load data from dict file and save to trie file
-        self.loadDict_(self.DIR_ + ".txt")
+        self.loadDict_(fnm)
 
     def _strQ2B(self, ustring):
         """全角转半角，转小写"""
@@ -156,22 +156,23 @@ def label_question(question, kbs):
 
     # 如果存在标签知识库ID，则进一步处理
     if tag_kb_ids:
+        # 根据标签知识库ID获取对应的标签知识库
+        tag_kbs = KnowledgebaseService.get_by_ids_cached(tag_kb_ids)
+        tenant_ids = list(set([kb.tenant_id for kb in tag_kbs]))
+        topn_tags = kb.parser_config.get("topn_tags", 3)
+
         # 尝试从缓存中获取所有标签
         all_tags = get_tags_from_cache(tag_kb_ids)
 
-        # 如果缓存中没有标签，从设置中检索标签，并设置缓存
+        # 如果缓存中没有标签，标签分布与问题标签在一次批量检索中得到，并设置缓存
         if not all_tags:
-            all_tags = settings.retrievaler.all_tags_in_portion(kb.tenant_id, tag_kb_ids)
+            all_tags, tags = settings.retrievaler.tag_question(question, kb.tenant_id, tenant_ids, tag_kb_ids, topn_tags)
             set_tags_to_cache(all_tags, tag_kb_ids)
         else:
             # 如果缓存中获取到标签，将其解析为JSON格式
             all_tags = json.loads(all_tags)
-
-        # 根据标签知识库ID获取对应的标签知识库
-        tag_kbs = KnowledgebaseService.get_by_ids(tag_kb_ids)
-
-        # 使用设置中的检索器对问题进行标签标记
-        tags = settings.retrievaler.tag_query(question, list(set([kb.tenant_id for kb in tag_kbs])), tag_kb_ids, all_tags, kb.parser_config.get("topn_tags", 3))
+            # 使用设置中的检索器对问题进行标签标记
+            tags = settings.retrievaler.tag_query(question, tenant_ids, tag_kb_ids, all_tags, topn_tags)
 
     # 返回标记的标签
     return tags
@@ -23,7 +23,7 @@ from openai import OpenAI
 import openai
 from ollama import Client
 from rag.nlp import is_chinese, is_english
-from rag.utils import num_tokens_from_string
+from rag.utils import TokenCounter, num_tokens_from_string
 import os
 import json
 import requests
@@ -67,7 +67,7 @@ class Base(ABC):
         if "max_tokens" in gen_conf:
             del gen_conf["max_tokens"]
         ans = ""
-        total_tokens = 0
+        token_counter = TokenCounter()
         try:
             response = self.client.chat.completions.create(
                 model=self.model_name,
@@ -87,11 +87,7 @@ class Base(ABC):
                 else:
                     ans += resp.choices[0].delta.content
 
-                tol = self.total_token_count(resp)
-                if not tol:
-                    total_tokens += num_tokens_from_string(resp.choices[0].delta.content)
-                else:
-                    total_tokens = tol
+                token_counter.add(resp.choices[0].delta.content, self.total_token_count(resp))
 
                 if resp.choices[0].finish_reason == "length":
                     if is_chinese(ans):
@@ -103,7 +99,7 @@ class Base(ABC):
         except openai.APIError as e:
             yield ans + "\n**ERROR**: " + str(e)
 
-        yield total_tokens
+        yield token_counter.total(ans)
 
     def total_token_count(self, resp):
         try:
@@ -223,7 +219,7 @@ class BaiChuanChat(Base):
         if "max_tokens" in gen_conf:
             del gen_conf["max_tokens"]
         ans = ""
-        total_tokens = 0
+        token_counter = TokenCounter()
         try:
             response = self.client.chat.completions.create(
                 model=self.model_name,
@@ -245,11 +241,7 @@ class BaiChuanChat(Base):
                 if not resp.choices[0].delta.content:
                     resp.choices[0].delta.content = ""
                 ans += resp.choices[0].delta.content
-                tol = self.total_token_count(resp)
-                if not tol:
-                    total_tokens += num_tokens_from_string(resp.choices[0].delta.content)
-                else:
-                    total_tokens = tol
+                token_counter.add(resp.choices[0].delta.content, self.total_token_count(resp))
                 if resp.choices[0].finish_reason == "length":
                     if is_chinese([ans]):
                         ans += LENGTH_NOTIFICATION_CN
@@ -260,7 +252,7 @@ class BaiChuanChat(Base):
         except Exception as e:
             yield ans + "\n**ERROR**: " + str(e)
 
-        yield total_tokens
+        yield token_counter.total(ans)
 
 
 class QWenChat(Base):
@@ -642,7 +634,7 @@ class MiniMaxChat(Base):
             if k not in ["temperature", "top_p", "max_tokens"]:
                 del gen_conf[k]
         ans = ""
-        total_tokens = 0
+        token_counter = TokenCounter()
         try:
             headers = {
                 "Authorization": f"Bearer {self.api_key}",
@@ -668,17 +660,13 @@ class MiniMaxChat(Base):
                 if "choices" in resp and "delta" in resp["choices"][0]:
                     text = resp["choices"][0]["delta"]["content"]
                 ans += text
-                tol = self.total_token_count(resp)
-                if not tol:
-                    total_tokens += num_tokens_from_string(text)
-                else:
-                    total_tokens = tol
+                token_counter.add(text, self.total_token_count(resp))
                 yield ans
 
         except Exception as e:
             yield ans + "\n**ERROR**: " + str(e)
 
-        yield total_tokens
+        yield token_counter.total(ans)
 
 
 class MistralChat(Base):
@@ -1061,7 +1049,7 @@ class CoHereChat(Base):
                 item["message"] = item.pop("content")
         mes = history.pop()["message"]
         ans = ""
-        total_tokens = 0
+        token_counter = TokenCounter()
         try:
             response = self.client.chat_stream(
                 model=self.model_name, chat_history=history, message=mes, **gen_conf
@@ -1069,7 +1057,7 @@ class CoHereChat(Base):
             for resp in response:
                 if resp.event_type == "text-generation":
                     ans += resp.text
-                    total_tokens += num_tokens_from_string(resp.text)
+                    token_counter.add(resp.text)
                 elif resp.event_type == "stream-end":
                     if resp.finish_reason == "MAX_TOKENS":
                         ans += (
@@ -1082,7 +1070,7 @@ class CoHereChat(Base):
         except Exception as e:
             yield ans + "\n**ERROR**: " + str(e)
 
-        yield total_tokens
+        yield token_counter.total(ans)
 
 
 class LeptonAIChat(Base):
@@ -1406,7 +1394,8 @@ class AnthropicChat(Base):
             del gen_conf["frequency_penalty"]
 
         ans = ""
-        total_tokens = 0
+        token_counter = TokenCounter()
+        input_tokens = 0
         try:
             response = self.client.messages.create(
                 model=self.model_name,
@@ -1416,15 +1405,19 @@ class AnthropicChat(Base):
                 **gen_conf,
             )
             for res in response:
-                if res.type == 'content_block_delta':
+                if res.type == 'message_start':
+                    input_tokens = res.message.usage.input_tokens
+                elif res.type == 'message_delta':
+                    token_counter.add(usage=input_tokens + res.usage.output_tokens)
+                elif res.type == 'content_block_delta':
                     text = res.delta.text
                     ans += text
-                    total_tokens += num_tokens_from_string(text)
+                    token_counter.add(text)
                     yield ans
         except Exception as e:
             yield ans + "\n**ERROR**: " + str(e)
 
-        yield total_tokens
+        yield token_counter.total(ans)
 
 
 class GoogleChat(Base):
@@ -1532,7 +1525,7 @@ class GoogleChat(Base):
             if "max_tokens" in gen_conf:
                 del gen_conf["max_tokens"]
             ans = ""
-            total_tokens = 0
+            token_counter = TokenCounter()
             try:
                 response = self.client.messages.create(
                     model=self.model_name,
@@ -1546,11 +1539,11 @@ class GoogleChat(Base):
                     if "content_block_delta" in res and "data" in res:
                         text = json.loads(res[6:])["delta"]["text"]
                         ans += text
-                        total_tokens += num_tokens_from_string(text)
+                        token_counter.add(text)
             except Exception as e:
                 yield ans + "\n**ERROR**: " + str(e)
 
-            yield total_tokens
+            yield token_counter.total(ans)
         else:
             self.client._system_instruction = self.system
             if "max_tokens" in gen_conf:
@@ -35,6 +35,12 @@ import json
 
 
 class Base(ABC):
+    # Provider limits used to plan embedding batches: inputs per encode() request,
+    # tokens per input, and tokens per request (0 means the provider has no such cap).
+    max_batch_size = 16
+    max_tokens = 8191
+    max_batch_tokens = 0
+
     def __init__(self, key, model_name):
         pass
 
@@ -57,6 +63,7 @@ class Base(ABC):
 
 
 class DefaultEmbedding(Base):
+    max_tokens = 2048
     _model = None
     _model_name = ""
     _model_lock = threading.Lock()
@@ -94,8 +101,8 @@ class DefaultEmbedding(Base):
         self._model_name = DefaultEmbedding._model_name
 
     def encode(self, texts: list):
-        batch_size = 16
-        texts = [truncate(t, 2048) for t in texts]
+        batch_size = self.max_batch_size
+        texts = [truncate(t, self.max_tokens) for t in texts]
         token_count = 0
         for t in texts:
             token_count += num_tokens_from_string(t)
@@ -110,6 +117,8 @@ class DefaultEmbedding(Base):
 
 
 class OpenAIEmbed(Base):
+    max_batch_tokens = 300000
+
     def __init__(self, key, model_name="text-embedding-ada-002",
                  base_url="https://api.openai.com/v1"):
         if not base_url:
@@ -119,8 +128,8 @@ class OpenAIEmbed(Base):
 
     def encode(self, texts: list):
         # OpenAI requires batch size <=16
-        batch_size = 16
-        texts = [truncate(t, 8191) for t in texts]
+        batch_size = self.max_batch_size
+        texts = [truncate(t, self.max_tokens) for t in texts]
         ress = []
         total_tokens = 0
         for i in range(0, len(texts), batch_size):
@@ -131,7 +140,7 @@ class OpenAIEmbed(Base):
         return np.array(ress), total_tokens
 
     def encode_queries(self, text):
-        res = self.client.embeddings.create(input=[truncate(text, 8191)],
+        res = self.client.embeddings.create(input=[truncate(text, self.max_tokens)],
                                             model=self.model_name)
         return np.array(res.data[0].embedding), self.total_token_count(res)
 
@@ -146,7 +155,7 @@ class LocalAIEmbed(Base):
         self.model_name = model_name.split("___")[0]
 
     def encode(self, texts: list):
-        batch_size = 16
+        batch_size = self.max_batch_size
         ress = []
         for i in range(0, len(texts), batch_size):
             res = self.client.embeddings.create(input=texts[i:i + batch_size], model=self.model_name)
@@ -178,17 +187,20 @@ class BaiChuanEmbed(OpenAIEmbed):
 
 
 class QWenEmbed(Base):
+    max_batch_size = 4
+    max_tokens = 2048
+
     def __init__(self, key, model_name="text_embedding_v2", **kwargs):
         self.key = key
         self.model_name = model_name
 
     def encode(self, texts: list):
         import dashscope
-        batch_size = 4
+        batch_size = self.max_batch_size
         try:
             res = []
             token_count = 0
-            texts = [truncate(t, 2048) for t in texts]
+            texts = [truncate(t, self.max_tokens) for t in texts]
             for i in range(0, len(texts), batch_size):
                 resp = dashscope.TextEmbedding.call(
                     model=self.model_name,
@@ -210,7 +222,7 @@ class QWenEmbed(Base):
         try:
             resp = dashscope.TextEmbedding.call(
                 model=self.model_name,
-                input=text[:2048],
+                input=truncate(text, self.max_tokens),
                 api_key=self.key,
                 text_type="query"
             )
@@ -225,17 +237,15 @@ class ZhipuEmbed(Base):
     def __init__(self, key, model_name="embedding-2", **kwargs):
         self.client = ZhipuAI(api_key=key)
         self.model_name = model_name
+        if self.model_name.lower() == "embedding-2":
+            self.max_tokens = 512
+        if self.model_name.lower() == "embedding-3":
+            self.max_tokens = 3072
 
     def encode(self, texts: list):
         arr = []
         tks_num = 0
-        MAX_LEN = -1
-        if self.model_name.lower() == "embedding-2":
-            MAX_LEN = 512
-        if self.model_name.lower() == "embedding-3":
-            MAX_LEN = 3072
-        if MAX_LEN > 0:
-            texts = [truncate(t, MAX_LEN) for t in texts]
+        texts = [truncate(t, self.max_tokens) for t in texts]
 
         for txt in texts:
             res = self.client.embeddings.create(input=txt,
@@ -324,7 +334,7 @@ class XinferenceEmbed(Base):
         self.model_name = model_name
 
     def encode(self, texts: list):
-        batch_size = 16
+        batch_size = self.max_batch_size
         ress = []
         total_tokens = 0
         for i in range(0, len(texts), batch_size):
@@ -340,6 +350,8 @@ class XinferenceEmbed(Base):
 
 
 class YoudaoEmbed(Base):
+    max_batch_size = 10
+    max_tokens = 512
     _client = None
 
     def __init__(self, key=None, model_name="maidalun1020/bce-embedding-base_v1", **kwargs):
@@ -356,7 +368,7 @@ class YoudaoEmbed(Base):
                         "maidalun1020", "InfiniFlow"))
 
     def encode(self, texts: list):
-        batch_size = 10
+        batch_size = self.max_batch_size
         res = []
         token_count = 0
         for t in texts:
@@ -372,6 +384,8 @@ class YoudaoEmbed(Base):
 
 
 class JinaEmbed(Base):
+    max_tokens = 8192
+
     def __init__(self, key, model_name="jina-embeddings-v3",
                  base_url="https://api.jina.ai/v1/embeddings"):
 
@@ -383,8 +397,8 @@ class JinaEmbed(Base):
         self.model_name = model_name
 
     def encode(self, texts: list):
-        texts = [truncate(t, 8196) for t in texts]
-        batch_size = 16
+        texts = [truncate(t, self.max_tokens) for t in texts]
+        batch_size = self.max_batch_size
         ress = []
         token_count = 0
         for i in range(0, len(texts), batch_size):
@@ -444,6 +458,8 @@ class InfinityEmbed(Base):
 
 
 class MistralEmbed(Base):
+    max_tokens = 8192
+
     def __init__(self, key, model_name="mistral-embed",
                  base_url=None):
         from mistralai.client import MistralClient
@@ -451,8 +467,8 @@ class MistralEmbed(Base):
         self.model_name = model_name
 
     def encode(self, texts: list):
-        texts = [truncate(t, 8196) for t in texts]
-        batch_size = 16
+        texts = [truncate(t, self.max_tokens) for t in texts]
+        batch_size = self.max_batch_size
         ress = []
         token_count = 0
         for i in range(0, len(texts), batch_size):
@@ -463,12 +479,14 @@ class MistralEmbed(Base):
         return np.array(ress), token_count
 
     def encode_queries(self, text):
-        res = self.client.embeddings(input=[truncate(text, 8196)],
+        res = self.client.embeddings(input=[truncate(text, self.max_tokens)],
                                             model=self.model_name)
         return np.array(res.data[0].embedding), self.total_token_count(res)
 
 
 class BedrockEmbed(Base):
+    max_tokens = 8192
+
     def __init__(self, key, model_name,
                  **kwargs):
         import boto3
@@ -485,7 +503,7 @@ class BedrockEmbed(Base):
                                     aws_access_key_id=self.bedrock_ak, aws_secret_access_key=self.bedrock_sk)
 
     def encode(self, texts: list):
-        texts = [truncate(t, 8196) for t in texts]
+        texts = [truncate(t, self.max_tokens) for t in texts]
         embeddings = []
         token_count = 0
         for text in texts:
@@ -505,9 +523,9 @@ class BedrockEmbed(Base):
         embeddings = []
         token_count = num_tokens_from_string(text)
         if self.model_name.split('.')[0] == 'amazon':
-            body = {"inputText": truncate(text, 8196)}
+            body = {"inputText": truncate(text, self.max_tokens)}
         elif self.model_name.split('.')[0] == 'cohere':
-            body = {"texts": [truncate(text, 8196)], "input_type": 'search_query'}
+            body = {"texts": [truncate(text, self.max_tokens)], "input_type": 'search_query'}
 
         response = self.client.invoke_model(modelId=self.model_name, body=json.dumps(body))
         model_response = json.loads(response["body"].read())
@@ -517,16 +535,18 @@ class BedrockEmbed(Base):
 
 
 class GeminiEmbed(Base):
+    max_tokens = 2048
+
     def __init__(self, key, model_name='models/text-embedding-004',
                  **kwargs):
         self.key = key
         self.model_name = 'models/' + model_name
         
     def encode(self, texts: list):
-        texts = [truncate(t, 2048) for t in texts]
+        texts = [truncate(t, self.max_tokens) for t in texts]
         token_count = sum(num_tokens_from_string(text) for text in texts)
         genai.configure(api_key=self.key)
-        batch_size = 16
+        batch_size = self.max_batch_size
         ress = []
         for i in range(0, len(texts), batch_size):
             result = genai.embed_content(
@@ -541,7 +561,7 @@ class GeminiEmbed(Base):
         genai.configure(api_key=self.key)
         result = genai.embed_content(
             model=self.model_name,
-            content=truncate(text,2048),
+            content=truncate(text, self.max_tokens),
             task_type="retrieval_document",
             title="Embedding of single string")
         token_count = num_tokens_from_string(text)
@@ -569,7 +589,7 @@ class NvidiaEmbed(Base):
             self.base_url = "https://ai.api.nvidia.com/v1/retrieval/snowflake/arctic-embed-l/embeddings"
 
     def encode(self, texts: list):
-        batch_size = 16
+        batch_size = self.max_batch_size
         ress = []
         token_count = 0
         for i in range(0, len(texts), batch_size):
@@ -618,7 +638,7 @@ class CoHereEmbed(Base):
         self.model_name = model_name
 
     def encode(self, texts: list):
-        batch_size = 16
+        batch_size = self.max_batch_size
         ress = []
         token_count = 0
         for i in range(0, len(texts), batch_size):
@@ -683,7 +703,7 @@ class SILICONFLOWEmbed(Base):
         self.model_name = model_name
 
     def encode(self, texts: list):
-        batch_size = 16
+        batch_size = self.max_batch_size
         ress = []
         token_count = 0
         for i in range(0, len(texts), batch_size):
@@ -728,7 +748,7 @@ class ReplicateEmbed(Base):
         self.client = Client(api_token=key)
 
     def encode(self, texts: list):
-        batch_size = 16
+        batch_size = self.max_batch_size
         token_count = sum([num_tokens_from_string(text) for text in texts])
         ress = []
         for i in range(0, len(texts), batch_size):
@@ -751,7 +771,7 @@ class BaiduYiyanEmbed(Base):
         self.client = qianfan.Embedding(ak=ak, sk=sk)
         self.model_name = model_name
 
-    def encode(self, texts: list, batch_size=16):
+    def encode(self, texts: list, batch_size=Base.max_batch_size):
         res = self.client.do(model=self.model_name, texts=texts).body
         return (
             np.array([r["embedding"] for r in res["data"]]),
@@ -774,7 +794,7 @@ class VoyageEmbed(Base):
         self.model_name = model_name
 
     def encode(self, texts: list):
-        batch_size = 16
+        batch_size = self.max_batch_size
         ress = []
         token_count = 0
         for i in range(0, len(texts), batch_size):
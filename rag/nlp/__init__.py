@@ -255,8 +255,18 @@ def tokenize(d, t, eng):
     d["content_sm_ltks"] = rag_tokenizer.fine_grained_tokenize(d["content_ltks"])
 
 
+def tokenize_many(ds, texts):
+    """tokenize() of every (d, t) pair, in one rag_tokenizer.tokenize_batch call."""
+    cleaned = [re.sub(r"</?(table|td|caption|tr|th)( [^<>]{0,12})?>", " ", t) for t in texts]
+    for d, t, (ltks, sm_ltks) in zip(ds, texts, rag_tokenizer.tokenize_batch(cleaned)):
+        d["content_with_weight"] = t
+        d["content_ltks"] = ltks
+        d["content_sm_ltks"] = sm_ltks
+
+
 def tokenize_chunks(chunks, doc, eng, pdf_parser=None):
     res = []
+    texts = []
     # wrap up as es documents
     for ck in chunks:
         if len(ck.strip()) == 0:
@@ -270,13 +280,15 @@ def tokenize_chunks(chunks, doc, eng, pdf_parser=None):
                 ck = pdf_parser.remove_tag(ck)
             except NotImplementedError:
                 pass
-        tokenize(d, ck, eng)
         res.append(d)
+        texts.append(ck)
+    tokenize_many(res, texts)
     return res
 
 
 def tokenize_chunks_docx(chunks, doc, eng, images):
     res = []
+    texts = []
     # wrap up as es documents
     for ck, image in zip(chunks, images):
         if len(ck.strip()) == 0:
@@ -284,8 +296,9 @@ def tokenize_chunks_docx(chunks, doc, eng, images):
         logging.debug("-- {}".format(ck))
         d = copy.deepcopy(doc)
         d["image"] = image
-        tokenize(d, ck, eng)
         res.append(d)
+        texts.append(ck)
+    tokenize_many(res, texts)
     return res
 
 
@@ -0,0 +1,164 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import mmap
+import os
+import struct
+import tempfile
+from array import array
+
+MAGIC = b"RAGDICT1"
+# magic, number of keys, number of tags, offset of the key blob, offset of the tag table
+HEADER = struct.Struct("<8sIIQQ")
+# Frequency stored for the reversed keys, which only mark existence and map to 1.
+MARKER = -(2**31)
+
+
+def _align(n: int) -> int:
+    return (n + 7) & ~7
+
+
+class MmapDict:
+    """
+    Read-only tokenizer dictionary backed by a single memory-mapped file, a drop-in replacement
+    for the subset of datrie.Trie used by RagTokenizer: `in`, `[]`, `get`, `has_keys_with_prefix`
+    and `items`.
+
+    Keys are stored sorted in one blob, with parallel offset, frequency and tag arrays; lookups
+    and prefix tests are binary searches over the mapping. Loading only maps the file, so every
+    process opening the same dictionary shares it read-only through the page cache.
+
+    Layout (arrays in native byte order, sections 8-byte aligned):
+        header | uint32 offsets[n + 1] | int32 freqs[n] | uint16 tags[n] | key blob | tag table
+    """
+
+    def __init__(self, fnm: str):
+        with open(fnm, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, n, tag_count, keys_offset, tags_offset = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{fnm} is not a tokenizer dictionary file")
+        view = memoryview(self._mm)
+        pos = _align(HEADER.size)
+        self._offsets = view[pos: pos + 4 * (n + 1)].cast("I")
+        pos = _align(pos + 4 * (n + 1))
+        self._freqs = view[pos: pos + 4 * n].cast("i")
+        pos = _align(pos + 4 * n)
+        self._tags = view[pos: pos + 2 * n].cast("H")
+        self._n = n
+        self._keys_offset = keys_offset
+        self._tag_names = bytes(self._mm[tags_offset:]).decode("utf-8").split("\n") if tag_count else []
+
+    @classmethod
+    def load(cls, fnm: str) -> "MmapDict":
+        return cls(fnm)
+
+    @staticmethod
+    def build(items, fnm: str):
+        """
+        Write (key, value) pairs as produced by datrie.Trie.items() to `fnm`. Values are either
+        (frequency, tag) or 1. The file is written aside and renamed, so concurrent readers never
+        see a partial dictionary.
+        """
+        entries = sorted((k.encode("utf-8"), v) for k, v in items)
+        tag_ids = {}
+        offsets, freqs, tags = array("I", [0]), array("i"), array("H")
+        blob = bytearray()
+        for k, v in entries:
+            blob += k
+            offsets.append(len(blob))
+            if isinstance(v, tuple):
+                freqs.append(int(v[0]))
+                tags.append(tag_ids.setdefault(v[1], len(tag_ids)))
+            else:
+                freqs.append(MARKER)
+                tags.append(0)
+        tag_table = "\n".join(sorted(tag_ids, key=tag_ids.get)).encode("utf-8")
+
+        sections = [offsets.tobytes(), freqs.tobytes(), tags.tobytes(), bytes(blob)]
+        pos = _align(HEADER.size)
+        starts = []
+        for s in sections:
+            starts.append(pos)
+            pos = _align(pos + len(s))
+        tags_offset = pos
+
+        d = os.path.dirname(os.path.abspath(fnm))
+        fd, tmp = tempfile.mkstemp(dir=d, prefix=os.path.basename(fnm), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(HEADER.pack(MAGIC, len(entries), len(tag_ids), starts[-1], tags_offset))
+                for start, s in zip(starts, sections):
+                    f.write(b"\0" * (start - f.tell()))
+                    f.write(s)
+                f.write(b"\0" * (tags_offset - f.tell()))
+                f.write(tag_table)
+            os.replace(tmp, fnm)
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def __len__(self):
+        return self._n
+
+    def _key(self, i: int) -> bytes:
+        return self._mm[self._keys_offset + self._offsets[i]: self._keys_offset + self._offsets[i + 1]]
+
+    def _lower_bound(self, k: bytes) -> int:
+        lo, hi = 0, self._n
+        while lo < hi:
+            mid = (lo + hi) >> 1
+            if self._key(mid) < k:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _index(self, key: str) -> int:
+        k = key.encode("utf-8")
+        i = self._lower_bound(k)
+        if i < self._n and self._key(i) == k:
+            return i
+        return -1
+
+    def _value(self, i: int):
+        f = self._freqs[i]
+        if f == MARKER:
+            return 1
+        return f, self._tag_names[self._tags[i]]
+
+    def __contains__(self, key: str) -> bool:
+        return self._index(key) >= 0
+
+    def __getitem__(self, key: str):
+        i = self._index(key)
+        if i < 0:
+            raise KeyError(key)
+        return self._value(i)
+
+    def get(self, key: str, default=None):
+        i = self._index(key)
+        return default if i < 0 else self._value(i)
+
+    def has_keys_with_prefix(self, prefix: str) -> bool:
+        k = prefix.encode("utf-8")
+        i = self._lower_bound(k)
+        return i < self._n and self._key(i).startswith(k)
+
+    def items(self):
+        for i in range(self._n):
+            yield self._key(i).decode("utf-8"), self._value(i)
@@ -16,11 +16,52 @@
 
 import logging
 import json
+import os
 import re
+import threading
+
+import numpy as np
+from cachetools import LRUCache
+
 from rag.utils.doc_store_conn import MatchTextExpr
 
 from rag.nlp import rag_tokenizer, term_weight, synonym
 
+QUESTION_CACHE_SIZE = int(os.environ.get("QUESTION_CACHE_SIZE", "4096"))
+
+SPECIAL_CHAR_RE = re.compile(r"([:\{\}/\[\]\-\*\"\(\)\|\+~\^])")
+BLANK_RE = re.compile(r"[ \t]+")
+ALPHA_WORD_RE = re.compile(r"[a-zA-Z]+$")
+WWW_RES = [
+    (
+        re.compile(
+            r"是*(什么样的|哪家|一下|那家|请问|啥样|咋样了|什么时候|何时|何地|何人|是否|是不是|多少|哪里|怎么|哪儿|怎么样|如何|哪些|是啥|啥是|啊|吗|呢|吧|咋|什么|有没有|呀|谁|哪位|哪个)是*",
+            re.IGNORECASE,
+        ),
+        "",
+    ),
+    (re.compile(r"(^| )(what|who|how|which|where|why)('re|'s)? ", re.IGNORECASE), " "),
+    (
+        re.compile(
+            r"(^| )('s|'re|is|are|were|was|do|does|did|don't|doesn't|didn't|has|have|be|there|you|me|your|my|mine|just|please|may|i|should|would|wouldn't|will|won't|done|go|for|with|so|the|a|an|by|i'm|it's|he's|she's|they|they're|you're|as|by|on|in|at|up|out|down|of|to|or|and|if) ",
+            re.IGNORECASE,
+        ),
+        " ",
+    ),
+]
+ENG_NUM_ZH_RE = re.compile(r"([A-Za-z]+[0-9]+)([\u4e00-\u9fa5]+)")
+ENG_ZH_RE = re.compile(r"([A-Za-z])([\u4e00-\u9fa5]+)")
+ZH_ENG_NUM_RE = re.compile(r"([\u4e00-\u9fa5]+)([A-Za-z]+[0-9]+)")
+ZH_ENG_RE = re.compile(r"([\u4e00-\u9fa5]+)([A-Za-z])")
+QUESTION_PUNCT_RE = re.compile(r"[ :|\r\n\t,，。？?/`!！&^%%()\[\]{}<>]+")
+TOKEN_QUOTE_RE = re.compile(r"[ \\\"'^]")
+SINGLE_ALNUM_RE = re.compile(r"^[a-z0-9]$")
+LEADING_SIGN_RE = re.compile(r"^[\+-]")
+QUERY_OPERATOR_RE = re.compile(r"[.^+\(\)-]")
+NO_FINE_GRAINED_RE = re.compile(r"[0-9a-z\.\+#_\*-]+$")
+PUNCT_RE = re.compile(r"[ ,\./;'\[\]\\`~!@#$%\^&\*\(\)=\+_<>\?:\"\{\}\|，。；‘’【】、！￥……（）——《》？：“”-]+")
+KEYWORD_QUOTE_RE = re.compile(r"[ \\\"']+")
+
 
 class FulltextQueryer:
     def __init__(self):
@@ -35,19 +76,21 @@ class FulltextQueryer:
             "content_ltks^2",
             "content_sm_ltks",
         ]
+        self._question_cache = LRUCache(maxsize=max(1, QUESTION_CACHE_SIZE))
+        self._question_lock = threading.Lock()
 
     @staticmethod
     def subSpecialChar(line):
-        return re.sub(r"([:\{\}/\[\]\-\*\"\(\)\|\+~\^])", r"\\\1", line).strip()
+        return SPECIAL_CHAR_RE.sub(r"\\\1", line).strip()
 
     @staticmethod
     def isChinese(line):
-        arr = re.split(r"[ \t]+", line)
+        arr = BLANK_RE.split(line)
         if len(arr) <= 3:
             return True
         e = 0
         for t in arr:
-            if not re.match(r"[a-zA-Z]+$", t):
+            if not ALPHA_WORD_RE.match(t):
                 e += 1
         return e * 1.0 / len(arr) >= 0.7
 
@@ -63,20 +106,9 @@ class FulltextQueryer:
         返回:
         - 处理后的文本字符串，如果所有疑问词都被移除且文本为空，则返回原始文本。
         """
-        patts = [
-            (
-                r"是*(什么样的|哪家|一下|那家|请问|啥样|咋样了|什么时候|何时|何地|何人|是否|是不是|多少|哪里|怎么|哪儿|怎么样|如何|哪些|是啥|啥是|啊|吗|呢|吧|咋|什么|有没有|呀|谁|哪位|哪个)是*",
-                "",
-            ),
-            (r"(^| )(what|who|how|which|where|why)('re|'s)? ", " "),
-            (
-                r"(^| )('s|'re|is|are|were|was|do|does|did|don't|doesn't|didn't|has|have|be|there|you|me|your|my|mine|just|please|may|i|should|would|wouldn't|will|won't|done|go|for|with|so|the|a|an|by|i'm|it's|he's|she's|they|they're|you're|as|by|on|in|at|up|out|down|of|to|or|and|if) ",
-                " ",
-            ),
-        ]
         otxt = txt
-        for r, p in patts:
-            txt = re.sub(r, p, txt, flags=re.IGNORECASE)
+        for r, p in WWW_RES:
+            txt = r.sub(p, txt)
         if not txt:
             txt = otxt
         return txt
@@ -96,12 +128,12 @@ class FulltextQueryer:
         str: 处理后的文本字符串，其中英文和中文之间添加了空格。
         """
         # (ENG/ENG+NUM) + ZH
-        txt = re.sub(r"([A-Za-z]+[0-9]+)([\u4e00-\u9fa5]+)", r"\1 \2", txt)
+        txt = ENG_NUM_ZH_RE.sub(r"\1 \2", txt)
         # ENG + ZH
-        txt = re.sub(r"([A-Za-z])([\u4e00-\u9fa5]+)", r"\1 \2", txt)
+        txt = ENG_ZH_RE.sub(r"\1 \2", txt)
         # ZH + (ENG/ENG+NUM)
-        txt = re.sub(r"([\u4e00-\u9fa5]+)([A-Za-z]+[0-9]+)", r"\1 \2", txt)
-        txt = re.sub(r"([\u4e00-\u9fa5]+)([A-Za-z])", r"\1 \2", txt)
+        txt = ZH_ENG_NUM_RE.sub(r"\1 \2", txt)
+        txt = ZH_ENG_RE.sub(r"\1 \2", txt)
         return txt
 
     def question(self, txt, tbl="qa", min_match: float = 0.6):
@@ -117,13 +149,38 @@ class FulltextQueryer:
         - MatchTextExpr: 生成的查询表达式对象。
         - keywords (list): 提取的关键词列表。
         """
-        txt = FulltextQueryer.add_space_between_eng_zh(txt)  # 在英文和中文之间添加空格
-        # 使用正则表达式替换特殊字符为单个空格，并将文本转换为简体中文和小写
-        txt = re.sub(
-            r"[ :|\r\n\t,，。？?/`!！&^%%()\[\]{}<>]+",
+        txt = FulltextQueryer.normalize(txt)
+        with self._question_lock:
+            res = self._question_cache.get(txt)
+        if res is None:
+            # 同一问题在 search、rerank 以及低 min_match 重试中会反复分析，分析结果按归一化后的问题缓存，
+            # min_match 只影响最后组装的查询表达式
+            res = self._question(txt)
+            with self._question_lock:
+                self._question_cache[txt] = res
+        query, keywords, use_min_match = res
+        if query is None:
+            return None, list(keywords)
+        if use_min_match:
+            return MatchTextExpr(self.query_fields, query, 100, {"minimum_should_match": min_match}), list(keywords)
+        return MatchTextExpr(self.query_fields, query, 100), list(keywords)
+
+    @staticmethod
+    def normalize(txt):
+        """
+        在英文和中文之间添加空格，将特殊字符替换为单个空格，并将文本转换为简体中文和小写。
+        """
+        txt = FulltextQueryer.add_space_between_eng_zh(txt)
+        return QUESTION_PUNCT_RE.sub(
             " ",
             rag_tokenizer.tradi2simp(rag_tokenizer.strQ2B(txt.lower())),
         ).strip()
+
+    def _question(self, txt):
+        """
+        对归一化后的文本做分析，返回 (查询文本或 None, keywords, 是否使用 minimum_should_match)，
+        由 question 组装成 MatchTextExpr。
+        """
         otxt = txt
         txt = FulltextQueryer.rmWWW(txt)
 
@@ -133,9 +190,9 @@ class FulltextQueryer:
             tks = rag_tokenizer.tokenize(txt).split()
             keywords = [t for t in tks if t]
             tks_w = self.tw.weights(tks, preprocess=False)
-            tks_w = [(re.sub(r"[ \\\"'^]", "", tk), w) for tk, w in tks_w]
-            tks_w = [(re.sub(r"^[a-z0-9]$", "", tk), w) for tk, w in tks_w if tk]
-            tks_w = [(re.sub(r"^[\+-]", "", tk), w) for tk, w in tks_w if tk]
+            tks_w = [(TOKEN_QUOTE_RE.sub("", tk), w) for tk, w in tks_w]
+            tks_w = [(SINGLE_ALNUM_RE.sub("", tk), w) for tk, w in tks_w if tk]
+            tks_w = [(LEADING_SIGN_RE.sub("", tk), w) for tk, w in tks_w if tk]
             tks_w = [(tk.strip(), w) for tk, w in tks_w if tk.strip()]
             syns = []
             for tk, w in tks_w[:256]:
@@ -145,7 +202,7 @@ class FulltextQueryer:
                 syn = ['"{}"^{:.4f}'.format(s, w / 4.0) for s in syn if s.strip()]
                 syns.append(" ".join(syn))
 
-            q = ["({}^{:.4f}".format(tk, w) + " {})".format(syn) for (tk, w), syn in zip(tks_w, syns) if tk and not re.match(r"[.^+\(\)-]", tk)]
+            q = ["({}^{:.4f}".format(tk, w) + " {})".format(syn) for (tk, w), syn in zip(tks_w, syns) if tk and not QUERY_OPERATOR_RE.match(tk)]
             for i in range(1, len(tks_w)):
                 left, right = tks_w[i - 1][0].strip(), tks_w[i][0].strip()
                 if not left or not right:
@@ -161,7 +218,7 @@ class FulltextQueryer:
             if not q:
                 q.append(txt)
             query = " ".join(q)
-            return MatchTextExpr(self.query_fields, query, 100), keywords
+            return query, tuple(keywords), False
 
         def need_fine_grained_tokenize(tk):
             """
@@ -177,7 +234,7 @@ class FulltextQueryer:
             if len(tk) < 3:
                 return False
             # 匹配特定模式的词不处理（如数字、字母、符号组合）
-            if re.match(r"[0-9a-z\.\+#_\*-]+$", tk):
+            if NO_FINE_GRAINED_RE.match(tk):
                 return False
             return True
 
@@ -208,20 +265,13 @@ class FulltextQueryer:
                 # 1. 去除标点符号和特殊字符
                 # 2. 使用subSpecialChar进一步处理
                 # 3. 过滤掉长度<=1的词
-                sm = [
-                    re.sub(
-                        r"[ ,\./;'\[\]\\`~!@#$%\^&\*\(\)=\+_<>\?:\"\{\}\|，。；‘’【】、！￥……（）——《》？：“”-]+",
-                        "",
-                        m,
-                    )
-                    for m in sm
-                ]
+                sm = [PUNCT_RE.sub("", m) for m in sm]
                 sm = [FulltextQueryer.subSpecialChar(m) for m in sm if len(m) > 1]
                 sm = [m for m in sm if len(m) > 1]
 
                 # 如果关键词数量未达上限，添加处理后的token和分词结果
                 if len(keywords) < 32:
-                    keywords.append(re.sub(r"[ \\\"']+", "", tk))  # 去除转义字符
+                    keywords.append(KEYWORD_QUOTE_RE.sub("", tk))  # 去除转义字符
                     keywords.extend(sm)  # 添加分词结果
                 # 获取当前token的同义词并进行处理
                 tk_syns = self.syn.lookup(tk)
@@ -275,34 +325,54 @@ class FulltextQueryer:
             if not query:
                 query = otxt
             # 返回匹配文本表达式和关键词
-            return MatchTextExpr(self.query_fields, query, 100, {"minimum_should_match": min_match}), keywords
+            return query, tuple(keywords), True
         # 如果没有生成查询条件，只返回关键词
-        return None, keywords
+        return None, tuple(keywords), True
 
-    def hybrid_similarity(self, avec, bvecs, atks, btkss, tkweight=0.3, vtweight=0.7):
-        from sklearn.metrics.pairwise import cosine_similarity as CosineSimilarity
-        import numpy as np
+    @staticmethod
+    def cosine_similarity(avec, bvecs):
+        """
+        avec 与 bvecs 每一行的余弦相似度，bvecs 可以是预分配好的 float32 矩阵，零向量的相似度为 0。
+        """
+        bvecs = np.asarray(bvecs, dtype=np.float32)
+        if bvecs.ndim != 2 or not bvecs.shape[0]:
+            return np.zeros(len(bvecs), dtype=np.float64)
+        avec = np.asarray(avec, dtype=np.float32)
+        norms = np.linalg.norm(bvecs, axis=1) * np.linalg.norm(avec)
+        dots = bvecs @ avec
+        sims = np.zeros(len(bvecs), dtype=np.float64)
+        np.divide(dots, norms, out=sims, where=norms > 0)
+        return sims
 
-        sims = CosineSimilarity([avec], bvecs)
+    def hybrid_similarity(self, avec, bvecs, atks, btkss, tkweight=0.3, vtweight=0.7):
+        sims = self.cosine_similarity(avec, bvecs)
         tksim = self.token_similarity(atks, btkss)
-        if np.sum(sims[0]) == 0:
-            return np.array(tksim), tksim, sims[0]
-        return np.array(sims[0]) * vtweight + np.array(tksim) * tkweight, tksim, sims[0]
+        if np.sum(sims) == 0:
+            return np.array(tksim), tksim, sims
+        return sims * vtweight + np.array(tksim) * tkweight, tksim, sims
 
     def token_similarity(self, atks, btkss):
-        def toDict(tks):
-            d = {}
+        """
+        只有问题词的权重参与打分，候选片段只看是否包含该词（见 similarity），
+        所以候选片段不再计算权重：问题词映射成整数 id，命中关系用 bincount 一次性累加。
+        """
+        if isinstance(atks, str):
+            atks = atks.split()
+        qtwt = {}
+        for t, c in self.tw.weights(atks, preprocess=False):
+            qtwt[t] = qtwt.get(t, 0) + c
+        vocab = {t: i for i, t in enumerate(qtwt.keys())}
+        weights = np.fromiter(qtwt.values(), dtype=np.float64, count=len(qtwt))
+
+        rows, cols = [], []
+        for i, tks in enumerate(btkss):
             if isinstance(tks, str):
                 tks = tks.split()
-            for t, c in self.tw.weights(tks, preprocess=False):
-                if t not in d:
-                    d[t] = 0
-                d[t] += c
-            return d
-
-        atks = toDict(atks)
-        btkss = [toDict(tks) for tks in btkss]
-        return [self.similarity(atks, btks) for btks in btkss]
+            hits = {vocab[t] for t in tks if t in vocab}
+            rows.extend([i] * len(hits))
+            cols.extend(hits)
+        s = np.bincount(np.asarray(rows, dtype=np.int64), weights=weights[np.asarray(cols, dtype=np.int64)], minlength=len(btkss))
+        return ((s + 1e-9) / (weights.sum() + 1e-9)).tolist()
 
     def similarity(self, qtwt, dtwt):
         if isinstance(dtwt, type("")):
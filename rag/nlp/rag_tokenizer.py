@@ -22,13 +22,19 @@ import os
 import re
 import string
 import sys
+import threading
 from pathlib import Path
+from cachetools import LRUCache
 from hanziconv import HanziConv
 from nltk import word_tokenize
 from nltk.stem import PorterStemmer, WordNetLemmatizer
 
 sys.path.append(str(Path(__file__).parent.parent.parent))
 from api.utils.file_utils import get_project_base_directory
+from rag.nlp.mmap_dict import MmapDict
+
+TOKENIZER_MMAP_DICT = int(os.environ.get("TOKENIZER_MMAP_DICT", "0"))
+TOKENIZER_CACHE_SIZE = int(os.environ.get("TOKENIZER_CACHE_SIZE", "100000"))
 
 
 class RagTokenizer:
@@ -71,7 +77,31 @@ class RagTokenizer:
 
         self.SPLIT_CHAR = r"([ ,\.<>/?;:'\[\]\\`!@#$%^&*\(\)\{\}\|_+=《》，。？、；‘’：“”【】~！￥%……（）——-]+|[a-zA-Z0-9,\.-]+)"
 
-        trie_file_name = self.DIR_ + ".txt.trie"
+        # Repeated headings, boilerplate and table cells hit the same segments over and over.
+        self._segment_cache = LRUCache(maxsize=max(1, TOKENIZER_CACHE_SIZE))
+        self._fine_grained_cache = LRUCache(maxsize=max(1, TOKENIZER_CACHE_SIZE))
+        self._cache_lock = threading.Lock()
+
+        dict_file_name = self.DIR_ + ".txt.dict"
+        if TOKENIZER_MMAP_DICT and os.path.exists(dict_file_name):
+            try:
+                # map the shared read-only dictionary, no heap copy per process
+                self.trie_ = MmapDict.load(dict_file_name)
+                return
+            except Exception:
+                logging.exception(f"[HUQIE]:Fail to load dict file {dict_file_name}, fall back to the trie file")
+
+        self.loadTrie_(self.DIR_ + ".txt")
+        if TOKENIZER_MMAP_DICT:
+            try:
+                logging.info(f"[HUQIE]:Build dict file {dict_file_name}")
+                MmapDict.build(self.trie_.items(), dict_file_name)
+                self.trie_ = MmapDict.load(dict_file_name)
+            except Exception:
+                logging.exception(f"[HUQIE]:Build dict file {dict_file_name} failed")
+
+    def loadTrie_(self, fnm):
+        trie_file_name = fnm + ".trie"
         # check if trie file existence
         if os.path.exists(trie_file_name):
             try:
@@ -88,9 +118,15 @@ class RagTokenizer:
             self.trie_ = datrie.Trie(string.printable)
 
         # load data from dict file and save to trie file
-        self.loadDict_(self.DIR_ + ".txt")
+        self.loadDict_(fnm)
+
+    def clear_cache(self):
+        with self._cache_lock:
+            self._segment_cache.clear()
+            self._fine_grained_cache.clear()
 
     def loadUserDict(self, fnm):
+        self.clear_cache()
         try:
             self.trie_ = datrie.Trie.load(fnm + ".trie")
             return
@@ -99,6 +135,13 @@ class RagTokenizer:
         self.loadDict_(fnm)
 
     def addUserDict(self, fnm):
+        if isinstance(self.trie_, MmapDict):
+            # the mapped dictionary is read only, merge the user words into a private trie
+            trie = datrie.Trie(string.printable)
+            for k, v in self.trie_.items():
+                trie[k] = v
+            self.trie_ = trie
+        self.clear_cache()
         self.loadDict_(fnm)
 
     def _strQ2B(self, ustring):
@@ -294,68 +337,81 @@ class RagTokenizer:
         arr = self._split_by_lang(line)
         res = []
         for L, lang in arr:
-            if not lang:
-                res.extend([self.stemmer.stem(self.lemmatizer.lemmatize(t)) for t in word_tokenize(L)])
-                continue
-            if len(L) < 2 or re.match(r"[a-z\.-]+$", L) or re.match(r"[0-9\.-]+$", L):
-                res.append(L)
+            res.extend(self._tokenize_segment(L, lang))
+
+        res = " ".join(res)
+        logging.debug("[TKS] {}".format(self.merge_(res)))
+        return self.merge_(res)
+
+    def _tokenize_segment(self, L, lang):
+        with self._cache_lock:
+            res = self._segment_cache.get((L, lang))
+        if res is None:
+            res = self._tokenize_segment_(L, lang)
+            with self._cache_lock:
+                self._segment_cache[(L, lang)] = res
+        return res
+
+    def _tokenize_segment_(self, L, lang):
+        if not lang:
+            return tuple(self.stemmer.stem(self.lemmatizer.lemmatize(t)) for t in word_tokenize(L))
+        if len(L) < 2 or re.match(r"[a-z\.-]+$", L) or re.match(r"[0-9\.-]+$", L):
+            return (L,)
+
+        res = []
+
+        # use maxforward for the first time
+        tks, s = self.maxForward_(L)
+        tks1, s1 = self.maxBackward_(L)
+        if self.DEBUG:
+            logging.debug("[FW] {} {}".format(tks, s))
+            logging.debug("[BW] {} {}".format(tks1, s1))
+
+        i, j, _i, _j = 0, 0, 0, 0
+        same = 0
+        while i + same < len(tks1) and j + same < len(tks) and tks1[i + same] == tks[j + same]:
+            same += 1
+        if same > 0:
+            res.append(" ".join(tks[j : j + same]))
+        _i = i + same
+        _j = j + same
+        j = _j + 1
+        i = _i + 1
+
+        while i < len(tks1) and j < len(tks):
+            tk1, tk = "".join(tks1[_i:i]), "".join(tks[_j:j])
+            if tk1 != tk:
+                if len(tk1) > len(tk):
+                    j += 1
+                else:
+                    i += 1
                 continue
 
-            # use maxforward for the first time
-            tks, s = self.maxForward_(L)
-            tks1, s1 = self.maxBackward_(L)
-            if self.DEBUG:
-                logging.debug("[FW] {} {}".format(tks, s))
-                logging.debug("[BW] {} {}".format(tks1, s1))
+            if tks1[i] != tks[j]:
+                i += 1
+                j += 1
+                continue
+            # backward tokens from_i to i are different from forward tokens from _j to j.
+            tkslist = []
+            self.dfs_("".join(tks[_j:j]), 0, [], tkslist)
+            res.append(" ".join(self.sortTks_(tkslist)[0][0]))
 
-            i, j, _i, _j = 0, 0, 0, 0
-            same = 0
+            same = 1
             while i + same < len(tks1) and j + same < len(tks) and tks1[i + same] == tks[j + same]:
                 same += 1
-            if same > 0:
-                res.append(" ".join(tks[j : j + same]))
+            res.append(" ".join(tks[j : j + same]))
             _i = i + same
             _j = j + same
             j = _j + 1
             i = _i + 1
 
-            while i < len(tks1) and j < len(tks):
-                tk1, tk = "".join(tks1[_i:i]), "".join(tks[_j:j])
-                if tk1 != tk:
-                    if len(tk1) > len(tk):
-                        j += 1
-                    else:
-                        i += 1
-                    continue
-
-                if tks1[i] != tks[j]:
-                    i += 1
-                    j += 1
-                    continue
-                # backward tokens from_i to i are different from forward tokens from _j to j.
-                tkslist = []
-                self.dfs_("".join(tks[_j:j]), 0, [], tkslist)
-                res.append(" ".join(self.sortTks_(tkslist)[0][0]))
-
-                same = 1
-                while i + same < len(tks1) and j + same < len(tks) and tks1[i + same] == tks[j + same]:
-                    same += 1
-                res.append(" ".join(tks[j : j + same]))
-                _i = i + same
-                _j = j + same
-                j = _j + 1
-                i = _i + 1
-
-            if _i < len(tks1):
-                assert _j < len(tks)
-                assert "".join(tks1[_i:]) == "".join(tks[_j:])
-                tkslist = []
-                self.dfs_("".join(tks[_j:]), 0, [], tkslist)
-                res.append(" ".join(self.sortTks_(tkslist)[0][0]))
-
-        res = " ".join(res)
-        logging.debug("[TKS] {}".format(self.merge_(res)))
-        return self.merge_(res)
+        if _i < len(tks1):
+            assert _j < len(tks)
+            assert "".join(tks1[_i:]) == "".join(tks[_j:])
+            tkslist = []
+            self.dfs_("".join(tks[_j:]), 0, [], tkslist)
+            res.append(" ".join(self.sortTks_(tkslist)[0][0]))
+        return tuple(res)
 
     def fine_grained_tokenize(self, tks):
         """
@@ -388,47 +444,66 @@ class RagTokenizer:
         # 中文或复杂文本处理流程
         res = []
         for tk in tks:
-            # 规则1：跳过短词（长度<3）或纯数字/符号组合（如"3.14"）
-            if len(tk) < 3 or re.match(r"[0-9,\.-]+$", tk):
-                res.append(tk)
-                continue
+            with self._cache_lock:
+                stk = self._fine_grained_cache.get(tk)
+            if stk is None:
+                stk = self._fine_grained_token(tk)
+                with self._cache_lock:
+                    self._fine_grained_cache[tk] = stk
+            res.append(stk)
 
-            # 初始化候选分词列表
-            tkslist = []
+        return " ".join(self.english_normalize_(res))
 
-            # 规则2：超长词（长度>10）直接保留不切分
-            if len(tk) > 10:
-                tkslist.append(tk)
-            else:
-                # 使用DFS回溯算法寻找所有可能的分词组合
-                self.dfs_(tk, 0, [], tkslist)
+    def _fine_grained_token(self, tk):
+        """对单个词做细粒度切分，结果只取决于词本身，由 fine_grained_tokenize 缓存"""
+        # 规则1：跳过短词（长度<3）或纯数字/符号组合（如"3.14"）
+        if len(tk) < 3 or re.match(r"[0-9,\.-]+$", tk):
+            return tk
 
-            # 规则3：若无有效切分方案则保留原词
-            if len(tkslist) < 2:
-                res.append(tk)
-                continue
+        # 初始化候选分词列表
+        tkslist = []
+
+        # 规则2：超长词（长度>10）直接保留不切分
+        if len(tk) > 10:
+            tkslist.append(tk)
+        else:
+            # 使用DFS回溯算法寻找所有可能的分词组合
+            self.dfs_(tk, 0, [], tkslist)
 
-            # 从候选方案中选择最优切分（通过sortTks_排序）
-            stk = self.sortTks_(tkslist)[1][0]
+        # 规则3：若无有效切分方案则保留原词
+        if len(tkslist) < 2:
+            return tk
 
-            # 规则4：若切分结果与原词长度相同则视为无效切分
-            if len(stk) == len(tk):
-                stk = tk
-            else:
-                # 英文特殊处理：检查子词长度是否合法
-                if re.match(r"[a-z\.-]+$", tk):
-                    for t in stk:
-                        if len(t) < 3:
-                            stk = tk
-                            break
-                    else:
-                        stk = " ".join(stk)
+        # 从候选方案中选择最优切分（通过sortTks_排序）
+        stk = self.sortTks_(tkslist)[1][0]
+
+        # 规则4：若切分结果与原词长度相同则视为无效切分
+        if len(stk) == len(tk):
+            stk = tk
+        else:
+            # 英文特殊处理：检查子词长度是否合法
+            if re.match(r"[a-z\.-]+$", tk):
+                for t in stk:
+                    if len(t) < 3:
+                        stk = tk
+                        break
                 else:
                     stk = " ".join(stk)
-            # 中文词直接拼接结果
-            res.append(stk)
+            else:
+                stk = " ".join(stk)
+        # 中文词直接拼接结果
+        return stk
 
-        return " ".join(self.english_normalize_(res))
+    def tokenize_batch(self, lines):
+        """
+        对一批文本同时做粗粒度和细粒度分词，返回 [(tokenize 结果, fine_grained_tokenize 结果), ...]。
+        重复出现的片段和词直接命中缓存。
+        """
+        res = []
+        for line in lines:
+            tks = self.tokenize(line)
+            res.append((tks, self.fine_grained_tokenize(tks)))
+        return res
 
 
 def is_chinese(s):
@@ -461,6 +536,25 @@ def naiveQie(txt):
     return tks
 
 
+def _tokenize_batch(lines):
+    return tokenizer.tokenize_batch(lines)
+
+
+def tokenize_batch(lines, executor=None, batch_size=256):
+    """
+    Coarse and fine-grained tokens of every line, as (tokenize, fine_grained_tokenize) pairs.
+    Given a concurrent.futures.ProcessPoolExecutor the lines are split into batches spread over
+    its workers; each worker keeps its own tokenizer and caches, and maps the shared dictionary
+    when TOKENIZER_MMAP_DICT is on.
+    """
+    if executor is None or len(lines) <= batch_size:
+        return tokenizer.tokenize_batch(lines)
+    res = []
+    for r in executor.map(_tokenize_batch, [lines[i : i + batch_size] for i in range(0, len(lines), batch_size)]):
+        res.extend(r)
+    return res
+
+
 tokenizer = RagTokenizer()
 tokenize = tokenizer.tokenize
 fine_grained_tokenize = tokenizer.fine_grained_tokenize
@@ -13,6 +13,7 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 #
+import itertools
 import logging
 import re
 import math
@@ -23,6 +24,8 @@ from rag.utils import rmSpace
 from rag.nlp import rag_tokenizer, query
 import numpy as np
 from rag.utils.doc_store_conn import DocStoreConnection, MatchDenseExpr, FusionExpr, OrderByExpr
+from rag.utils.retrieval_cache import RETRIEVAL_CACHE, normalize_question
+from api.utils.chat_trace import span
 
 
 def index_name(uid):
@@ -44,9 +47,12 @@ class Dealer:
         aggregation: list | dict | None = None
         keywords: list[str] | None = None
         group_docs: list[list] | None = None
+        vectors: np.ndarray | None = None  # 与 ids 对齐的 float32 向量矩阵
 
     def get_vector(self, txt, emb_mdl, topk=10, similarity=0.1):
-        qv, _ = emb_mdl.encode_queries(txt)
+        # Normalized so that the query vector cache is shared by trivially different spellings.
+        with span("embedding"):
+            qv, _ = emb_mdl.encode_queries(normalize_question(txt))
         shape = np.array(qv).shape
         if len(shape) > 1:
             raise Exception(f"Dealer.get_vector returned array's shape {shape} doesn't match expectation(exact one dimension).")
@@ -139,20 +145,23 @@ class Dealer:
                 orderBy.asc("page_num_int")
                 orderBy.asc("top_int")
                 orderBy.desc("create_timestamp_flt")
-            res = self.dataStore.search(src, [], filters, [], orderBy, offset, limit, idx_names, kb_ids)
+            with span("es_search"):
+                res = self.dataStore.search(src, [], filters, [], orderBy, offset, limit, idx_names, kb_ids)
             total = self.dataStore.getTotal(res)
             logging.debug("Dealer.search TOTAL: {}".format(total))
         else:
             # 4.2 若存在查询文本，进入全文/混合检索流程
             highlightFields = ["content_ltks", "title_tks"] if highlight else []  # highlight当前会一直为False，不起作用
             # 4.2.1 生成全文检索表达式和关键词
-            matchText, keywords = self.qryr.question(qst, min_match=0.3)
+            with span("query_analysis"):
+                matchText, keywords = self.qryr.question(qst, min_match=0.3)
             print(f"matchText.matching_text: {matchText.matching_text}")
             print(f"keywords: {keywords}\n")
             if emb_mdl is None:
                 # 4.2.2 纯全文检索模式 （未提供向量模型，正常情况不会进入）
                 matchExprs = [matchText]
-                res = self.dataStore.search(src, highlightFields, filters, matchExprs, orderBy, offset, limit, idx_names, kb_ids, rank_feature=rank_feature)
+                with span("es_search"):
+                    res = self.dataStore.search(src, highlightFields, filters, matchExprs, orderBy, offset, limit, idx_names, kb_ids, rank_feature=rank_feature)
                 total = self.dataStore.getTotal(res)
                 logging.debug("Dealer.search TOTAL: {}".format(total))
             else:
@@ -168,7 +177,8 @@ class Dealer:
                 matchExprs = [matchText, matchDense, fusionExpr]
 
                 # 执行混合检索
-                res = self.dataStore.search(src, highlightFields, filters, matchExprs, orderBy, offset, limit, idx_names, kb_ids, rank_feature=rank_feature)
+                with span("es_search"):
+                    res = self.dataStore.search(src, highlightFields, filters, matchExprs, orderBy, offset, limit, idx_names, kb_ids, rank_feature=rank_feature)
                 total = self.dataStore.getTotal(res)
                 logging.debug("Dealer.search TOTAL: {}".format(total))
 
@@ -179,16 +189,19 @@ class Dealer:
                 if total == 0:
                     if filters.get("doc_id"):
                         # 有特定文档ID时执行无条件查询
-                        res = self.dataStore.search(src, [], filters, [], orderBy, offset, limit, idx_names, kb_ids)
+                        with span("es_search"):
+                            res = self.dataStore.search(src, [], filters, [], orderBy, offset, limit, idx_names, kb_ids)
                         total = self.dataStore.getTotal(res)
                         print(f"针对选中文档，共查询到: {total} 条信息")
                         # print(f"查询信息结果: {res}\n")
                     else:
                         # 否则调整全文和向量匹配参数再次搜索
-                        matchText, _ = self.qryr.question(qst, min_match=0.1)
+                        with span("query_analysis"):
+                            matchText, _ = self.qryr.question(qst, min_match=0.1)
                         filters.pop("doc_id", None)
                         matchDense.extra_options["similarity"] = 0.17
-                        res = self.dataStore.search(src, highlightFields, filters, [matchText, matchDense, fusionExpr], orderBy, offset, limit, idx_names, kb_ids, rank_feature=rank_feature)
+                        with span("es_search"):
+                            res = self.dataStore.search(src, highlightFields, filters, [matchText, matchDense, fusionExpr], orderBy, offset, limit, idx_names, kb_ids, rank_feature=rank_feature)
                         total = self.dataStore.getTotal(res)
                         logging.debug("Dealer.search 2 TOTAL: {}".format(total))
                         print(f"再次查询，共查询到: {total} 条信息")
@@ -210,7 +223,13 @@ class Dealer:
         keywords = list(kwds)  # 转为列表格式返回
         highlight = self.dataStore.getHighlight(res, keywords, "content_with_weight")  # 获取高亮内容
         aggs = self.dataStore.getAggregation(res, "docnm_kwd")  # 执行基于文档名的聚合分析
-        return self.SearchResult(total=total, ids=ids, query_vector=q_vec, aggregation=aggs, highlight=highlight, field=self.dataStore.getFields(res, src), keywords=keywords)
+        # 候选片段向量直接转成一个与 ids 对齐的 float32 矩阵，不再放进各片段的字段里
+        vectors = None
+        if q_vec:
+            vector_column = f"q_{len(q_vec)}_vec"
+            vectors = self.dataStore.getVectors(res, ids, vector_column, len(q_vec))
+            src = [f for f in src if f != vector_column]
+        return self.SearchResult(total=total, ids=ids, query_vector=q_vec, aggregation=aggs, highlight=highlight, field=self.dataStore.getFields(res, src), keywords=keywords, vectors=vectors)
 
     @staticmethod
     def trans2floats(txt):
@@ -346,28 +365,22 @@ class Dealer:
                 如果初步检索结果为空 (sres.ids is empty)，则返回三个空列表。
         """
         _, keywords = self.qryr.question(query)
-        vector_size = len(sres.query_vector)
-        vector_column = f"q_{vector_size}_vec"
-        zero_vector = [0.0] * vector_size
-        ins_embd = []
-        for chunk_id in sres.ids:
-            vector = sres.field[chunk_id].get(vector_column, zero_vector)
-            if isinstance(vector, str):
-                vector = [float(v) for v in vector.split("\t")]
-            ins_embd.append(vector)
-        if not ins_embd:
+        if not sres.ids:
             return [], [], []
+        ins_embd = sres.vectors
+        if ins_embd is None:
+            ins_embd = np.zeros((len(sres.ids), len(sres.query_vector)), dtype=np.float32)
 
         for i in sres.ids:
             if isinstance(sres.field[i].get("important_kwd", []), str):
                 sres.field[i]["important_kwd"] = [sres.field[i]["important_kwd"]]
+        # 词元相似度只看问题词是否出现在片段中，重复次数不影响得分，这里直接取集合
         ins_tw = []
         for i in sres.ids:
-            content_ltks = sres.field[i][cfield].split()
-            title_tks = [t for t in sres.field[i].get("title_tks", "").split() if t]
-            question_tks = [t for t in sres.field[i].get("question_tks", "").split() if t]
-            important_kwd = sres.field[i].get("important_kwd", [])
-            tks = content_ltks + title_tks * 2 + important_kwd * 5 + question_tks * 6
+            tks = set(sres.field[i][cfield].split())
+            tks.update(sres.field[i].get("title_tks", "").split())
+            tks.update(sres.field[i].get("question_tks", "").split())
+            tks.update(sres.field[i].get("important_kwd", []))
             ins_tw.append(tks)
 
         ## For rank feature(tag_fea) scores.
@@ -444,6 +457,26 @@ class Dealer:
         ranks = {"total": 0, "chunks": [], "doc_aggs": {}}
         if not question:
             return ranks
+        # 相同问题、相同知识库版本下直接复用排序结果，跳过向量化与检索
+        cache_key = RETRIEVAL_CACHE.key(
+            kb_ids or [],
+            question=normalize_question(question),
+            embd_mdl=getattr(embd_mdl, "embd_cache_key", getattr(embd_mdl, "llm_name", None)),
+            tenant_ids=tenant_ids,
+            doc_ids=doc_ids,
+            page=page,
+            page_size=page_size,
+            similarity_threshold=similarity_threshold,
+            vector_similarity_weight=vector_similarity_weight,
+            top=top,
+            aggs=aggs,
+            rerank_mdl=getattr(rerank_mdl, "llm_name", str(rerank_mdl)) if rerank_mdl else None,
+            highlight=highlight,
+            rank_feature=rank_feature,
+        )
+        cached = RETRIEVAL_CACHE.get(cache_key)
+        if cached is not None:
+            return cached
         # 设置重排序页面限制
         RERANK_LIMIT = 64
         RERANK_LIMIT = int(RERANK_LIMIT // page_size + ((RERANK_LIMIT % page_size) / (page_size * 1.0) + 0.5)) * page_size if page_size > 1 else 1
@@ -470,16 +503,16 @@ class Dealer:
         sres = self.search(req, [index_name(tid) for tid in tenant_ids], kb_ids, embd_mdl, highlight, rank_feature=rank_feature)
 
         # 执行重排序操作
-        if rerank_mdl and sres.total > 0:
-            sim, tsim, vsim = self.rerank_by_model(rerank_mdl, sres, question, 1 - vector_similarity_weight, vector_similarity_weight, rank_feature=rank_feature)
-        else:
-            sim, tsim, vsim = self.rerank(sres, question, 1 - vector_similarity_weight, vector_similarity_weight, rank_feature=rank_feature)
+        with span("rerank"):
+            if rerank_mdl and sres.total > 0:
+                sim, tsim, vsim = self.rerank_by_model(rerank_mdl, sres, question, 1 - vector_similarity_weight, vector_similarity_weight, rank_feature=rank_feature)
+            else:
+                sim, tsim, vsim = self.rerank(sres, question, 1 - vector_similarity_weight, vector_similarity_weight, rank_feature=rank_feature)
         # Already paginated in search function
         idx = np.argsort(sim * -1)[(page - 1) * page_size : page * page_size]
 
         dim = len(sres.query_vector)
-        vector_column = f"q_{dim}_vec"
-        zero_vector = [0.0] * dim
+        zero_vector = np.zeros(dim, dtype=np.float32)
         if doc_ids:
             similarity_threshold = 0
             page_size = 30
@@ -510,7 +543,7 @@ class Dealer:
                 "similarity": sim[i],
                 "vector_similarity": vsim[i],
                 "term_similarity": tsim[i],
-                "vector": chunk.get(vector_column, zero_vector),
+                "vector": sres.vectors[i] if sres.vectors is not None else zero_vector,
                 "positions": position_int,
                 "doc_type_kwd": chunk.get("doc_type_kwd", ""),
             }
@@ -526,26 +559,21 @@ class Dealer:
         ranks["doc_aggs"] = [{"doc_name": k, "doc_id": v["doc_id"], "count": v["count"]} for k, v in sorted(ranks["doc_aggs"].items(), key=lambda x: x[1]["count"] * -1)]
         ranks["chunks"] = ranks["chunks"][:page_size]
 
+        RETRIEVAL_CACHE.set(cache_key, ranks)
         return ranks
 
     def sql_retrieval(self, sql, fetch_size=128, format="json"):
         tbl = self.dataStore.sql(sql, fetch_size, format)
         return tbl
 
-    def chunk_list(self, doc_id: str, tenant_id: str, kb_ids: list[str], max_count=1024, offset=0, fields=["docnm_kwd", "content_with_weight", "img_id"]):
-        condition = {"doc_id": doc_id}
-        res = []
-        bs = 128
-        for p in range(offset, max_count, bs):
-            es_res = self.dataStore.search(fields, [], condition, [], OrderByExpr(), p, bs, index_name(tenant_id), kb_ids)
-            dict_chunks = self.dataStore.getFields(es_res, fields)
-            for id, doc in dict_chunks.items():
-                doc["id"] = id
-            if dict_chunks:
-                res.extend(dict_chunks.values())
-            if len(dict_chunks.values()) < bs:
-                break
-        return res
+    def chunk_list(self, doc_id: str, tenant_id: str, kb_ids: list[str], max_count=None, offset=0, fields=["docnm_kwd", "content_with_weight", "img_id"]):
+        """
+        逐个产出文档的全部片段（游标分页，内存与每页开销恒定），max_count/offset 仅用于截取其中一段。
+        """
+        chunks = self.dataStore.scan(fields, {"doc_id": doc_id}, index_name(tenant_id), kb_ids)
+        if offset or max_count is not None:
+            chunks = itertools.islice(chunks, offset, None if max_count is None else offset + max_count)
+        yield from chunks
 
     def all_tags(self, tenant_id: str, kb_ids: list[str], S=1000):
         if not self.dataStore.indexExist(index_name(tenant_id), kb_ids[0]):
@@ -555,6 +583,9 @@ class Dealer:
 
     def all_tags_in_portion(self, tenant_id: str, kb_ids: list[str], S=1000):
         res = self.dataStore.search([], [], {}, [], OrderByExpr(), 0, 0, index_name(tenant_id), kb_ids, ["tag_kwd"])
+        return self._tags_in_portion(res, S)
+
+    def _tags_in_portion(self, res, S=1000):
         res = self.dataStore.getAggregation(res, "tag_kwd")
         total = np.sum([c for _, c in res])
         return {t: (c + 1) / (total + S) for t, c in res}
@@ -572,12 +603,33 @@ class Dealer:
         return True
 
     def tag_query(self, question: str, tenant_ids: str | list[str], kb_ids: list[str], all_tags, topn_tags=3, S=1000):
+        res = self.dataStore.search(**self._tag_query_search(question, tenant_ids, kb_ids))
+        return self._tag_query_fea(res, all_tags, topn_tags, S)
+
+    def tag_question(self, question: str, tenant_id: str, tenant_ids: str | list[str], kb_ids: list[str], topn_tags=3, S=1000):
+        """
+        标签分布与问题标签的两次聚合合并为一次 msearch，用于标签缓存未命中时。
+        返回 (all_tags, 问题标签)。
+        """
+        searches = [
+            dict(selectFields=[], highlightFields=[], condition={}, matchExprs=[], orderBy=OrderByExpr(), offset=0, limit=0,
+                 indexNames=index_name(tenant_id), knowledgebaseIds=kb_ids, aggFields=["tag_kwd"]),
+            self._tag_query_search(question, tenant_ids, kb_ids),
+        ]
+        portion_res, query_res = self.dataStore.msearch(searches)
+        all_tags = self._tags_in_portion(portion_res, S)
+        return all_tags, self._tag_query_fea(query_res, all_tags, topn_tags, S)
+
+    def _tag_query_search(self, question: str, tenant_ids: str | list[str], kb_ids: list[str]):
         if isinstance(tenant_ids, str):
             idx_nms = index_name(tenant_ids)
         else:
             idx_nms = [index_name(tid) for tid in tenant_ids]
         match_txt, _ = self.qryr.question(question, min_match=0.0)
-        res = self.dataStore.search([], [], {}, [match_txt], OrderByExpr(), 0, 0, idx_nms, kb_ids, ["tag_kwd"])
+        return dict(selectFields=[], highlightFields=[], condition={}, matchExprs=[match_txt], orderBy=OrderByExpr(), offset=0, limit=0,
+                    indexNames=idx_nms, knowledgebaseIds=kb_ids, aggFields=["tag_kwd"])
+
+    def _tag_query_fea(self, res, all_tags, topn_tags=3, S=1000):
         aggs = self.dataStore.getAggregation(res, "tag_kwd")
         if not aggs:
             return {}
@@ -84,6 +84,7 @@ class Dealer:
 
         fnm = os.path.join(get_project_base_directory(), "rag/res")
         self.ne, self.df = {}, {}
+        self._token_weights = {}
         try:
             self.ne = json.load(open(os.path.join(fnm, "ner.json"), "r", encoding="utf-8"))
         except Exception:
@@ -164,7 +165,20 @@ class Dealer:
                 tks.append(t)
         return tks
 
-    def weights(self, tks, preprocess=True):
+    def token_weight(self, t):
+        """
+        Unnormalized weight of a single token. It only depends on the static dictionaries,
+        so it is memoized: rerank and query analysis hit the same tokens over and over.
+        """
+        w = self._token_weights.get(t)
+        if w is None:
+            w = self._token_weight(t)
+            if len(self._token_weights) >= 200000:
+                self._token_weights.clear()
+            self._token_weights[t] = w
+        return w
+
+    def _token_weight(self, t):
         def skill(t):
             if t not in self.sk:
                 return 1
@@ -227,21 +241,16 @@ class Dealer:
         def idf(s, N):
             return math.log10(10 + ((N - s + 0.5) / (s + 0.5)))
 
+        return (0.3 * idf(freq(t), 10000000) + 0.7 * idf(df(t), 1000000000)) * ner(t) * postag(t)
+
+    def weights(self, tks, preprocess=True):
         tw = []
         if not preprocess:
-            idf1 = np.array([idf(freq(t), 10000000) for t in tks])
-            idf2 = np.array([idf(df(t), 1000000000) for t in tks])
-            wts = (0.3 * idf1 + 0.7 * idf2) * np.array([ner(t) * postag(t) for t in tks])
-            wts = [s for s in wts]
-            tw = list(zip(tks, wts))
+            tw = [(t, self.token_weight(t)) for t in tks]
         else:
             for tk in tks:
                 tt = self.tokenMerge(self.pretoken(tk, True))
-                idf1 = np.array([idf(freq(t), 10000000) for t in tt])
-                idf2 = np.array([idf(df(t), 1000000000) for t in tt])
-                wts = (0.3 * idf1 + 0.7 * idf2) * np.array([ner(t) * postag(t) for t in tt])
-                wts = [s for s in wts]
-                tw.extend(zip(tt, wts))
+                tw.extend([(t, self.token_weight(t)) for t in tt])
 
         S = np.sum([s for _, s in tw])
         return [(t, s / S) for t, s in tw]
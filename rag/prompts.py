@@ -25,7 +25,7 @@ from api.db.services.document_service import DocumentService
 from api.db.services.llm_service import TenantLLMService, LLMBundle
 from api.utils.file_utils import get_project_base_directory
 from rag.settings import TAG_FLD
-from rag.utils import num_tokens_from_string, encoder
+from rag.utils import cached_num_tokens, encoder
 
 
 def chunks_format(reference):
@@ -78,7 +78,7 @@ def message_fit_in(msg, max_length=4000):
         nonlocal msg
         tks_cnts = []
         for m in msg:
-            tks_cnts.append({"role": m["role"], "count": num_tokens_from_string(m["content"])})
+            tks_cnts.append({"role": m["role"], "count": cached_num_tokens(m["content"])})
         total = 0
         for m in tks_cnts:
             total += m["count"]
@@ -99,8 +99,8 @@ def message_fit_in(msg, max_length=4000):
         return c, msg
 
     # 计算系统消息和最后一条消息的token数
-    ll = num_tokens_from_string(msg_[0]["content"])
-    ll2 = num_tokens_from_string(msg_[-1]["content"])
+    ll = cached_num_tokens(msg_[0]["content"])
+    ll2 = cached_num_tokens(msg_[-1]["content"])
     # 如果系统消息占比超过80%，则截断系统消息
     if ll / (ll + ll2) > 0.8:
         m = msg_[0]["content"]
@@ -137,7 +137,7 @@ def kb_prompt(kbinfos, max_tokens):
     used_token_count = 0
     chunks_num = 0
     for i, c in enumerate(knowledges):
-        used_token_count += num_tokens_from_string(c)
+        used_token_count += cached_num_tokens(c)
         chunks_num += 1
         if max_tokens * 0.97 < used_token_count:
             knowledges = knowledges[:i]
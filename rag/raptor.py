@@ -15,9 +15,6 @@
 #
 import logging
 import re
-import umap
-import numpy as np
-from sklearn.mixture import GaussianMixture
 import trio
 
 from graphrag.utils import (
@@ -27,12 +24,15 @@ from graphrag.utils import (
     set_llm_cache,
     chat_limiter,
 )
+from rag.raptor_clustering import RaptorClustering
 from rag.utils import truncate
 
+EMBEDDING_BATCH_SIZE = 16
+
 
 class RecursiveAbstractiveProcessing4TreeOrganizedRetrieval:
     def __init__(
-        self, max_cluster, llm_model, embd_model, prompt, max_token=512, threshold=0.1
+        self, max_cluster, llm_model, embd_model, prompt, max_token=512, threshold=0.1, clustering=None
     ):
         self._max_cluster = max_cluster
         self._llm_model = llm_model
@@ -40,6 +40,7 @@ class RecursiveAbstractiveProcessing4TreeOrganizedRetrieval:
         self._threshold = threshold
         self._prompt = prompt
         self._max_token = max_token
+        self._clustering = RaptorClustering(max_cluster, threshold, clustering)
 
     async def _chat(self, system, history, gen_conf):
         response = get_llm_cache(self._llm_model.llm_name, system, history, gen_conf)
@@ -54,28 +55,20 @@ class RecursiveAbstractiveProcessing4TreeOrganizedRetrieval:
         set_llm_cache(self._llm_model.llm_name, system, response, history, gen_conf)
         return response
 
-    async def _embedding_encode(self, txt):
-        response = get_embed_cache(self._embd_model.llm_name, txt)
-        if response is not None:
-            return response
-        embds, _ = await trio.to_thread.run_sync(lambda: self._embd_model.encode([txt]))
-        if len(embds) < 1 or len(embds[0]) < 1:
-            raise Exception("Embedding error: ")
-        embds = embds[0]
-        set_embed_cache(self._embd_model.llm_name, txt, embds)
+    async def _embedding_encode_batch(self, txts):
+        """Embeddings of `txts`, looking up the cache first and encoding the misses by batches."""
+        embds = [get_embed_cache(self._embd_model.llm_name, txt) for txt in txts]
+        missed = [i for i, e in enumerate(embds) if e is None]
+        for b in range(0, len(missed), EMBEDDING_BATCH_SIZE):
+            idx = missed[b: b + EMBEDDING_BATCH_SIZE]
+            vects, _ = await trio.to_thread.run_sync(lambda: self._embd_model.encode([txts[i] for i in idx]))
+            if len(vects) != len(idx) or any(len(v) < 1 for v in vects):
+                raise Exception("Embedding error: ")
+            for i, v in zip(idx, vects):
+                embds[i] = v
+                set_embed_cache(self._embd_model.llm_name, txts[i], v)
         return embds
 
-    def _get_optimal_clusters(self, embeddings: np.ndarray, random_state: int):
-        max_clusters = min(self._max_cluster, len(embeddings))
-        n_clusters = np.arange(1, max_clusters)
-        bics = []
-        for n in n_clusters:
-            gm = GaussianMixture(n_components=n, random_state=random_state)
-            gm.fit(embeddings)
-            bics.append(gm.bic(embeddings))
-        optimal_clusters = n_clusters[np.argmin(bics)]
-        return optimal_clusters
-
     async def __call__(self, chunks, random_state, callback=None):
         layers = [(0, len(chunks))]
         start, end = 0, len(chunks)
@@ -84,7 +77,6 @@ class RecursiveAbstractiveProcessing4TreeOrganizedRetrieval:
         chunks = [(s, a) for s, a in chunks if s and len(a) > 0]
 
         async def summarize(ck_idx: list[int]):
-            nonlocal chunks
             texts = [chunks[i][0] for i in ck_idx]
             len_per_chunk = int(
                 (self._llm_model.max_length - self._max_token) / len(texts)
@@ -111,14 +103,27 @@ class RecursiveAbstractiveProcessing4TreeOrganizedRetrieval:
                 cnt,
             )
             logging.debug(f"SUM: {cnt}")
-            embds = await self._embedding_encode(cnt)
-            chunks.append((cnt, embds))
+            return cnt
+
+        async def summarize_layer(clusters: list[list[int]]):
+            # summaries are generated concurrently, then embedded together and appended in cluster order
+            summaries = [None] * len(clusters)
+
+            async def summarize_cluster(c):
+                summaries[c] = await summarize(clusters[c])
+
+            async with trio.open_nursery() as nursery:
+                for c in range(len(clusters)):
+                    assert len(clusters[c]) > 0
+                    nursery.start_soon(summarize_cluster, c)
+            embds = await self._embedding_encode_batch(summaries)
+            chunks.extend(zip(summaries, embds))
 
         labels = []
         while end - start > 1:
             embeddings = [embd for _, embd in chunks[start:end]]
             if len(embeddings) == 2:
-                await summarize([start, start + 1])
+                await summarize_layer([[start, start + 1]])
                 if callback:
                     callback(
                         msg="Cluster one layer: {} -> {}".format(
@@ -131,28 +136,12 @@ class RecursiveAbstractiveProcessing4TreeOrganizedRetrieval:
                 end = len(chunks)
                 continue
 
-            n_neighbors = int((len(embeddings) - 1) ** 0.8)
-            reduced_embeddings = umap.UMAP(
-                n_neighbors=max(2, n_neighbors),
-                n_components=min(12, len(embeddings) - 2),
-                metric="cosine",
-            ).fit_transform(embeddings)
-            n_clusters = self._get_optimal_clusters(reduced_embeddings, random_state)
-            if n_clusters == 1:
-                lbls = [0 for _ in range(len(reduced_embeddings))]
-            else:
-                gm = GaussianMixture(n_components=n_clusters, random_state=random_state)
-                gm.fit(reduced_embeddings)
-                probs = gm.predict_proba(reduced_embeddings)
-                lbls = [np.where(prob > self._threshold)[0] for prob in probs]
-                lbls = [lbl[0] if isinstance(lbl, np.ndarray) else lbl for lbl in lbls]
-
-            async with trio.open_nursery() as nursery:
-                for c in range(n_clusters):
-                    ck_idx = [i + start for i in range(len(lbls)) if lbls[i] == c]
-                    assert len(ck_idx) > 0
-                    async with chat_limiter:
-                        nursery.start_soon(lambda: summarize(ck_idx))
+            n_clusters, lbls = await trio.to_thread.run_sync(
+                lambda: self._clustering(embeddings, random_state)
+            )
+            await summarize_layer(
+                [[i + start for i in range(len(lbls)) if lbls[i] == c] for c in range(n_clusters)]
+            )
 
             assert len(chunks) - end == n_clusters, "{} vs. {}".format(
                 len(chunks) - end, n_clusters
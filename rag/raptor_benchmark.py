@@ -0,0 +1,72 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""
+Compare the RAPTOR clustering modes on one layer: wall time, number of clusters, silhouette
+score (cosine, on the raw embeddings) and agreement (adjusted Rand index) with the gmm mode.
+Embeddings come from a .npy file of shape (chunks, dims), or are sampled around random centers.
+
+    python rag/raptor_benchmark.py [--embeddings FILE.npy] [--chunks N] [--max-cluster K]
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+from sklearn.datasets import make_blobs
+from sklearn.metrics import adjusted_rand_score, silhouette_score
+
+sys.path.append(str(Path(__file__).parent.parent))
+from rag.raptor_clustering import CLUSTERING_MODES, RaptorClustering
+
+
+def quality(embeddings, lbls):
+    if len(set(lbls)) < 2:
+        return 0.0
+    return silhouette_score(embeddings, lbls, metric="cosine")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="RAPTOR clustering benchmark")
+    parser.add_argument("--embeddings", help=".npy file of chunk embeddings")
+    parser.add_argument("--chunks", type=int, default=2000, help="synthetic chunks")
+    parser.add_argument("--dims", type=int, default=1024, help="synthetic dimensions")
+    parser.add_argument("--centers", type=int, default=40, help="synthetic topics")
+    parser.add_argument("--max-cluster", type=int, default=64)
+    parser.add_argument("--threshold", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--modes", nargs="+", default=CLUSTERING_MODES, choices=CLUSTERING_MODES)
+    args = parser.parse_args()
+
+    if args.embeddings:
+        embeddings = np.load(args.embeddings).astype(np.float32)
+    else:
+        embeddings, _ = make_blobs(n_samples=args.chunks, n_features=args.dims, centers=args.centers, random_state=args.seed)
+        embeddings = embeddings.astype(np.float32)
+
+    results = {}
+    for mode in args.modes:
+        clustering = RaptorClustering(args.max_cluster, args.threshold, mode)
+        start = time.perf_counter()
+        n_clusters, lbls = clustering(embeddings, args.seed)
+        elapsed = time.perf_counter() - start
+        results[mode] = lbls
+        print(f"{mode:>8}: {elapsed:.2f} s, {n_clusters} clusters, silhouette {quality(embeddings, lbls):.3f}")
+
+    if "gmm" in results:
+        for mode, lbls in results.items():
+            if mode != "gmm":
+                print(f"{mode:>8}: adjusted Rand index vs gmm {adjusted_rand_score(results['gmm'], lbls):.3f}")
@@ -0,0 +1,147 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""
+Clustering of one RAPTOR layer: reduce the embeddings, pick the number of clusters by BIC and
+label every chunk. Modes:
+
+    gmm       UMAP, then a GaussianMixture for every cluster count (the original behaviour)
+    gmm_fast  UMAP, then a coarse-to-fine search over the cluster counts, far fewer GMM fits
+    kmeans    PCA, then the coarse-to-fine search with MiniBatchKMeans and a spherical BIC
+
+Candidate fits of a search are independent and run on a process pool of RAPTOR_CLUSTER_WORKERS
+processes when it is set.
+"""
+import itertools
+import logging
+import math
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.decomposition import PCA
+from sklearn.mixture import GaussianMixture
+
+RAPTOR_CLUSTERING = os.environ.get("RAPTOR_CLUSTERING", "gmm")
+RAPTOR_CLUSTER_WORKERS = int(os.environ.get("RAPTOR_CLUSTER_WORKERS", "0"))
+CLUSTERING_MODES = ["gmm", "gmm_fast", "kmeans"]
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _executor():
+    global _pool
+    if RAPTOR_CLUSTER_WORKERS < 2:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            # spawn: the task executor runs threads, forking it is not safe
+            _pool = ProcessPoolExecutor(max_workers=RAPTOR_CLUSTER_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+
+def gmm_bic(embeddings: np.ndarray, n: int, random_state: int) -> float:
+    gm = GaussianMixture(n_components=n, random_state=random_state)
+    gm.fit(embeddings)
+    return gm.bic(embeddings)
+
+
+def kmeans_bic(embeddings: np.ndarray, n: int, random_state: int) -> float:
+    """BIC of a spherical Gaussian model with a shared variance, estimated from the k-means inertia."""
+    km = MiniBatchKMeans(n_clusters=n, random_state=random_state, batch_size=1024, n_init=3)
+    km.fit(embeddings)
+    rows, dims = embeddings.shape
+    sse = max(km.inertia_, 1e-12)
+    return rows * dims * math.log(sse / (rows * dims)) + n * (dims + 1) * math.log(rows)
+
+
+def _scores(score, embeddings, ns, random_state) -> dict:
+    pool = _executor()
+    if pool is None or len(ns) < 2:
+        return {n: score(embeddings, n, random_state) for n in ns}
+    return dict(zip(ns, pool.map(score, itertools.repeat(embeddings), ns, itertools.repeat(random_state))))
+
+
+def exhaustive_search(score, embeddings, max_clusters, random_state) -> int:
+    scores = _scores(score, embeddings, list(range(1, max_clusters)), random_state)
+    return min(scores, key=scores.get)
+
+
+def coarse_to_fine_search(score, embeddings, max_clusters, random_state) -> int:
+    """
+    Score every sqrt(N)-th cluster count, then every count around the best of them:
+    about 3 * sqrt(N) fits instead of N.
+    """
+    ns = list(range(1, max_clusters))
+    if len(ns) <= 8:
+        return exhaustive_search(score, embeddings, max_clusters, random_state)
+    step = int(math.ceil(math.sqrt(len(ns))))
+    coarse = sorted(set(ns[::step] + [ns[-1]]))
+    scores = _scores(score, embeddings, coarse, random_state)
+    best = min(scores, key=scores.get)
+    fine = [n for n in range(max(1, best - step + 1), min(ns[-1], best + step - 1) + 1) if n not in scores]
+    scores.update(_scores(score, embeddings, fine, random_state))
+    return min(scores, key=scores.get)
+
+
+class RaptorClustering:
+    def __init__(self, max_cluster: int, threshold: float, mode: str | None = None):
+        self._max_cluster = max_cluster
+        self._threshold = threshold
+        self.mode = mode or RAPTOR_CLUSTERING
+        if self.mode not in CLUSTERING_MODES:
+            logging.warning(f"Unknown RAPTOR clustering mode {self.mode}, using gmm")
+            self.mode = "gmm"
+
+    def reduce(self, embeddings: np.ndarray) -> np.ndarray:
+        n_components = min(12, len(embeddings) - 2)
+        if self.mode == "kmeans":
+            x = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+            return PCA(n_components=n_components).fit_transform(x)
+        import umap
+        n_neighbors = int((len(embeddings) - 1) ** 0.8)
+        return umap.UMAP(
+            n_neighbors=max(2, n_neighbors),
+            n_components=n_components,
+            metric="cosine",
+        ).fit_transform(embeddings)
+
+    def n_clusters(self, reduced: np.ndarray, random_state: int) -> int:
+        max_clusters = min(self._max_cluster, len(reduced))
+        if self.mode == "gmm":
+            return exhaustive_search(gmm_bic, reduced, max_clusters, random_state)
+        if self.mode == "gmm_fast":
+            return coarse_to_fine_search(gmm_bic, reduced, max_clusters, random_state)
+        return coarse_to_fine_search(kmeans_bic, reduced, max_clusters, random_state)
+
+    def __call__(self, embeddings, random_state: int) -> tuple[int, list[int]]:
+        """(number of clusters, cluster label of every embedding)"""
+        reduced = self.reduce(np.asarray(embeddings, dtype=np.float32))
+        n_clusters = self.n_clusters(reduced, random_state)
+        if n_clusters == 1:
+            return 1, [0 for _ in range(len(reduced))]
+        if self.mode == "kmeans":
+            km = MiniBatchKMeans(n_clusters=n_clusters, random_state=random_state, batch_size=1024, n_init=3)
+            return n_clusters, [int(lbl) for lbl in km.fit_predict(reduced)]
+        gm = GaussianMixture(n_components=n_clusters, random_state=random_state)
+        gm.fit(reduced)
+        probs = gm.predict_proba(reduced)
+        lbls = [np.where(prob > self._threshold)[0] for prob in probs]
+        lbls = [lbl[0] if isinstance(lbl, np.ndarray) else lbl for lbl in lbls]
+        return n_clusters, lbls
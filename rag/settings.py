@@ -33,6 +33,10 @@ except Exception:
     REDIS = {}
     pass
 DOC_MAXIMUM_SIZE = int(os.environ.get("MAX_CONTENT_LENGTH", 128 * 1024 * 1024))
+DOC_BULK_MAX_DOCS = int(os.environ.get("DOC_BULK_MAX_DOCS", 512))
+DOC_BULK_MAX_BYTES = int(os.environ.get("DOC_BULK_MAX_BYTES", 8 * 1024 * 1024))
+DOC_BULK_CONCURRENCY = int(os.environ.get("DOC_BULK_CONCURRENCY", 2))
+DOC_BULK_MAX_RETRIES = int(os.environ.get("DOC_BULK_MAX_RETRIES", 5))
 
 SVR_QUEUE_NAME = "rag_flow_svr_queue"
 SVR_QUEUE_RETENTION = 60*60
@@ -45,6 +49,7 @@ TAG_FLD = "tag_feas"
 
 def print_rag_settings():
     logging.info(f"MAX_CONTENT_LENGTH: {DOC_MAXIMUM_SIZE}")
+    logging.info(f"DOC_BULK_MAX_DOCS: {DOC_BULK_MAX_DOCS}, DOC_BULK_MAX_BYTES: {DOC_BULK_MAX_BYTES}, DOC_BULK_CONCURRENCY: {DOC_BULK_CONCURRENCY}")
     logging.info(f"SERVER_QUEUE_MAX_LEN: {SVR_QUEUE_MAX_LEN}")
     logging.info(f"SERVER_QUEUE_RETENTION: {SVR_QUEUE_RETENTION}")
     logging.info(f"MAX_FILE_COUNT_PER_USER: {int(os.environ.get('MAX_FILE_NUM_PER_USER', 0))}")
\ No newline at end of file
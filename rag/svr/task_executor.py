@@ -2,7 +2,7 @@ import random
 import sys
 from api.utils.log_utils import initRootLogger, get_project_base_directory
 from graphrag.general.index import run_graphrag
-from graphrag.utils import get_llm_cache, set_llm_cache, get_tags_from_cache, set_tags_to_cache
+from graphrag.utils import get_llm_cache, set_llm_cache, mget_llm_cache, mset_llm_cache, get_tags_from_cache, set_tags_to_cache
 from rag.prompts import keyword_extraction, question_proposal, content_tagging
 import logging
 import os
@@ -11,6 +11,7 @@ import json
 import xxhash
 import copy
 import re
+from collections import deque
 from functools import partial
 from io import BytesIO
 from multiprocessing.context import TimeoutError
@@ -21,21 +22,24 @@ import trio
 import exceptiongroup
 import faulthandler
 import numpy as np
+from cachetools import LRUCache
 from peewee import DoesNotExist
-from api.db import LLMType, ParserType, TaskStatus
+from api.db import LLMType, ParserType
 from api.db.services.document_service import DocumentService
 from api.db.services.llm_service import LLMBundle
 from api.db.services.task_service import TaskService
 from api.db.services.file2document_service import File2DocumentService
 from api import settings
 from api.versions import get_ragflow_version
-from api.db.db_models import close_connection
 from rag.app import laws, paper, presentation, manual, qa, table, book, resume, picture, naive, one, audio, \
     email, tag
 from rag.nlp import search, rag_tokenizer
 from rag.raptor import RecursiveAbstractiveProcessing4TreeOrganizedRetrieval as Raptor
 from rag.settings import DOC_MAXIMUM_SIZE, SVR_QUEUE_NAME, print_rag_settings, TAG_FLD, PAGERANK_FLD
 from rag.utils import num_tokens_from_string
+from rag.utils.bulk_indexer import open_bulk_indexer
+from rag.utils.embedding_cache import EMBEDDING_CACHE
+from rag.utils.progress_reporter import PROGRESS_REPORTER
 from rag.utils.redis_conn import REDIS_CONN
 from rag.utils.storage_factory import STORAGE_IMPL
 from graphrag.utils import chat_limiter
@@ -76,8 +80,25 @@ CURRENT_TASKS = {}
 
 MAX_CONCURRENT_TASKS = int(os.environ.get('MAX_CONCURRENT_TASKS', "5"))
 MAX_CONCURRENT_CHUNK_BUILDERS = int(os.environ.get('MAX_CONCURRENT_CHUNK_BUILDERS', "1"))
+# Streaming pipeline: chunks flow through enrichment, embedding and indexing over bounded channels.
+PIPELINE_ENABLED = int(os.environ.get('TASK_PIPELINE_ENABLED', "0"))
+PIPELINE_CHANNEL_SIZE = int(os.environ.get('TASK_PIPELINE_CHANNEL_SIZE', "256"))
+PIPELINE_ENRICH_WORKERS = int(os.environ.get('TASK_PIPELINE_ENRICH_WORKERS', "8"))
+MAX_CONCURRENT_EMBEDDINGS = int(os.environ.get('MAX_CONCURRENT_EMBEDDINGS', "4"))
+EMBEDDING_LIMITERS_SIZE = int(os.environ.get('EMBEDDING_LIMITERS_SIZE', "1024"))
+# Most messages claimed per XREADGROUP, never more than the free task slots: claimed messages
+# wait in a local ready queue, out of reach of the other executors.
+TASK_PREFETCH = int(os.environ.get('TASK_PREFETCH', str(MAX_CONCURRENT_TASKS)))
+# Pending messages of a consumer without heartbeat for this long (seconds) are claimed by the others.
+TASK_CONSUMER_DEAD_AFTER = int(os.environ.get('TASK_CONSUMER_DEAD_AFTER', "180"))
+TASK_CLAIM_INTERVAL = int(os.environ.get('TASK_CLAIM_INTERVAL', "60"))
 task_limiter = trio.CapacityLimiter(MAX_CONCURRENT_TASKS)
+READY_TASKS = deque()
+LAST_CLAIM_AT = 0
 chunk_limiter = trio.CapacityLimiter(MAX_CONCURRENT_CHUNK_BUILDERS)
+# Embedding requests in flight per tenant, shared by all the tasks of the tenant. Only the tenants
+# seen lately are kept: a limiter evicted while in use just lets one more batch of requests through.
+embedding_limiters = LRUCache(maxsize=max(1, EMBEDDING_LIMITERS_SIZE))
 
 # SIGUSR1 handler: start tracemalloc and take snapshot
 def start_tracemalloc_and_snapshot(signum, frame):
@@ -120,7 +141,7 @@ def set_progress(task_id, from_page=0, to_page=-1, prog=None, msg="Processing...
     try:
         if prog is not None and prog < 0:
             msg = "[ERROR]" + msg
-        cancel = TaskService.do_cancel(task_id)
+        cancel = PROGRESS_REPORTER.is_canceled(task_id)
 
         if cancel:
             msg += " [Canceled]"
@@ -136,9 +157,8 @@ def set_progress(task_id, from_page=0, to_page=-1, prog=None, msg="Processing...
         if prog is not None:
             d["progress"] = prog
 
-        TaskService.update_progress(task_id, d)
-
-        close_connection()
+        # Ticks are coalesced and written in bulk; final states go out right away.
+        PROGRESS_REPORTER.report(task_id, d, final=cancel or (prog is not None and (prog < 0 or prog >= 1)))
         if cancel:
             raise TaskCanceledException(msg)
         logging.info(f"set_progress({task_id}), progress: {prog}, progress_msg: {msg}")
@@ -147,49 +167,89 @@ def set_progress(task_id, from_page=0, to_page=-1, prog=None, msg="Processing...
     except Exception:
         logging.exception(f"set_progress({task_id}), progress: {prog}, progress_msg: {msg}, got exception")
 
+def queue_wait(redis_msg):
+    """Seconds since the message was queued, from the millisecond part of the stream entry id."""
+    try:
+        return max(0., datetime.now().timestamp() - int(str(redis_msg.get_msg_id()).split("-")[0]) / 1000.)
+    except ValueError:
+        return 0.
+
+
+def dead_consumers():
+    now = datetime.now().timestamp()
+    consumers = REDIS_CONN.smembers("TASKEXE") or []
+    return [c for c in consumers if c != CONSUMER_NAME and REDIS_CONN.zcount(c, now - TASK_CONSUMER_DEAD_AFTER, "+inf") == 0]
+
+
+def fetch_messages(count):
+    global UNACKED_ITERATOR, LAST_CLAIM_AT
+    if not UNACKED_ITERATOR:
+        UNACKED_ITERATOR = REDIS_CONN.get_unacked_iterator(SVR_QUEUE_NAME, "rag_flow_svr_task_broker", CONSUMER_NAME)
+    redis_msgs = []
+    for redis_msg in UNACKED_ITERATOR:
+        redis_msgs.append(redis_msg)
+        if len(redis_msgs) >= count:
+            return redis_msgs
+
+    now = datetime.now().timestamp()
+    if now - LAST_CLAIM_AT >= TASK_CLAIM_INTERVAL:
+        LAST_CLAIM_AT = now
+        redis_msgs.extend(REDIS_CONN.queue_claim(SVR_QUEUE_NAME, "rag_flow_svr_task_broker", CONSUMER_NAME, dead_consumers(),
+                                                 TASK_CONSUMER_DEAD_AFTER * 1000, count - len(redis_msgs)))
+    if len(redis_msgs) < count:
+        redis_msgs.extend(REDIS_CONN.queue_consumer_batch(SVR_QUEUE_NAME, "rag_flow_svr_task_broker", CONSUMER_NAME, count - len(redis_msgs)))
+    return redis_msgs
+
+
+def prefetch():
+    """
+    Claim as many messages as there are free task slots, at most TASK_PREFETCH, and load their
+    tasks with one batched query into READY_TASKS. The slot of the caller is already taken.
+    """
+    global FAILED_TASKS
+    redis_msgs = []
+    for redis_msg in fetch_messages(max(1, min(TASK_PREFETCH, int(task_limiter.available_tokens) + 1))):
+        if not redis_msg.get_message():
+            logging.error(f"collect got empty message of {redis_msg.get_msg_id()}")
+            redis_msg.ack()
+            continue
+        redis_msgs.append(redis_msg)
+    if not redis_msgs:
+        return
+
+    tasks = TaskService.get_task_batch([m.get_message()["id"] for m in redis_msgs])
+    for redis_msg in redis_msgs:
+        msg = redis_msg.get_message()
+        task = copy.deepcopy(tasks.get(msg["id"]))
+        if not task or task.pop("canceled"):
+            state = "is unknown" if not task else "has been cancelled"
+            FAILED_TASKS += 1
+            logging.warning(f"collect task {msg['id']} {state}")
+            redis_msg.ack()
+            continue
+        task["task_type"] = msg.get("task_type", "")
+        READY_TASKS.append((redis_msg, task))
+
+
 async def collect():
-    global CONSUMER_NAME, DONE_TASKS, FAILED_TASKS
-    global UNACKED_ITERATOR
     try:
-        if not UNACKED_ITERATOR:
-            UNACKED_ITERATOR = REDIS_CONN.get_unacked_iterator(SVR_QUEUE_NAME, "rag_flow_svr_task_broker", CONSUMER_NAME)
-        try:
-            redis_msg = next(UNACKED_ITERATOR)
-        except StopIteration:
-            redis_msg = REDIS_CONN.queue_consumer(SVR_QUEUE_NAME, "rag_flow_svr_task_broker", CONSUMER_NAME)
-        if not redis_msg:
+        if not READY_TASKS:
+            prefetch()
+        if not READY_TASKS:
             await trio.sleep(1)
             return None, None
     except Exception:
         logging.exception("collect got exception")
+        await trio.sleep(1)
         return None, None
-
-    msg = redis_msg.get_message()
-    if not msg:
-        logging.error(f"collect got empty message of {redis_msg.get_msg_id()}")
-        redis_msg.ack()
-        return None, None
-
-    canceled = False
-    task = TaskService.get_task(msg["id"])
-    if task:
-        _, doc = DocumentService.get_by_id(task["doc_id"])
-        canceled = doc.run == TaskStatus.CANCEL.value or doc.progress < 0
-    if not task or canceled:
-        state = "is unknown" if not task else "has been cancelled"
-        FAILED_TASKS += 1
-        logging.warning(f"collect task {msg['id']} {state}")
-        redis_msg.ack()
-        return None, None
-    task["task_type"] = msg.get("task_type", "")
-    return redis_msg, task
+    return READY_TASKS.popleft()
 
 
 async def get_storage_binary(bucket, name):
     return await trio.to_thread.run_sync(lambda: STORAGE_IMPL.get(bucket, name))
 
 
-async def build_chunks(task, progress_callback):
+async def chunk_document(task, progress_callback):
     if task["size"] > DOC_MAXIMUM_SIZE:
         set_progress(task["id"], prog=-1, msg="File size exceeds( <= %dMb )" %
                                               (int(DOC_MAXIMUM_SIZE / 1024 / 1024)))
@@ -226,85 +286,155 @@ async def build_chunks(task, progress_callback):
         progress_callback(-1, "Internal server error while chunking: %s" % str(e).replace("'", ""))
         logging.exception("Chunking {}/{} got exception".format(task["location"], task["name"]))
         raise
+    return cks
 
-    docs = []
-    doc = {
+
+async def make_chunk_doc(task, ck):
+    d = {
         "doc_id": task["doc_id"],
         "kb_id": str(task["kb_id"])
     }
     if task["pagerank"]:
-        doc[PAGERANK_FLD] = int(task["pagerank"])
-    el = 0
-    for ck in cks:
-        d = copy.deepcopy(doc)
-        d.update(ck)
-        d["id"] = xxhash.xxh64((ck["content_with_weight"] + str(d["doc_id"])).encode("utf-8")).hexdigest()
-        d["create_time"] = str(datetime.now()).replace("T", " ")[:19]
-        d["create_timestamp_flt"] = datetime.now().timestamp()
-        if not d.get("image"):
-            _ = d.pop("image", None)
-            d["img_id"] = ""
-            docs.append(d)
-            continue
+        d[PAGERANK_FLD] = int(task["pagerank"])
+    d.update(ck)
+    d["id"] = xxhash.xxh64((ck["content_with_weight"] + str(d["doc_id"])).encode("utf-8")).hexdigest()
+    d["create_time"] = str(datetime.now()).replace("T", " ")[:19]
+    d["create_timestamp_flt"] = datetime.now().timestamp()
+    if not d.get("image"):
+        _ = d.pop("image", None)
+        d["img_id"] = ""
+        return d
 
-        try:
-            output_buffer = BytesIO()
-            if isinstance(d["image"], bytes):
-                output_buffer = BytesIO(d["image"])
+    try:
+        output_buffer = BytesIO()
+        if isinstance(d["image"], bytes):
+            output_buffer = BytesIO(d["image"])
+        else:
+            d["image"].save(output_buffer, format='JPEG')
+        await trio.to_thread.run_sync(lambda: STORAGE_IMPL.put(task["kb_id"], d["id"], output_buffer.getvalue()))
+    except Exception:
+        logging.exception(
+            "Saving image of chunk {}/{}/{} got exception".format(task["location"], task["name"], d["id"]))
+        raise
+
+    d["img_id"] = "{}-{}".format(task["kb_id"], d["id"])
+    del d["image"]
+    return d
+
+
+def set_keywords(d, cached):
+    if cached:
+        d["important_kwd"] = cached.split(",")
+        d["important_tks"] = rag_tokenizer.tokenize(" ".join(d["important_kwd"]))
+
+
+def set_questions(d, cached):
+    if cached:
+        d["question_kwd"] = cached.split("\n")
+        d["question_tks"] = rag_tokenizer.tokenize("\n".join(d["question_kwd"]))
+
+
+def set_tags(d, cached):
+    if cached:
+        d[TAG_FLD] = json.loads(cached)
+
+
+async def doc_keyword_extraction(chat_mdl, d, topn):
+    cached = get_llm_cache(chat_mdl.llm_name, d["content_with_weight"], "keywords", {"topn": topn})
+    if not cached:
+        async with chat_limiter:
+            cached = await trio.to_thread.run_sync(lambda: keyword_extraction(chat_mdl, d["content_with_weight"], topn))
+        set_llm_cache(chat_mdl.llm_name, d["content_with_weight"], cached, "keywords", {"topn": topn})
+    set_keywords(d, cached)
+
+
+async def doc_question_proposal(chat_mdl, d, topn):
+    cached = get_llm_cache(chat_mdl.llm_name, d["content_with_weight"], "question", {"topn": topn})
+    if not cached:
+        async with chat_limiter:
+            cached = await trio.to_thread.run_sync(lambda: question_proposal(chat_mdl, d["content_with_weight"], topn))
+        set_llm_cache(chat_mdl.llm_name, d["content_with_weight"], cached, "question", {"topn": topn})
+    set_questions(d, cached)
+
+
+async def docs_llm_generate(chat_mdl, docs, history, genconf, generate, apply):
+    """
+    LLM enrichment of many chunks: the cache is checked for all of them in one round trip,
+    only the misses go to the LLM, and the new answers are written back in one pipeline.
+    """
+    cached = await mget_llm_cache(chat_mdl.llm_name, [d["content_with_weight"] for d in docs], history, genconf)
+    answers = {}
+
+    async def gen(d):
+        async with chat_limiter:
+            ans = await trio.to_thread.run_sync(lambda: generate(d))
+        if ans:
+            answers[d["content_with_weight"]] = ans
+        apply(d, ans)
+
+    async with trio.open_nursery() as nursery:
+        for d, ans in zip(docs, cached):
+            if ans:
+                apply(d, ans)
             else:
-                d["image"].save(output_buffer, format='JPEG')
+                nursery.start_soon(gen, d)
+    await mset_llm_cache(chat_mdl.llm_name, answers, history, genconf)
+    return len(docs) - len([a for a in cached if a])
+
+
+def get_all_tags(task, S=1000):
+    kb_ids = task["kb_parser_config"]["tag_kb_ids"]
+    all_tags = get_tags_from_cache(kb_ids)
+    if not all_tags:
+        all_tags = settings.retrievaler.all_tags_in_portion(task["tenant_id"], kb_ids, S)
+        set_tags_to_cache(kb_ids, all_tags)
+    else:
+        all_tags = json.loads(all_tags)
+    return all_tags
 
-            st = timer()
-            await trio.to_thread.run_sync(lambda: STORAGE_IMPL.put(task["kb_id"], d["id"], output_buffer.getvalue()))
-            el += timer() - st
-        except Exception:
-            logging.exception(
-                "Saving image of chunk {}/{}/{} got exception".format(task["location"], task["name"], d["id"]))
-            raise
 
-        d["img_id"] = "{}-{}".format(task["kb_id"], d["id"])
-        del d["image"]
-        docs.append(d)
-    logging.info("MINIO PUT({}):{}".format(task["name"], el))
+def content_tagging_answer(chat_mdl, d, all_tags, examples, topn_tags):
+    picked_examples = random.choices(examples, k=2) if len(examples)>2 else examples
+    cached = content_tagging(chat_mdl, d["content_with_weight"], all_tags, picked_examples, topn=topn_tags)
+    return json.dumps(cached) if cached else cached
+
+
+async def doc_content_tagging(chat_mdl, d, all_tags, examples, topn_tags):
+    cached = get_llm_cache(chat_mdl.llm_name, d["content_with_weight"], all_tags, {"topn": topn_tags})
+    if not cached:
+        async with chat_limiter:
+            cached = await trio.to_thread.run_sync(lambda: content_tagging_answer(chat_mdl, d, all_tags, examples, topn_tags))
+    if cached:
+        set_llm_cache(chat_mdl.llm_name, d["content_with_weight"], cached, all_tags, {"topn": topn_tags})
+        set_tags(d, cached)
+
+
+async def build_chunks(task, progress_callback):
+    cks = await chunk_document(task, progress_callback)
+
+    st = timer()
+    docs = []
+    for ck in cks:
+        docs.append(await make_chunk_doc(task, ck))
+    logging.info("MINIO PUT({}):{}".format(task["name"], timer() - st))
 
     if task["parser_config"].get("auto_keywords", 0):
         st = timer()
         progress_callback(msg="Start to generate keywords for every chunk ...")
         chat_mdl = LLMBundle(task["tenant_id"], LLMType.CHAT, llm_name=task["llm_id"], lang=task["language"])
-
-        async def doc_keyword_extraction(chat_mdl, d, topn):
-            cached = get_llm_cache(chat_mdl.llm_name, d["content_with_weight"], "keywords", {"topn": topn})
-            if not cached:
-                async with chat_limiter:
-                    cached = await trio.to_thread.run_sync(lambda: keyword_extraction(chat_mdl, d["content_with_weight"], topn))
-                set_llm_cache(chat_mdl.llm_name, d["content_with_weight"], cached, "keywords", {"topn": topn})
-            if cached:
-                d["important_kwd"] = cached.split(",")
-                d["important_tks"] = rag_tokenizer.tokenize(" ".join(d["important_kwd"]))
-            return
-        async with trio.open_nursery() as nursery:
-            for d in docs:
-                nursery.start_soon(lambda: doc_keyword_extraction(chat_mdl, d, task["parser_config"]["auto_keywords"]))
-        progress_callback(msg="Keywords generation {} chunks completed in {:.2f}s".format(len(docs), timer() - st))
+        topn = task["parser_config"]["auto_keywords"]
+        missed = await docs_llm_generate(chat_mdl, docs, "keywords", {"topn": topn},
+                                         lambda d: keyword_extraction(chat_mdl, d["content_with_weight"], topn), set_keywords)
+        progress_callback(msg="Keywords generation {} chunks ({} not cached) completed in {:.2f}s".format(len(docs), missed, timer() - st))
 
     if task["parser_config"].get("auto_questions", 0):
         st = timer()
         progress_callback(msg="Start to generate questions for every chunk ...")
         chat_mdl = LLMBundle(task["tenant_id"], LLMType.CHAT, llm_name=task["llm_id"], lang=task["language"])
-
-        async def doc_question_proposal(chat_mdl, d, topn):
-            cached = get_llm_cache(chat_mdl.llm_name, d["content_with_weight"], "question", {"topn": topn})
-            if not cached:
-                async with chat_limiter:
-                    cached = await trio.to_thread.run_sync(lambda: question_proposal(chat_mdl, d["content_with_weight"], topn))
-                set_llm_cache(chat_mdl.llm_name, d["content_with_weight"], cached, "question", {"topn": topn})
-            if cached:
-                d["question_kwd"] = cached.split("\n")
-                d["question_tks"] = rag_tokenizer.tokenize("\n".join(d["question_kwd"]))
-        async with trio.open_nursery() as nursery:
-            for d in docs:
-                nursery.start_soon(lambda: doc_question_proposal(chat_mdl, d, task["parser_config"]["auto_questions"]))
-        progress_callback(msg="Question generation {} chunks completed in {:.2f}s".format(len(docs), timer() - st))
+        topn = task["parser_config"]["auto_questions"]
+        missed = await docs_llm_generate(chat_mdl, docs, "question", {"topn": topn},
+                                         lambda d: question_proposal(chat_mdl, d["content_with_weight"], topn), set_questions)
+        progress_callback(msg="Question generation {} chunks ({} not cached) completed in {:.2f}s".format(len(docs), missed, timer() - st))
 
     if task["kb_parser_config"].get("tag_kb_ids", []):
         progress_callback(msg="Start to tag for every chunk ...")
@@ -314,12 +444,7 @@ async def build_chunks(task, progress_callback):
         S = 1000
         st = timer()
         examples = []
-        all_tags = get_tags_from_cache(kb_ids)
-        if not all_tags:
-            all_tags = settings.retrievaler.all_tags_in_portion(tenant_id, kb_ids, S)
-            set_tags_to_cache(kb_ids, all_tags)
-        else:
-            all_tags = json.loads(all_tags)
+        all_tags = get_all_tags(task, S)
 
         chat_mdl = LLMBundle(task["tenant_id"], LLMType.CHAT, llm_name=task["llm_id"], lang=task["language"])
 
@@ -330,20 +455,8 @@ async def build_chunks(task, progress_callback):
             else:
                 docs_to_tag.append(d)
 
-        async def doc_content_tagging(chat_mdl, d, topn_tags):
-            cached = get_llm_cache(chat_mdl.llm_name, d["content_with_weight"], all_tags, {"topn": topn_tags})
-            if not cached:
-                picked_examples = random.choices(examples, k=2) if len(examples)>2 else examples
-                async with chat_limiter:
-                    cached = await trio.to_thread.run_sync(lambda: content_tagging(chat_mdl, d["content_with_weight"], all_tags, picked_examples, topn=topn_tags))
-                if cached:
-                    cached = json.dumps(cached)
-            if cached:
-                set_llm_cache(chat_mdl.llm_name, d["content_with_weight"], cached, all_tags, {"topn": topn_tags})
-                d[TAG_FLD] = json.loads(cached)
-        async with trio.open_nursery() as nursery:
-            for d in docs_to_tag:
-                nursery.start_soon(lambda: doc_content_tagging(chat_mdl, d, topn_tags))
+        await docs_llm_generate(chat_mdl, docs_to_tag, all_tags, {"topn": topn_tags},
+                                lambda d: content_tagging_answer(chat_mdl, d, all_tags, examples, topn_tags), set_tags)
         progress_callback(msg="Tagging {} chunks completed in {:.2f}s".format(len(docs), timer() - st))
 
     return docs
@@ -354,10 +467,38 @@ def init_kb(row, vector_size: int):
     return settings.docStoreConn.createIdx(idxnm, row.get("kb_id", ""), vector_size)
 
 
+def get_embedding_limiter(tenant_id):
+    limiter = embedding_limiters.get(tenant_id)
+    if limiter is None:
+        limiter = embedding_limiters[tenant_id] = trio.CapacityLimiter(MAX_CONCURRENT_EMBEDDINGS)
+    return limiter
+
+
+def plan_embedding_batches(texts, mdl):
+    """
+    Cuts texts into [start, end) ranges which fit in one request of the embedding provider:
+    at most `max_batch_size` inputs and, if the provider caps it, `max_batch_tokens` tokens.
+    The character count, clipped at the per-input token limit, stands in for the token count.
+    """
+    max_batch_size = getattr(mdl.mdl, "max_batch_size", 16)
+    max_tokens = getattr(mdl.mdl, "max_tokens", 8191)
+    max_batch_tokens = getattr(mdl.mdl, "max_batch_tokens", 0)
+    batches = []
+    st, tks = 0, 0
+    for i, t in enumerate(texts):
+        n = min(len(t), max_tokens)
+        if i > st and (i - st >= max_batch_size or (max_batch_tokens and tks + n > max_batch_tokens)):
+            batches.append((st, i))
+            st, tks = i, 0
+        tks += n
+    if st < len(texts):
+        batches.append((st, len(texts)))
+    return batches
+
+
 async def embedding(docs, mdl, parser_config=None, callback=None):
     if parser_config is None:
         parser_config = {}
-    batch_size = 16
     tts, cnts = [], []
     for d in docs:
         tts.append(d.get("docnm_kwd", "Title"))
@@ -370,41 +511,205 @@ async def embedding(docs, mdl, parser_config=None, callback=None):
         cnts.append(c)
 
     tk_count = 0
+    title_vec = None
     if len(tts) == len(cnts):
         vts, c = await trio.to_thread.run_sync(lambda: mdl.encode(tts[0: 1]))
-        tts = np.concatenate([vts for _ in range(len(tts))], axis=0)
+        title_vec = np.asarray(vts[0], dtype=np.float32)
         tk_count += c
 
-    cnts_ = np.array([])
-    for i in range(0, len(cnts), batch_size):
-        vts, c = await trio.to_thread.run_sync(lambda: mdl.encode(cnts[i: i + batch_size]))
-        if len(cnts_) == 0:
-            cnts_ = vts
-        else:
-            cnts_ = np.concatenate((cnts_, vts), axis=0)
+    # Batches run concurrently under the tenant's limiter and land in one preallocated matrix.
+    vects = np.empty((len(cnts), len(title_vec)), dtype=np.float32) if title_vec is not None else None
+    limiter = get_embedding_limiter(mdl.tenant_id)
+    done = 0
+
+    async def encode_batch(st, ed):
+        nonlocal tk_count, vects, done
+        async with limiter:
+            vts, c = await trio.to_thread.run_sync(lambda: mdl.encode(cnts[st: ed]))
+        if vects is None:
+            vects = np.empty((len(cnts), len(vts[0])), dtype=np.float32)
+        vects[st: ed] = vts
         tk_count += c
-        callback(prog=0.7 + 0.2 * (i + 1) / len(cnts), msg="")
-    cnts = cnts_
+        done += ed - st
+        if callback:
+            callback(prog=0.7 + 0.2 * done / len(cnts), msg="")
+
+    async with trio.open_nursery() as nursery:
+        for st, ed in plan_embedding_batches(cnts, mdl):
+            nursery.start_soon(encode_batch, st, ed)
 
-    title_w = float(parser_config.get("filename_embd_weight", 0.1))
-    vects = (title_w * tts + (1 - title_w) *
-             cnts) if len(tts) == len(cnts) else cnts
+    if title_vec is not None:
+        title_w = float(parser_config.get("filename_embd_weight", 0.1))
+        vects *= 1 - title_w
+        vects += title_w * title_vec
 
     assert len(vects) == len(docs)
-    vector_size = 0
+    vector_size = vects.shape[1]
     for i, d in enumerate(docs):
-        v = vects[i].tolist()
-        vector_size = len(v)
-        d["q_%d_vec" % len(v)] = v
+        d["q_%d_vec" % vector_size] = vects[i].tolist()
     return tk_count, vector_size
 
 
+def index_checkpoint(task, total, progress_callback):
+    """
+    Returns the BulkIndexer checkpoint of the task: persists the ids indexed so far and reports progress.
+    """
+    def checkpoint(chunk_ids):
+        try:
+            TaskService.update_chunk_ids(task["id"], " ".join(chunk_ids))
+        except DoesNotExist:
+            logging.warning(f"update_chunk_ids failed since task {task['id']} is unknown.")
+            return False
+        progress_callback(prog=0.8 + 0.1 * len(chunk_ids) / max(1, total), msg="")
+        return True
+    return checkpoint
+
+
+async def handle_index_result(task, indexer, progress_callback):
+    """
+    Returns True if the indexer finished cleanly. Aborted indexing (the task vanished) is rolled back.
+    """
+    if indexer.error:
+        error_message = f"Insert chunk error: {indexer.error}, please check log file and Elasticsearch/Infinity status!"
+        progress_callback(-1, msg=error_message)
+        raise Exception(error_message)
+    if indexer.aborted:
+        chunk_ids = indexer.written_ids
+        await trio.to_thread.run_sync(lambda: settings.docStoreConn.delete({"id": chunk_ids}, search.index_name(task["tenant_id"]), task["kb_id"]))
+        return False
+    return True
+
+
+async def index_chunks(task, chunks, progress_callback):
+    async with open_bulk_indexer(settings.docStoreConn, search.index_name(task["tenant_id"]), task["kb_id"],
+                                 index_checkpoint(task, len(chunks), progress_callback)) as indexer:
+        await indexer.add_many(chunks)
+    logging.info("index_chunks({}): {} chunks in {} bulks, {} retries".format(task["name"], len(chunks), indexer.bulk_count, indexer.retry_count))
+    return await handle_index_result(task, indexer, progress_callback)
+
+
+async def run_pipeline(task, embedding_model, progress_callback):
+    """
+    Streaming counterpart of build_chunks + embedding + indexing. Chunks are handed from
+    stage to stage through bounded trio memory channels, so the LLM, the embedding backend
+    and the doc store work at the same time. A full channel blocks its producer, which is
+    the per-stage back-pressure; the time spent blocked is reported along with busy time.
+    Returns (chunk_count, token_count), or None if the task disappeared while indexing.
+    """
+    parser_config = task["parser_config"]
+    index_nm = search.index_name(task["tenant_id"])
+    stats = {stage: {"busy": 0., "blocked": 0., "count": 0} for stage in ["chunk", "enrich", "embed", "insert"]}
+
+    st = timer()
+    cks = await chunk_document(task, progress_callback)
+    stats["chunk"]["busy"] += timer() - st
+    if not cks:
+        progress_callback(1., msg=f"No chunk built from {task['name']}")
+        return 0, 0
+    progress_callback(msg="Generate {} chunks, start streaming pipeline".format(len(cks)))
+
+    chat_mdl = None
+    auto_keywords = parser_config.get("auto_keywords", 0)
+    auto_questions = parser_config.get("auto_questions", 0)
+    tag_kb_ids = task["kb_parser_config"].get("tag_kb_ids", [])
+    if auto_keywords or auto_questions or tag_kb_ids:
+        chat_mdl = LLMBundle(task["tenant_id"], LLMType.CHAT, llm_name=task["llm_id"], lang=task["language"])
+    topn_tags = task["kb_parser_config"].get("topn_tags", 3)
+    all_tags = get_all_tags(task) if tag_kb_ids else {}
+    examples = []
+
+    async def send(stage, channel, d):
+        st = timer()
+        await channel.send(d)
+        stats[stage]["blocked"] += timer() - st
+
+    async def chunk_stage(send_channel):
+        async with send_channel:
+            for ck in cks:
+                st = timer()
+                d = await make_chunk_doc(task, ck)
+                stats["chunk"]["busy"] += timer() - st
+                stats["chunk"]["count"] += 1
+                await send("chunk", send_channel, d)
+
+    async def enrich_stage(receive_channel, send_channel):
+        async with receive_channel, send_channel:
+            async for d in receive_channel:
+                st = timer()
+                if auto_keywords:
+                    await doc_keyword_extraction(chat_mdl, d, auto_keywords)
+                if auto_questions:
+                    await doc_question_proposal(chat_mdl, d, auto_questions)
+                if tag_kb_ids:
+                    if await trio.to_thread.run_sync(lambda: settings.retrievaler.tag_content(task["tenant_id"], tag_kb_ids, d, all_tags, topn_tags=topn_tags)):
+                        examples.append({"content": d["content_with_weight"], TAG_FLD: d[TAG_FLD]})
+                    else:
+                        await doc_content_tagging(chat_mdl, d, all_tags, examples, topn_tags)
+                stats["enrich"]["busy"] += timer() - st
+                stats["enrich"]["count"] += 1
+                await send("enrich", send_channel, d)
+
+    token_count = 0
+
+    async def embed_stage(receive_channel, send_channel):
+        async def flush(batch):
+            nonlocal token_count
+            st = timer()
+            tk_count, _ = await embedding(batch, embedding_model, parser_config)
+            token_count += tk_count
+            stats["embed"]["busy"] += timer() - st
+            stats["embed"]["count"] += len(batch)
+            for d in batch:
+                await send("embed", send_channel, d)
+
+        async with receive_channel, send_channel:
+            batch = []
+            async for d in receive_channel:
+                batch.append(d)
+                if len(batch) >= BATCH_SIZE:
+                    await flush(batch)
+                    batch = []
+            if batch:
+                await flush(batch)
+
+    async def insert_stage(receive_channel, indexer):
+        async with receive_channel:
+            async for d in receive_channel:
+                st = timer()
+                await indexer.add(d)
+                stats["insert"]["busy"] += timer() - st
+                stats["insert"]["count"] += 1
+
+    enrich_send, enrich_receive = trio.open_memory_channel(PIPELINE_CHANNEL_SIZE)
+    embed_send, embed_receive = trio.open_memory_channel(PIPELINE_CHANNEL_SIZE)
+    insert_send, insert_receive = trio.open_memory_channel(PIPELINE_CHANNEL_SIZE)
+    st = timer()
+    async with open_bulk_indexer(settings.docStoreConn, index_nm, task["kb_id"],
+                                 index_checkpoint(task, len(cks), progress_callback)) as indexer:
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(chunk_stage, enrich_send)
+            async with enrich_receive, embed_send:
+                for _ in range(max(1, PIPELINE_ENRICH_WORKERS if chat_mdl else 1)):
+                    nursery.start_soon(enrich_stage, enrich_receive.clone(), embed_send.clone())
+            nursery.start_soon(embed_stage, embed_receive, insert_send)
+            nursery.start_soon(insert_stage, insert_receive, indexer)
+    if not await handle_index_result(task, indexer, progress_callback):
+        return None
+
+    inserted_ids = indexer.indexed_ids
+    progress_callback(msg="Pipeline of {} chunks done ({:.2f}s): {}".format(
+        len(inserted_ids), timer() - st,
+        ", ".join(["{} {:.2f}s/blocked {:.2f}s".format(stage, s["busy"], s["blocked"]) for stage, s in stats.items()])))
+    logging.info("run_pipeline({}) stats: {}".format(task["name"], json.dumps(stats)))
+    return len(set(inserted_ids)), token_count
+
+
 async def run_raptor(row, chat_mdl, embd_mdl, vector_size, callback=None):
-    chunks = []
     vctr_nm = "q_%d_vec"%vector_size
-    for d in settings.retrievaler.chunk_list(row["doc_id"], row["tenant_id"], [str(row["kb_id"])],
-                                             fields=["content_with_weight", vctr_nm]):
-        chunks.append((d["content_with_weight"], np.array(d[vctr_nm])))
+    chunks = await trio.to_thread.run_sync(lambda: [
+        (d["content_with_weight"], np.array(d[vctr_nm]))
+        for d in settings.retrievaler.chunk_list(row["doc_id"], row["tenant_id"], [str(row["kb_id"])],
+                                                 fields=["content_with_weight", vctr_nm])])
 
     raptor = Raptor(
         row["parser_config"]["raptor"].get("max_cluster", 64),
@@ -412,7 +717,8 @@ async def run_raptor(row, chat_mdl, embd_mdl, vector_size, callback=None):
         embd_mdl,
         row["parser_config"]["raptor"]["prompt"],
         row["parser_config"]["raptor"]["max_token"],
-        row["parser_config"]["raptor"]["threshold"]
+        row["parser_config"]["raptor"]["threshold"],
+        row["parser_config"]["raptor"].get("clustering")
     )
     original_length = len(chunks)
     chunks = await raptor(chunks, row["parser_config"]["raptor"]["random_seed"], callback)
@@ -500,6 +806,21 @@ async def do_handle_task(task):
         await run_graphrag(task, task_language, with_resolution, with_community, chat_model, embedding_model, progress_callback)
         progress_callback(prog=1.0, msg="Knowledge Graph done ({:.2f}s)".format(timer() - start_ts))
         return
+    elif PIPELINE_ENABLED:
+        # Standard chunking methods, streamed through overlapping stages
+        start_ts = timer()
+        res = await run_pipeline(task, embedding_model, progress_callback)
+        if not res or not res[0]:
+            return
+        chunk_count, token_count = res
+        DocumentService.increment_chunk_num(task_doc_id, task_dataset_id, token_count, chunk_count, 0)
+        task_time_cost = timer() - task_start_ts
+        progress_callback(prog=1.0, msg="Indexing done ({:.2f}s). Task done ({:.2f}s)".format(timer() - start_ts, task_time_cost))
+        logging.info(
+            "Chunk doc({}), page({}-{}), chunks({}), token({}), elapsed:{:.2f}".format(task_document_name, task_from_page,
+                                                                                       task_to_page, chunk_count,
+                                                                                       token_count, task_time_cost))
+        return
     else:
         # Standard chunking methods
         start_ts = timer()
@@ -528,24 +849,8 @@ async def do_handle_task(task):
 
     chunk_count = len(set([chunk["id"] for chunk in chunks]))
     start_ts = timer()
-    doc_store_result = ""
-    es_bulk_size = 4
-    for b in range(0, len(chunks), es_bulk_size):
-        doc_store_result = await trio.to_thread.run_sync(lambda: settings.docStoreConn.insert(chunks[b:b + es_bulk_size], search.index_name(task_tenant_id), task_dataset_id))
-        if b % 128 == 0:
-            progress_callback(prog=0.8 + 0.1 * (b + 1) / len(chunks), msg="")
-        if doc_store_result:
-            error_message = f"Insert chunk error: {doc_store_result}, please check log file and Elasticsearch/Infinity status!"
-            progress_callback(-1, msg=error_message)
-            raise Exception(error_message)
-        chunk_ids = [chunk["id"] for chunk in chunks[:b + es_bulk_size]]
-        chunk_ids_str = " ".join(chunk_ids)
-        try:
-            TaskService.update_chunk_ids(task["id"], chunk_ids_str)
-        except DoesNotExist:
-            logging.warning(f"do_handle_task update_chunk_ids failed since task {task['id']} is unknown.")
-            doc_store_result = await trio.to_thread.run_sync(lambda: settings.docStoreConn.delete({"id": chunk_ids}, search.index_name(task_tenant_id), task_dataset_id))
-            return
+    if not await index_chunks(task, chunks, progress_callback):
+        return
     logging.info("Indexing doc({}), page({}-{}), chunks({}), elapsed: {:.2f}".format(task_document_name, task_from_page,
                                                                                      task_to_page, len(chunks),
                                                                                      timer() - start_ts))
@@ -561,12 +866,11 @@ async def do_handle_task(task):
                                                                                    token_count, task_time_cost))
 
 
-async def handle_task():
+async def handle_task(redis_msg, task, slot):
     global DONE_TASKS, FAILED_TASKS
-    redis_msg, task = await collect()
-    if not task:
-        return
     try:
+        task["queue_wait"] = round(queue_wait(redis_msg), 3)
+        TaskService.mark_received(task["id"])
         logging.info(f"handle_task begin for task {json.dumps(task)}")
         CURRENT_TASKS[task["id"]] = copy.deepcopy(task)
         await do_handle_task(task)
@@ -585,6 +889,9 @@ async def handle_task():
         except Exception:
             pass
         logging.exception(f"handle_task got exception for task {json.dumps(task)}")
+    finally:
+        PROGRESS_REPORTER.forget(task["id"])
+        task_limiter.release_on_behalf_of(slot)
     redis_msg.ack()
 
 
@@ -608,7 +915,9 @@ async def report_status():
                 "lag": LAG_TASKS,
                 "done": DONE_TASKS,
                 "failed": FAILED_TASKS,
+                "ready": len(READY_TASKS),
                 "current": current,
+                "embedding_cache": EMBEDDING_CACHE.stats(),
             })
             REDIS_CONN.zadd(CONSUMER_NAME, heartbeat, now.timestamp())
             logging.info(f"{CONSUMER_NAME} reported heartbeat: {heartbeat}")
@@ -642,8 +951,14 @@ async def main():
     async with trio.open_nursery() as nursery:
         nursery.start_soon(report_status)
         while True:
-            async with task_limiter:
-                nursery.start_soon(handle_task)
+            # Take a slot first, so a collected task never waits for one outside the ready queue.
+            slot = object()
+            await task_limiter.acquire_on_behalf_of(slot)
+            redis_msg, task = await collect()
+            if not task:
+                task_limiter.release_on_behalf_of(slot)
+                continue
+            nursery.start_soon(handle_task, redis_msg, task, slot)
     logging.error("BUG!!! You should not reach here!!!")
 
 if __name__ == "__main__":
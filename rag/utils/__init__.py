@@ -16,6 +16,8 @@
 
 import os
 import re
+from functools import lru_cache
+
 import tiktoken
 from api.utils.file_utils import get_project_base_directory
 
@@ -86,6 +88,51 @@ def num_tokens_from_string(string: str) -> int:
         return 0
 
 
+TOKEN_COUNT_CACHE_SIZE = int(os.environ.get("TOKEN_COUNT_CACHE_SIZE", "4096"))
+
+
+@lru_cache(maxsize=TOKEN_COUNT_CACHE_SIZE)
+def cached_num_tokens(string: str) -> int:
+    """num_tokens_from_string, memoized for the strings counted over and over: system prompts, knowledge chunks, history."""
+    return num_tokens_from_string(string)
+
+
+_CJK_RE = re.compile(r"[\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]")
+
+
+def approx_num_tokens(string: str) -> int:
+    """Estimate of the cl100k_base token count without encoding: one token per CJK character, one per four other characters."""
+    if not string:
+        return 0
+    cjk = len(_CJK_RE.findall(string))
+    return cjk + (len(string) - cjk + 3) // 4
+
+
+class TokenCounter:
+    """
+    Token usage of a streamed completion. The provider-reported usage is used when there is one;
+    otherwise deltas are only estimated with approx_num_tokens while streaming and the answer is
+    encoded once at the end.
+    """
+
+    def __init__(self):
+        self.usage = 0
+        self.approx = 0
+
+    def add(self, delta: str = "", usage: int = 0):
+        if usage:
+            self.usage = usage
+        elif not self.usage:
+            self.approx += approx_num_tokens(delta)
+
+    def total(self, answer: str | None = None) -> int:
+        if self.usage:
+            return self.usage
+        if answer is not None:
+            return num_tokens_from_string(answer)
+        return self.approx
+
+
 def truncate(string: str, max_len: int) -> str:
     """Returns truncated text if the length of text exceed max_len."""
     return encoder.decode(encoder.encode(string)[:max_len])
@@ -0,0 +1,161 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import logging
+import random
+import re
+from contextlib import asynccontextmanager
+from typing import Callable
+
+import trio
+
+from rag import settings
+from rag.utils.doc_store_conn import DocStoreConnection
+
+logger = logging.getLogger('ragflow.bulk_indexer')
+
+# Errors worth retrying: the doc store is alive but pushing back (HTTP 429, full write queue, breaker tripped).
+RETRIABLE_ERROR = re.compile(r"(\b429\b|es_rejected_execution_exception|too_many_requests|circuit_breaking_exception|Timeout|time out)", re.IGNORECASE)
+
+
+def estimate_size(v) -> int:
+    """
+    Cheap estimation of the serialized size of a chunk, good enough to cut bulk requests by bytes.
+    """
+    if isinstance(v, str):
+        return len(v) * 3 if not v.isascii() else len(v)
+    if isinstance(v, dict):
+        return sum(len(k) + estimate_size(vv) for k, vv in v.items())
+    if isinstance(v, (list, tuple)):
+        return sum(estimate_size(vv) for vv in v) + len(v)
+    return 20
+
+
+class BulkIndexer:
+    """
+    Buffers chunks and writes them to the doc store in bulk requests bounded by document count and bytes.
+    Up to `concurrency` bulk requests are in flight at once; `add` blocks when all of them are busy.
+    Rejections (429) are retried with exponential back-off, only for the documents that were rejected.
+    After every successful bulk, `checkpoint` is called with all the chunk ids indexed so far;
+    returning False from it aborts the indexing. `written_ids` holds the ids of every document sent
+    to the doc store, indexed or not: that is what to delete to roll an aborted indexing back.
+    """
+
+    def __init__(self, doc_store: DocStoreConnection, index_name: str, knowledgebase_id: str,
+                 nursery: trio.Nursery, checkpoint: Callable[[list[str]], bool] | None = None,
+                 max_docs: int = settings.DOC_BULK_MAX_DOCS, max_bytes: int = settings.DOC_BULK_MAX_BYTES,
+                 concurrency: int = settings.DOC_BULK_CONCURRENCY, max_retries: int = settings.DOC_BULK_MAX_RETRIES):
+        self.doc_store = doc_store
+        self.index_name = index_name
+        self.knowledgebase_id = knowledgebase_id
+        self.checkpoint = checkpoint
+        self.max_docs = max(1, max_docs)
+        self.max_bytes = max_bytes
+        self.max_retries = max_retries
+        self.indexed_ids = []
+        self.written_ids = []
+        self.error = None
+        self.aborted = False
+        self.bulk_count = 0
+        self.retry_count = 0
+        self._nursery = nursery
+        self._slots = trio.Semaphore(max(1, concurrency))
+        self._checkpoint_lock = trio.Lock()
+        self._buffer = []
+        self._buffer_bytes = 0
+
+    async def add(self, doc: dict):
+        self._buffer.append(doc)
+        self._buffer_bytes += estimate_size(doc)
+        if len(self._buffer) >= self.max_docs or self._buffer_bytes >= self.max_bytes:
+            await self.flush()
+
+    async def add_many(self, docs: list[dict]):
+        for d in docs:
+            await self.add(d)
+
+    async def flush(self):
+        if not self._buffer:
+            return
+        docs, self._buffer, self._buffer_bytes = self._buffer, [], 0
+        await self._slots.acquire()
+        self._nursery.start_soon(self._bulk, docs)
+
+    def _fail(self, error: str):
+        if self.error is None:
+            self.error = error
+        self._nursery.cancel_scope.cancel()
+
+    async def _bulk(self, docs: list[dict]):
+        try:
+            # Recorded before anything can be cancelled: once sent, a document may be in the doc store.
+            self.written_ids.extend([d["id"] for d in docs])
+            pending = docs
+            for attempt in range(self.max_retries + 1):
+                try:
+                    errors = await trio.to_thread.run_sync(lambda: self.doc_store.insert(pending, self.index_name, self.knowledgebase_id))
+                except Exception as e:
+                    errors = [str(e)]
+                if not errors:
+                    break
+                pending_ids = set([d["id"] for d in pending])
+                failed_ids = set()
+                fatal = []
+                for e in errors:
+                    # "<doc id>:<error>" for a document, anything else for the whole request
+                    doc_id, sep, reason = e.partition(":")
+                    if sep and doc_id in pending_ids:
+                        failed_ids.add(doc_id)
+                    else:
+                        reason = e
+                    if not RETRIABLE_ERROR.search(reason):
+                        fatal.append(e)
+                if fatal or attempt == self.max_retries:
+                    self._fail("; ".join((fatal or errors)[:8]))
+                    return
+                rejected = [d for d in pending if d["id"] in failed_ids]
+                # A request-level rejection doesn't name any document: resend the whole bulk.
+                pending = rejected if rejected else pending
+                self.retry_count += 1
+                backoff = min(30., 2 ** attempt) * (0.5 + random.random() / 2)
+                logger.warning(f"BulkIndexer {self.index_name}: {len(pending)} docs rejected, retry in {backoff:.1f}s ({attempt + 1}/{self.max_retries})")
+                await trio.sleep(backoff)
+
+            self.bulk_count += 1
+            async with self._checkpoint_lock:
+                self.indexed_ids.extend([d["id"] for d in docs])
+                if self.checkpoint and await trio.to_thread.run_sync(lambda: self.checkpoint(self.indexed_ids)) is False:
+                    self.aborted = True
+                    self._nursery.cancel_scope.cancel()
+        finally:
+            self._slots.release()
+
+
+@asynccontextmanager
+async def open_bulk_indexer(doc_store: DocStoreConnection, index_name: str, knowledgebase_id: str,
+                            checkpoint: Callable[[list[str]], bool] | None = None, **kwargs):
+    """
+    Usage:
+        async with open_bulk_indexer(docStoreConn, idxnm, kb_id, checkpoint) as indexer:
+            await indexer.add_many(chunks)
+        if indexer.error or indexer.aborted:
+            ...
+    Leaving the block flushes the buffer and waits for all in-flight bulk requests.
+    """
+    async with trio.open_nursery() as nursery:
+        indexer = BulkIndexer(doc_store, index_name, knowledgebase_id, nursery, checkpoint, **kwargs)
+        yield indexer
+        await indexer.flush()
@@ -208,6 +208,22 @@ class DocStoreConnection(ABC):
         """
         raise NotImplementedError("Not implemented")
 
+    @abstractmethod
+    def msearch(self, searches: list[dict]) -> list:
+        """
+        Run several searches with as few round trips as the store allows. Each item holds the
+        keyword arguments of search(); results come back in the same order, each as search() returns it.
+        """
+        raise NotImplementedError("Not implemented")
+
+    @abstractmethod
+    def scan(self, selectFields: list[str], condition: dict, indexNames: str | list[str], knowledgebaseIds: list[str], batchSize: int = 1000):
+        """
+        Generator over all chunks matching the condition, each a dict of the selected fields plus "id".
+        Pages with a cursor so memory and per page cost stay constant.
+        """
+        raise NotImplementedError("Not implemented")
+
     @abstractmethod
     def get(self, chunkId: str, indexName: str, knowledgebaseIds: list[str]) -> dict | None:
         """
@@ -229,6 +245,17 @@ class DocStoreConnection(ABC):
         """
         raise NotImplementedError("Not implemented")
 
+    def updateBulk(self, updates: dict[str, dict], indexName: str, knowledgebaseId: str) -> list[str]:
+        """
+        Partial update of many rows by id, {chunk_id: newValue}. Returns the errors.
+        Stores with a bulk API override this one-by-one fallback.
+        """
+        res = []
+        for chunkId, newValue in updates.items():
+            if not self.update({"id": chunkId}, newValue, indexName, knowledgebaseId):
+                res.append(f"{chunkId}: update failed")
+        return res
+
     @abstractmethod
     def delete(self, condition: dict, indexName: str, knowledgebaseId: str) -> int:
         """
@@ -252,6 +279,22 @@ class DocStoreConnection(ABC):
     def getFields(self, res, fields: list[str]) -> dict[str, dict]:
         raise NotImplementedError("Not implemented")
 
+    def getVectors(self, res, ids: list[str], fieldnm: str, dim: int) -> np.ndarray:
+        """
+        Vectors of `fieldnm` as one contiguous float32 matrix whose rows follow `ids`;
+        rows of chunks without the vector are zero.
+        """
+        vectors = np.zeros((len(ids), dim), dtype=np.float32)
+        fields = self.getFields(res, [fieldnm])
+        for i, chunk_id in enumerate(ids):
+            v = fields.get(chunk_id, {}).get(fieldnm)
+            if v is None:
+                continue
+            if isinstance(v, str):
+                v = v.split("\t")
+            vectors[i] = np.asarray(v, dtype=np.float32)
+        return vectors
+
     @abstractmethod
     def getHighlight(self, res, keywords: list[str], fieldnm: str):
         raise NotImplementedError("Not implemented")
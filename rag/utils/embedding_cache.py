@@ -0,0 +1,143 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import base64
+import logging
+import os
+import threading
+from typing import Callable
+
+import numpy as np
+import xxhash
+from cachetools import LRUCache
+
+from rag.utils import num_tokens_from_string
+from rag.utils.redis_conn import REDIS_CONN
+
+EMBEDDING_CACHE_ENABLED = int(os.environ.get("EMBEDDING_CACHE_ENABLED", "1"))
+EMBEDDING_CACHE_LOCAL_SIZE = int(os.environ.get("EMBEDDING_CACHE_LOCAL_SIZE", "10000"))
+EMBEDDING_CACHE_TTL = int(os.environ.get("EMBEDDING_CACHE_TTL", str(7 * 24 * 3600)))
+
+
+class EmbeddingCache:
+    """
+    Content addressed embedding cache: a vector is keyed by the embedding model and the xxhash of the text.
+    Lookups go to a process local LRU first, then to Redis (one MGET per call); only the misses
+    are sent to the provider. Vectors are stored in Redis as base64 encoded float32 bytes.
+    """
+
+    def __init__(self, local_size=EMBEDDING_CACHE_LOCAL_SIZE, ttl=EMBEDDING_CACHE_TTL, enabled=EMBEDDING_CACHE_ENABLED):
+        self.enabled = bool(enabled)
+        self.ttl = ttl
+        self._local = LRUCache(maxsize=max(1, local_size))
+        self._lock = threading.Lock()
+        self.local_hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(model: str, text: str) -> str:
+        return "embd:{}:{}".format(model, xxhash.xxh128_hexdigest(text.encode("utf-8")))
+
+    @staticmethod
+    def _dumps(v: np.ndarray) -> str:
+        return base64.b64encode(np.asarray(v, dtype=np.float32).tobytes()).decode("ascii")
+
+    @staticmethod
+    def _loads(s: str) -> np.ndarray:
+        return np.frombuffer(base64.b64decode(s), dtype=np.float32)
+
+    def stats(self) -> dict:
+        total = self.local_hits + self.redis_hits + self.misses
+        return {
+            "local_hits": self.local_hits,
+            "redis_hits": self.redis_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.local_hits + self.redis_hits) / total, 4) if total else 0.0,
+        }
+
+    def get_many(self, model: str, texts: list[str]) -> list[np.ndarray | None]:
+        keys = [self.key(model, t) for t in texts]
+        res = [None] * len(texts)
+        remote = []
+        with self._lock:
+            for i, k in enumerate(keys):
+                v = self._local.get(k)
+                if v is not None:
+                    res[i] = v
+                    self.local_hits += 1
+                else:
+                    remote.append(i)
+        if not remote:
+            return res
+        values = REDIS_CONN.mget([keys[i] for i in remote])
+        with self._lock:
+            for i, v in zip(remote, values):
+                if not v:
+                    self.misses += 1
+                    continue
+                try:
+                    res[i] = self._loads(v)
+                except Exception:
+                    self.misses += 1
+                    continue
+                self._local[keys[i]] = res[i]
+                self.redis_hits += 1
+        return res
+
+    def set_many(self, model: str, texts: list[str], vectors):
+        mapping = {}
+        with self._lock:
+            for t, v in zip(texts, vectors):
+                k = self.key(model, t)
+                v = np.asarray(v, dtype=np.float32)
+                self._local[k] = v
+                mapping[k] = self._dumps(v)
+        REDIS_CONN.mset(mapping, self.ttl)
+
+    def encode(self, model: str, texts: list[str], encoder: Callable[[list[str]], tuple[np.ndarray, int]]) -> tuple[np.ndarray, int, int]:
+        """
+        Returns (vectors, used_tokens, billed_tokens). `used_tokens` counts every text like the
+        embedding models do, estimated for the texts served from the cache; `billed_tokens` only
+        counts the texts that were actually sent to `encoder`. Duplicated texts within one call
+        are encoded once.
+        """
+        if not self.enabled or not texts:
+            vectors, used_tokens = encoder(texts)
+            return vectors, used_tokens, used_tokens
+        cached = self.get_many(model, texts)
+        missing = list(dict.fromkeys([t for t, v in zip(texts, cached) if v is None]))
+        billed_tokens = 0
+        if missing:
+            vectors, billed_tokens = encoder(missing)
+            vectors = np.asarray(vectors, dtype=np.float32)
+            if len(vectors) != len(missing):
+                logging.warning(f"EmbeddingCache: encoder returned {len(vectors)} vectors for {len(missing)} texts, skip caching")
+                vectors, used_tokens = encoder(texts)
+                return vectors, used_tokens, billed_tokens + used_tokens
+            self.set_many(model, missing, vectors)
+            fresh = dict(zip(missing, vectors))
+            cached = [v if v is not None else fresh[t] for t, v in zip(texts, cached)]
+        used_tokens = billed_tokens
+        sent = set(missing)
+        for t in texts:
+            if t in sent:
+                sent.discard(t)
+            else:
+                used_tokens += num_tokens_from_string(t)
+        return np.stack(cached).astype(np.float32, copy=False), used_tokens, billed_tokens
+
+EMBEDDING_CACHE = EmbeddingCache()
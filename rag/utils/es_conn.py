@@ -21,12 +21,14 @@ import time
 import os
 
 import copy
+import numpy as np
 from elasticsearch import Elasticsearch, NotFoundError
 from elasticsearch_dsl import UpdateByQuery, Q, Search, Index
 from elastic_transport import ConnectionTimeout
 from rag import settings
 from rag.settings import TAG_FLD, PAGERANK_FLD
 from rag.utils import singleton
+from rag.utils.retrieval_cache import bumps_kb_version, kb_ids_of_insert, kb_ids_of_condition
 from api.utils.file_utils import get_project_base_directory
 from rag.utils.doc_store_conn import DocStoreConnection, MatchExpr, OrderByExpr, MatchTextExpr, MatchDenseExpr, \
     FusionExpr
@@ -145,30 +147,83 @@ class ESConnection(DocStoreConnection):
         """
         Refers to https://www.elastic.co/guide/en/elasticsearch/reference/current/query-dsl.html
         """
+        indexNames, q = self.__searchBody(selectFields, highlightFields, condition, matchExprs, orderBy, offset, limit,
+                                          indexNames, knowledgebaseIds, aggFields, rank_feature)
+
+        for i in range(ATTEMPT_TIME):
+            try:
+                #print(json.dumps(q, ensure_ascii=False))
+                res = self.es.search(index=indexNames,
+                                     body=q,
+                                     timeout="600s",
+                                     # search_type="dfs_query_then_fetch",
+                                     track_total_hits=True,
+                                     _source=True)
+                if str(res.get("timed_out", "")).lower() == "true":
+                    raise Exception("Es Timeout.")
+                logger.debug(f"ESConnection.search {str(indexNames)} res: " + str(res))
+                return res
+            except Exception as e:
+                logger.exception(f"ESConnection.search {str(indexNames)} query: " + str(q))
+                if str(e).find("Timeout") > 0:
+                    continue
+                raise e
+        logger.error("ESConnection.search timeout for 3 times!")
+        raise Exception("ESConnection.search timeout.")
+
+    def msearch(self, searches: list[dict]) -> list:
+        """
+        All searches in one _msearch round trip.
+        Refers to https://www.elastic.co/guide/en/elasticsearch/reference/current/search-multi-search.html
+        """
+        if not searches:
+            return []
+        body = []
+        for kwargs in searches:
+            indexNames, q = self.__searchBody(**kwargs)
+            q["track_total_hits"] = True
+            q["timeout"] = "600s"
+            body.append({"index": ",".join(indexNames)})
+            body.append(q)
+
+        for i in range(ATTEMPT_TIME):
+            try:
+                res = self.es.msearch(searches=body)
+                responses = res["responses"]
+                for r in responses:
+                    if "error" in r:
+                        raise Exception(f"ESConnection.msearch error: {r['error']}")
+                    if str(r.get("timed_out", "")).lower() == "true":
+                        raise Exception("Es Timeout.")
+                return responses
+            except Exception as e:
+                logger.exception("ESConnection.msearch body: " + str(body))
+                if str(e).find("Timeout") > 0:
+                    continue
+                raise e
+        logger.error("ESConnection.msearch timeout for 3 times!")
+        raise Exception("ESConnection.msearch timeout.")
+
+    def __searchBody(
+            self, selectFields: list[str],
+            highlightFields: list[str],
+            condition: dict,
+            matchExprs: list[MatchExpr],
+            orderBy: OrderByExpr,
+            offset: int,
+            limit: int,
+            indexNames: str | list[str],
+            knowledgebaseIds: list[str],
+            aggFields: list[str] = [],
+            rank_feature: dict | None = None
+    ) -> tuple[list[str], dict]:
         if isinstance(indexNames, str):
             indexNames = indexNames.split(",")
         assert isinstance(indexNames, list) and len(indexNames) > 0
         assert "_id" not in condition
 
-        bqry = Q("bool", must=[])
         condition["kb_id"] = knowledgebaseIds
-        for k, v in condition.items():
-            if k == "available_int":
-                if v == 0:
-                    bqry.filter.append(Q("range", available_int={"lt": 1}))
-                else:
-                    bqry.filter.append(
-                        Q("bool", must_not=Q("range", available_int={"lt": 1})))
-                continue
-            if not v:
-                continue
-            if isinstance(v, list):
-                bqry.filter.append(Q("terms", **{k: v}))
-            elif isinstance(v, str) or isinstance(v, int):
-                bqry.filter.append(Q("term", **{k: v}))
-            else:
-                raise Exception(
-                    f"Condition `{str(k)}={str(v)}` value type is {str(type(v))}, expected to be int, str or list.")
+        bqry = self.__filterQuery(condition)
 
         s = Search()
         vector_similarity_weight = 0.5
@@ -235,27 +290,76 @@ class ESConnection(DocStoreConnection):
             s = s[offset:offset + limit]
         q = s.to_dict()
         logger.debug(f"ESConnection.search {str(indexNames)} query: " + json.dumps(q))
+        return indexNames, q
 
-        for i in range(ATTEMPT_TIME):
+    @staticmethod
+    def __filterQuery(condition: dict):
+        bqry = Q("bool", must=[])
+        for k, v in condition.items():
+            if k == "available_int":
+                if v == 0:
+                    bqry.filter.append(Q("range", available_int={"lt": 1}))
+                else:
+                    bqry.filter.append(
+                        Q("bool", must_not=Q("range", available_int={"lt": 1})))
+                continue
+            if not v:
+                continue
+            if isinstance(v, list):
+                bqry.filter.append(Q("terms", **{k: v}))
+            elif isinstance(v, str) or isinstance(v, int):
+                bqry.filter.append(Q("term", **{k: v}))
+            else:
+                raise Exception(
+                    f"Condition `{str(k)}={str(v)}` value type is {str(type(v))}, expected to be int, str or list.")
+        return bqry
+
+    def scan(self, selectFields: list[str], condition: dict, indexNames: str | list[str],
+             knowledgebaseIds: list[str], batchSize: int = 1000):
+        """
+        Stream every chunk matching `condition` over a point in time with search_after,
+        so each page costs the same however deep it is and only one page is held in memory.
+        Refers to https://www.elastic.co/guide/en/elasticsearch/reference/current/paginate-search-results.html
+        """
+        if isinstance(indexNames, str):
+            indexNames = indexNames.split(",")
+        condition = {**condition, "kb_id": knowledgebaseIds}
+        query = self.__filterQuery(condition).to_dict()
+        pit_id = self.es.open_point_in_time(index=indexNames, keep_alive="5m")["id"]
+        try:
+            search_after = None
+            while True:
+                body = {
+                    "query": query,
+                    "size": batchSize,
+                    "sort": [{"_shard_doc": "asc"}],
+                    "pit": {"id": pit_id, "keep_alive": "5m"},
+                    "_source": selectFields,
+                }
+                if search_after:
+                    body["search_after"] = search_after
+                for i in range(ATTEMPT_TIME):
+                    try:
+                        res = self.es.search(body=body, timeout="600s", track_total_hits=False)
+                        break
+                    except Exception as e:
+                        logger.exception(f"ESConnection.scan {str(indexNames)} query: " + json.dumps(body))
+                        if str(e).find("Timeout") > 0 and i < ATTEMPT_TIME - 1:
+                            continue
+                        raise e
+                pit_id = res.get("pit_id", pit_id)
+                hits = res["hits"]["hits"]
+                for chunk_id, d in self.getFields(res, selectFields).items():
+                    d["id"] = chunk_id
+                    yield d
+                if len(hits) < batchSize:
+                    break
+                search_after = hits[-1]["sort"]
+        finally:
             try:
-                #print(json.dumps(q, ensure_ascii=False))
-                res = self.es.search(index=indexNames,
-                                     body=q,
-                                     timeout="600s",
-                                     # search_type="dfs_query_then_fetch",
-                                     track_total_hits=True,
-                                     _source=True)
-                if str(res.get("timed_out", "")).lower() == "true":
-                    raise Exception("Es Timeout.")
-                logger.debug(f"ESConnection.search {str(indexNames)} res: " + str(res))
-                return res
-            except Exception as e:
-                logger.exception(f"ESConnection.search {str(indexNames)} query: " + str(q))
-                if str(e).find("Timeout") > 0:
-                    continue
-                raise e
-        logger.error("ESConnection.search timeout for 3 times!")
-        raise Exception("ESConnection.search timeout.")
+                self.es.close_point_in_time(body={"id": pit_id})
+            except Exception:
+                logger.warning(f"ESConnection.scan fail to close point in time of {str(indexNames)}")
 
     def get(self, chunkId: str, indexName: str, knowledgebaseIds: list[str]) -> dict | None:
         for i in range(ATTEMPT_TIME):
@@ -277,6 +381,7 @@ class ESConnection(DocStoreConnection):
         logger.error("ESConnection.get timeout for 3 times!")
         raise Exception("ESConnection.get timeout.")
 
+    @bumps_kb_version(kb_ids_of_insert)
     def insert(self, documents: list[dict], indexName: str, knowledgebaseId: str = None) -> list[str]:
         # Refers to https://www.elastic.co/guide/en/elasticsearch/reference/current/docs-bulk.html
         operations = []
@@ -304,15 +409,15 @@ class ESConnection(DocStoreConnection):
                             res.append(str(item[action]["_id"]) + ":" + str(item[action]["error"]))
                 return res
             except Exception as e:
-                res.append(str(e))
                 logger.warning("ESConnection.insert got exception: " + str(e))
-                res = []
+                res = [str(e)]
                 if re.search(r"(Timeout|time out)", str(e), re.IGNORECASE):
-                    res.append(str(e))
                     time.sleep(3)
                     continue
+                break
         return res
 
+    @bumps_kb_version(kb_ids_of_condition)
     def update(self, condition: dict, newValue: dict, indexName: str, knowledgebaseId: str) -> bool:
         doc = copy.deepcopy(newValue)
         doc.pop("id", None)
@@ -396,6 +501,40 @@ class ESConnection(DocStoreConnection):
                 break
         return False
 
+    @bumps_kb_version(kb_ids_of_condition)
+    def updateBulk(self, updates: dict[str, dict], indexName: str, knowledgebaseId: str) -> list[str]:
+        # Refers to https://www.elastic.co/guide/en/elasticsearch/reference/current/docs-bulk.html
+        operations = []
+        for chunkId, newValue in updates.items():
+            doc = copy.deepcopy(newValue)
+            doc.pop("id", None)
+            operations.append({"update": {"_index": indexName, "_id": chunkId}})
+            operations.append({"doc": doc})
+        if not operations:
+            return []
+
+        res = []
+        for _ in range(ATTEMPT_TIME):
+            try:
+                res = []
+                r = self.es.bulk(index=indexName, operations=operations, refresh=False, timeout="60s")
+                if re.search(r"False", str(r["errors"]), re.IGNORECASE):
+                    return res
+
+                for item in r["items"]:
+                    if "update" in item and "error" in item["update"]:
+                        res.append(str(item["update"]["_id"]) + ":" + str(item["update"]["error"]))
+                return res
+            except Exception as e:
+                logger.warning("ESConnection.updateBulk got exception: " + str(e))
+                res = [str(e)]
+                if re.search(r"(Timeout|time out)", str(e), re.IGNORECASE):
+                    time.sleep(3)
+                    continue
+                break
+        return res
+
+    @bumps_kb_version(kb_ids_of_condition)
     def delete(self, condition: dict, indexName: str, knowledgebaseId: str) -> int:
         qry = None
         assert "_id" not in condition
@@ -479,6 +618,18 @@ class ESConnection(DocStoreConnection):
                 res_fields[d["id"]] = m
         return res_fields
 
+    def getVectors(self, res, ids: list[str], fieldnm: str, dim: int) -> np.ndarray:
+        rows = {d["_id"]: i for i, d in enumerate(res["hits"]["hits"])}
+        vectors = np.zeros((len(ids), dim), dtype=np.float32)
+        for i, chunk_id in enumerate(ids):
+            j = rows.get(chunk_id)
+            if j is None:
+                continue
+            v = res["hits"]["hits"][j]["_source"].get(fieldnm)
+            if v is not None:
+                vectors[i] = v
+        return vectors
+
     def getHighlight(self, res, keywords: list[str], fieldnm: str):
         ans = {}
         for d in res["hits"]["hits"]:
@@ -20,6 +20,7 @@ import re
 import json
 import time
 import copy
+from concurrent.futures import ThreadPoolExecutor
 import infinity
 from infinity.common import ConflictType, InfinityException, SortType
 from infinity.index import IndexInfo, IndexType
@@ -28,6 +29,7 @@ from infinity.errors import ErrorCode
 from rag import settings
 from rag.settings import PAGERANK_FLD
 from rag.utils import singleton
+from rag.utils.retrieval_cache import bumps_kb_version, kb_ids_of_insert, kb_ids_of_condition
 import pandas as pd
 from api.utils.file_utils import get_project_base_directory
 
@@ -416,6 +418,55 @@ class InfinityConnection(DocStoreConnection):
         logger.debug(f"INFINITY search final result: {str(res)}")
         return res, total_hits_count
 
+    def msearch(self, searches: list[dict]) -> list:
+        """
+        Infinity has no multi-search, run the searches concurrently instead.
+        """
+        if len(searches) <= 1:
+            return [self.search(**kwargs) for kwargs in searches]
+        with ThreadPoolExecutor(max_workers=len(searches)) as executor:
+            return list(executor.map(lambda kwargs: self.search(**kwargs), searches))
+
+    def scan(self, selectFields: list[str], condition: dict, indexNames: str | list[str],
+             knowledgebaseIds: list[str], batchSize: int = 1000):
+        """
+        Keyset paging on id, table by table, instead of growing offsets.
+        """
+        if isinstance(indexNames, str):
+            indexNames = indexNames.split(",")
+        output = selectFields.copy()
+        if "id" not in output:
+            output.append("id")
+        for indexName in indexNames:
+            for knowledgebaseId in knowledgebaseIds:
+                table_name = f"{indexName}_{knowledgebaseId}"
+                last_id = None
+                while True:
+                    inf_conn = self.connPool.get_conn()
+                    try:
+                        db_instance = inf_conn.get_database(self.dbName)
+                        try:
+                            table_instance = db_instance.get_table(table_name)
+                        except Exception:
+                            break
+                        filter_cond = equivalent_condition_to_str(condition, table_instance) if condition else ""
+                        if last_id is not None:
+                            after = f"id > '{last_id}'"
+                            filter_cond = f"({filter_cond}) AND {after}" if filter_cond else after
+                        builder = table_instance.output(output)
+                        if filter_cond:
+                            builder.filter(filter_cond)
+                        builder.sort([("id", SortType.Asc)]).limit(batchSize)
+                        kb_res, _ = builder.to_df()
+                    finally:
+                        self.connPool.release_conn(inf_conn)
+                    for chunk_id, d in self.getFields(kb_res, selectFields).items():
+                        d["id"] = chunk_id
+                        yield d
+                    if len(kb_res) < batchSize:
+                        break
+                    last_id = kb_res["id"].iloc[-1]
+
     def get(
             self, chunkId: str, indexName: str, knowledgebaseIds: list[str]
     ) -> dict | None:
@@ -442,6 +493,7 @@ class InfinityConnection(DocStoreConnection):
         res_fields = self.getFields(res, res.columns.tolist())
         return res_fields.get(chunkId, None)
 
+    @bumps_kb_version(kb_ids_of_insert)
     def insert(
             self, documents: list[dict], indexName: str, knowledgebaseId: str = None
     ) -> list[str]:
@@ -512,6 +564,7 @@ class InfinityConnection(DocStoreConnection):
         logger.debug(f"INFINITY inserted into {table_name} {str_ids}.")
         return []
 
+    @bumps_kb_version(kb_ids_of_condition)
     def update(
             self, condition: dict, newValue: dict, indexName: str, knowledgebaseId: str
     ) -> bool:
@@ -552,6 +605,7 @@ class InfinityConnection(DocStoreConnection):
         self.connPool.release_conn(inf_conn)
         return True
 
+    @bumps_kb_version(kb_ids_of_condition)
     def delete(self, condition: dict, indexName: str, knowledgebaseId: str) -> int:
         inf_conn = self.connPool.get_conn()
         db_instance = inf_conn.get_database(self.dbName)
@@ -0,0 +1,134 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import logging
+import os
+import threading
+import time
+from copy import deepcopy
+from functools import wraps
+
+from cachetools import TTLCache
+
+from rag.utils.redis_conn import REDIS_CONN
+
+METADATA_CACHE_ENABLED = int(os.environ.get("METADATA_CACHE_ENABLED", "1"))
+METADATA_CACHE_SIZE = int(os.environ.get("METADATA_CACHE_SIZE", "4096"))
+# Bounds the staleness of an entry whose invalidation was missed, or that no write invalidates (KB counters).
+METADATA_CACHE_TTL = int(os.environ.get("METADATA_CACHE_TTL", "300"))
+METADATA_VERSION_KEY = "metadata_version"
+METADATA_VERSION_CHANNEL = "metadata_version"
+
+_MISSING = object()
+
+
+class MetadataCache:
+    """
+    Process local cache of knowledge base and model metadata read on the chat path: KB rows,
+    field maps, model configs, tenants. Every write to the Knowledgebase, Tenant and TenantLLM
+    rows bumps a version in Redis and publishes it on METADATA_VERSION_CHANNEL; a listener
+    thread in every process clears its cache on each message, and on every (re)subscription
+    since messages sent meanwhile are lost.
+    """
+
+    def __init__(self, size=METADATA_CACHE_SIZE, ttl=METADATA_CACHE_TTL, enabled=METADATA_CACHE_ENABLED):
+        self.enabled = bool(enabled) and REDIS_CONN.is_alive()
+        self._cache = TTLCache(maxsize=max(1, size), ttl=ttl)
+        self._lock = threading.Lock()
+        # bumped by every invalidation, so that a value loaded across one is not kept
+        self._generation = 0
+        self._listener = None
+
+    def get(self, key, loader):
+        if not self.enabled:
+            return loader()
+        self._listen()
+        with self._lock:
+            value = self._cache.get(key, _MISSING)
+            generation = self._generation
+        if value is not _MISSING:
+            # Callers may modify what they get.
+            return deepcopy(value)
+        value = loader()
+        with self._lock:
+            if generation == self._generation:
+                self._cache[key] = deepcopy(value)
+        return value
+
+    def invalidate(self):
+        with self._lock:
+            self._cache.clear()
+            self._generation += 1
+
+    def bump(self):
+        """Invalidate the caches of all processes, after a metadata write."""
+        self.invalidate()
+        if self.enabled:
+            REDIS_CONN.incr_publish(METADATA_VERSION_KEY, METADATA_VERSION_CHANNEL)
+
+    def _listen(self):
+        if self._listener:
+            return
+        with self._lock:
+            if self._listener:
+                return
+            self._listener = threading.Thread(target=self._run, name="metadata_cache", daemon=True)
+            self._listener.start()
+
+    def _run(self):
+        while True:
+            pubsub = REDIS_CONN.subscribe(METADATA_VERSION_CHANNEL)
+            if pubsub is not None:
+                self.invalidate()
+                try:
+                    for message in pubsub.listen():
+                        if message.get("type") == "message":
+                            self.invalidate()
+                except Exception as e:
+                    logging.warning(f"MetadataCache listener got exception: {e}")
+                finally:
+                    try:
+                        pubsub.close()
+                    except Exception:
+                        pass
+            time.sleep(1)
+
+
+METADATA_CACHE = MetadataCache()
+
+_WRITES = ["save", "insert", "insert_many", "update_by_id", "update_many_by_id", "delete_by_id", "filter_update", "filter_delete"]
+
+
+def bumps_metadata_version(service):
+    """
+    Decorates a CommonService subclass: once any of its write methods returns, successfully or
+    not, the metadata version is bumped.
+    """
+    def bumping(func):
+        @wraps(func)
+        def wrapper(cls, *args, **kwargs):
+            try:
+                return func(cls, *args, **kwargs)
+            finally:
+                try:
+                    METADATA_CACHE.bump()
+                except Exception:
+                    logging.exception(f"MetadataCache.bump after {func.__name__} got exception")
+        return wrapper
+
+    for name in _WRITES:
+        setattr(service, name, classmethod(bumping(getattr(service, name).__func__)))
+    return service
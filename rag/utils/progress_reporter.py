@@ -0,0 +1,110 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import logging
+import os
+import threading
+import time
+
+from api.db.db_models import close_connection
+from api.db.services.task_service import TaskService
+
+PROGRESS_FLUSH_INTERVAL = float(os.environ.get("PROGRESS_FLUSH_INTERVAL", "1"))
+PROGRESS_CANCEL_CHECK_INTERVAL = float(os.environ.get("PROGRESS_CANCEL_CHECK_INTERVAL", "3"))
+
+
+class ProgressReporter:
+    """
+    Coalesces the progress ticks of the running tasks. Messages of a task are joined and only
+    its latest progress is kept; a background thread writes all tasks pending at each interval
+    with TaskService.update_progress_batch. Final states (progress < 0 or >= 1) and cancellations
+    are written immediately, after whatever was pending for the task.
+
+    Cancellation is read from the document at most once per PROGRESS_CANCEL_CHECK_INTERVAL per
+    task, the flag being kept in memory in between.
+    """
+
+    def __init__(self, flush_interval=PROGRESS_FLUSH_INTERVAL, cancel_check_interval=PROGRESS_CANCEL_CHECK_INTERVAL):
+        self._flush_interval = flush_interval
+        self._cancel_check_interval = cancel_check_interval
+        self._lock = threading.Lock()
+        # serializes DB writes, so that an immediate flush never overtakes an older batch
+        self._flush_lock = threading.Lock()
+        self._pending = {}
+        self._canceled = {}
+        self._thread = None
+
+    def is_canceled(self, task_id) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            cached = self._canceled.get(task_id)
+        if cached and (cached[0] or now - cached[1] < self._cancel_check_interval):
+            return cached[0]
+        canceled = TaskService.do_cancel(task_id)
+        with self._lock:
+            self._canceled[task_id] = (canceled, now)
+        return canceled
+
+    def report(self, task_id, info: dict, final=False):
+        with self._lock:
+            pending = self._pending.setdefault(task_id, {"progress_msg": ""})
+            if info.get("progress_msg"):
+                pending["progress_msg"] = "\n".join(m for m in [pending["progress_msg"], info["progress_msg"]] if m)
+            if "progress" in info:
+                pending["progress"] = info["progress"]
+        if final:
+            self.flush(task_id)
+        else:
+            self._start()
+
+    def flush(self, task_id=None):
+        with self._flush_lock:
+            with self._lock:
+                if task_id is None:
+                    infos, self._pending = self._pending, {}
+                else:
+                    infos = {task_id: self._pending.pop(task_id)} if task_id in self._pending else {}
+            if not infos:
+                return
+            try:
+                TaskService.update_progress_batch(infos)
+            except Exception:
+                logging.exception(f"ProgressReporter.flush of {len(infos)} tasks got exception")
+            finally:
+                close_connection()
+
+    def forget(self, task_id):
+        """Write what is left of a finished task and drop its cancellation flag."""
+        self.flush(task_id)
+        with self._lock:
+            self._canceled.pop(task_id, None)
+
+    def _start(self):
+        if self._thread:
+            return
+        with self._lock:
+            if self._thread:
+                return
+            self._thread = threading.Thread(target=self._run, name="progress_reporter", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self._flush_interval)
+            self.flush()
+
+
+PROGRESS_REPORTER = ProgressReporter()
@@ -16,13 +16,17 @@
 
 import logging
 import json
+import os
 import uuid
 
+import trio
 import valkey as redis
 from rag import settings
 from rag.utils import singleton
 from valkey.lock import Lock
 
+REDIS_MAX_CONNECTIONS = int(os.environ.get("REDIS_MAX_CONNECTIONS", "64"))
+
 class RedisMsg:
     def __init__(self, consumer, queue_name, group_name, msg_id, message):
         self.__consumer = consumer
@@ -51,17 +55,22 @@ class RedisDB:
     def __init__(self):
         self.REDIS = None
         self.config = settings.REDIS
+        self.max_connections = int(self.config.get("max_connections", REDIS_MAX_CONNECTIONS))
+        # Async callers run the blocking client in worker threads; at most one thread per pooled connection.
+        self.limiter = trio.CapacityLimiter(self.max_connections)
         self.__open__()
 
     def __open__(self):
         try:
-            self.REDIS = redis.StrictRedis(
+            pool = redis.BlockingConnectionPool(
                 host=self.config["host"].split(":")[0],
                 port=int(self.config.get("host", ":6379").split(":")[1]),
                 db=int(self.config.get("db", 1)),
                 password=self.config.get("password"),
                 decode_responses=True,
+                max_connections=self.max_connections,
             )
+            self.REDIS = redis.StrictRedis(connection_pool=pool)
         except Exception:
             logging.warning("Redis can't be connected.")
         return self.REDIS
@@ -95,6 +104,90 @@ class RedisDB:
             logging.warning("RedisDB.get " + str(k) + " got exception: " + str(e))
             self.__open__()
 
+    def delete(self, k) -> bool:
+        try:
+            self.REDIS.delete(k)
+            return True
+        except Exception as e:
+            logging.warning("RedisDB.delete " + str(k) + " got exception: " + str(e))
+            self.__open__()
+        return False
+
+    def mget(self, keys: list[str]) -> list:
+        if not self.REDIS or not keys:
+            return [None] * len(keys)
+        try:
+            return self.REDIS.mget(keys)
+        except Exception as e:
+            logging.warning("RedisDB.mget " + str(len(keys)) + " keys got exception: " + str(e))
+            self.__open__()
+        return [None] * len(keys)
+
+    def mset(self, mapping: dict, exp=3600):
+        if not mapping:
+            return True
+        try:
+            pipeline = self.REDIS.pipeline(transaction=False)
+            for k, v in mapping.items():
+                pipeline.set(k, v, exp)
+            pipeline.execute()
+            return True
+        except Exception as e:
+            logging.warning("RedisDB.mset " + str(len(mapping)) + " keys got exception: " + str(e))
+            self.__open__()
+        return False
+
+    def incr_many(self, keys: list[str]):
+        if not keys:
+            return True
+        try:
+            pipeline = self.REDIS.pipeline(transaction=False)
+            for k in keys:
+                pipeline.incr(k)
+            pipeline.execute()
+            return True
+        except Exception as e:
+            logging.warning("RedisDB.incr_many " + str(keys) + " got exception: " + str(e))
+            self.__open__()
+        return False
+
+    def incr_publish(self, key: str, channel: str):
+        """INCR `key` and publish its new value on `channel`. Returns the new value, None on failure."""
+        try:
+            version = self.REDIS.incr(key)
+            self.REDIS.publish(channel, version)
+            return version
+        except Exception as e:
+            logging.warning("RedisDB.incr_publish " + str(key) + " got exception: " + str(e))
+            self.__open__()
+        return None
+
+    def subscribe(self, channel: str):
+        """A PubSub subscribed to `channel`, None when Redis can't be reached."""
+        try:
+            pubsub = self.REDIS.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(channel)
+            return pubsub
+        except Exception as e:
+            logging.warning("RedisDB.subscribe " + str(channel) + " got exception: " + str(e))
+            self.__open__()
+        return None
+
+    async def _run(self, func, *args):
+        return await trio.to_thread.run_sync(func, *args, limiter=self.limiter)
+
+    async def aget(self, k):
+        return await self._run(self.get, k)
+
+    async def aset(self, k, v, exp=3600):
+        return await self._run(self.set, k, v, exp)
+
+    async def amget(self, keys: list[str]) -> list:
+        return await self._run(self.mget, keys)
+
+    async def amset(self, mapping: dict, exp=3600):
+        return await self._run(self.mset, mapping, exp)
+
     def set_obj(self, k, obj, exp=3600):
         try:
             self.REDIS.set(k, json.dumps(obj, ensure_ascii=False), exp)
@@ -151,6 +244,14 @@ class RedisDB:
             self.__open__()
         return False
 
+    def zscore(self, key: str, member: str):
+        try:
+            return self.REDIS.zscore(key, member)
+        except Exception as e:
+            logging.warning("RedisDB.zscore " + str(key) + " got exception: " + str(e))
+            self.__open__()
+        return None
+
     def zcount(self, key: str, min: float, max: float):
         try:
             res = self.REDIS.zcount(key, min, max)
@@ -209,6 +310,10 @@ class RedisDB:
         return False
 
     def queue_consumer(self, queue_name, group_name, consumer_name, msg_id=b">") -> RedisMsg:
+        res = self.queue_consumer_batch(queue_name, group_name, consumer_name, 1, msg_id)
+        return res[0] if res else None
+
+    def queue_consumer_batch(self, queue_name, group_name, consumer_name, count=1, msg_id=b">") -> list[RedisMsg]:
         """https://redis.io/docs/latest/commands/xreadgroup/"""
         try:
             group_info = self.REDIS.xinfo_groups(queue_name)
@@ -217,19 +322,15 @@ class RedisDB:
             args = {
                 "groupname": group_name,
                 "consumername": consumer_name,
-                "count": 1,
+                "count": count,
                 "block": 5,
                 "streams": {queue_name: msg_id},
             }
             messages = self.REDIS.xreadgroup(**args)
             if not messages:
-                return None
+                return []
             stream, element_list = messages[0]
-            if not element_list:
-                return None
-            msg_id, payload = element_list[0]
-            res = RedisMsg(self.REDIS, queue_name, group_name, msg_id, payload)
-            return res
+            return [RedisMsg(self.REDIS, queue_name, group_name, msg_id, payload) for msg_id, payload in element_list]
         except Exception as e:
             if "key" in str(e):
                 pass
@@ -240,7 +341,34 @@ class RedisDB:
                     + " got exception: "
                     + str(e)
                 )
-        return None
+        return []
+
+    def queue_claim(self, queue_name, group_name, consumer_name, from_consumers, min_idle_ms, count=1) -> list[RedisMsg]:
+        """
+        Take over messages left pending by `from_consumers` for at least `min_idle_ms`.
+        https://redis.io/docs/latest/commands/xclaim/
+        """
+        res = []
+        try:
+            for owner in from_consumers:
+                if len(res) >= count:
+                    break
+                pending = self.REDIS.xpending_range(queue_name, group_name, min="-", max="+", count=count - len(res),
+                                                    consumername=owner, idle=min_idle_ms)
+                if not pending:
+                    continue
+                claimed = self.REDIS.xclaim(queue_name, group_name, consumer_name, min_idle_ms,
+                                            [p["message_id"] for p in pending])
+                for msg_id, payload in claimed:
+                    if not payload:
+                        # the entry was trimmed from the stream, nothing left to run
+                        self.REDIS.xack(queue_name, group_name, msg_id)
+                        continue
+                    logging.info(f"RedisDB.queue_claim {consumer_name} took {msg_id} over from {owner}")
+                    res.append(RedisMsg(self.REDIS, queue_name, group_name, msg_id, payload))
+        except Exception as e:
+            logging.warning("RedisDB.queue_claim " + str(queue_name) + " got exception: " + str(e))
+        return res
 
     def get_unacked_iterator(self, queue_name, group_name, consumer_name):
         try:
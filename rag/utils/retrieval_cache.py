@@ -0,0 +1,171 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import json
+import logging
+import os
+import re
+import threading
+from copy import deepcopy
+from functools import wraps
+
+import xxhash
+from cachetools import TTLCache
+
+from rag.utils.redis_conn import REDIS_CONN
+
+RETRIEVAL_CACHE_ENABLED = int(os.environ.get("RETRIEVAL_CACHE_ENABLED", "1"))
+RETRIEVAL_CACHE_SIZE = int(os.environ.get("RETRIEVAL_CACHE_SIZE", "1024"))
+RETRIEVAL_CACHE_TTL = int(os.environ.get("RETRIEVAL_CACHE_TTL", "600"))
+
+# version keys whose bump failed, retried on the next bump; results are not cached meanwhile
+_pending_bumps = set()
+_pending_lock = threading.Lock()
+
+
+def normalize_question(txt: str) -> str:
+    return re.sub(r"\s+", " ", txt).strip()
+
+
+def kb_version_key(kb_id: str) -> str:
+    return f"kb_version:{kb_id}"
+
+
+def bump_kb_version(kb_ids) -> bool:
+    """
+    Called on every chunk insert, update or delete of the knowledge bases, so that ranked
+    results cached for them are no longer reachable. Bumps that failed before are retried along.
+    Returns False if the bump failed: it is then kept pending.
+    """
+    if isinstance(kb_ids, str):
+        kb_ids = [kb_ids]
+    keys = set([kb_version_key(kb_id) for kb_id in kb_ids or [] if kb_id])
+    with _pending_lock:
+        keys |= _pending_bumps
+        _pending_bumps.clear()
+    if not keys:
+        return True
+    if REDIS_CONN.incr_many(sorted(keys)):
+        return True
+    logging.error(f"bump_kb_version of {sorted(keys)} failed, cached retrieval results of these knowledge bases may be stale")
+    with _pending_lock:
+        _pending_bumps.update(keys)
+    return False
+
+
+def _as_list(v) -> list:
+    if not v:
+        return []
+    return v if isinstance(v, list) else [v]
+
+
+def kb_ids_of_insert(conn, documents, indexName, knowledgebaseId=None, *args, **kwargs) -> list:
+    if knowledgebaseId:
+        return [knowledgebaseId]
+    return [kb_id for d in documents for kb_id in _as_list(d.get("kb_id"))]
+
+
+def kb_ids_of_condition(conn, condition, *args, **kwargs) -> list:
+    # update(condition, newValue, indexName, knowledgebaseId) and delete(condition, indexName, knowledgebaseId)
+    knowledgebaseId = kwargs.get("knowledgebaseId", args[-1] if args else None)
+    return _as_list(knowledgebaseId) + _as_list(condition.get("kb_id"))
+
+
+def bumps_kb_version(kb_ids_of):
+    """
+    Decorates a DocStoreConnection write operation: once it returns, successfully or not,
+    the version of the knowledge bases found by `kb_ids_of(*args, **kwargs)` is bumped.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            try:
+                return func(*args, **kwargs)
+            finally:
+                try:
+                    bump_kb_version(kb_ids_of(*args, **kwargs))
+                except Exception:
+                    logging.exception(f"bump_kb_version after {func.__name__} got exception")
+        return wrapper
+    return decorator
+
+
+def get_kb_versions(kb_ids: list[str]) -> list | None:
+    """Version stamps of the knowledge bases, None if Redis can't be read."""
+    try:
+        return REDIS_CONN.REDIS.mget([kb_version_key(kb_id) for kb_id in kb_ids])
+    except Exception as e:
+        logging.warning(f"get_kb_versions got exception: {e}")
+        return None
+
+
+class RetrievalCache:
+    """
+    Process local cache of Dealer.retrieval results. The key folds in the version stamp of every
+    knowledge base involved, which is shared through Redis and bumped on any chunk change, so
+    a stale entry is never hit again and simply ages out of the TTL cache. Nothing is cached
+    while the versions can't be read or a bump of this process is pending.
+    """
+
+    def __init__(self, size=RETRIEVAL_CACHE_SIZE, ttl=RETRIEVAL_CACHE_TTL, enabled=RETRIEVAL_CACHE_ENABLED):
+        self.enabled = bool(enabled) and REDIS_CONN.is_alive()
+        self._cache = TTLCache(maxsize=max(1, size), ttl=ttl)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, kb_ids: list[str], **params) -> str | None:
+        if not self.enabled:
+            return None
+        if _pending_bumps and not bump_kb_version([]):
+            return None
+        kb_ids = sorted(kb_ids)
+        versions = get_kb_versions(kb_ids)
+        if versions is None:
+            # Writes made meanwhile may not have bumped anything: drop what was cached before.
+            with self._lock:
+                self._cache.clear()
+            return None
+        try:
+            raw = json.dumps({"kb": dict(zip(kb_ids, versions)), **params}, sort_keys=True, ensure_ascii=False, default=str)
+        except Exception as e:
+            logging.warning(f"RetrievalCache.key got exception: {e}")
+            return None
+        return xxhash.xxh128_hexdigest(raw.encode("utf-8"))
+
+    def get(self, key: str | None):
+        if key is None:
+            return None
+        with self._lock:
+            res = self._cache.get(key)
+            if res is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        # Callers decorate the ranks in place.
+        return deepcopy(res)
+
+    def set(self, key: str | None, ranks: dict):
+        if key is None:
+            return
+        with self._lock:
+            self._cache[key] = deepcopy(ranks)
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._cache)}
+
+
+RETRIEVAL_CACHE = RetrievalCache()